@@ -0,0 +1,222 @@
+"""
+Offline relay benchmarks.
+
+Runs the real Relay cog and RelayBot against a fake Discord and an in-memory
+database, and reports throughput, fan-out latency and REST calls per relayed
+message for each scenario::
+
+    python -m bench
+    python -m bench --latency 0.05 --rate-limit-chance 0.02 --scenario pool-30
+"""
+from argparse import ArgumentParser
+from asyncio import gather, run, sleep
+from contextlib import redirect_stdout
+from time import perf_counter
+from typing import *
+
+from tabulate import tabulate
+
+from bench.fakes import FakeDiscord, FakeReactionPayload
+from bench.harness import Harness, percentile
+
+
+class Scenario(NamedTuple):
+    name: str
+    pool_size: int
+    messages: int
+    attachments: int = 0
+    reactions: int = 0
+    # Reactions removed again by their users, the first ones that were added
+    removals: int = 0
+    # Seconds between messages, 0 sends them all at once
+    interval: float = 0.05
+    # Moderation threshold of the pool, None disables moderation
+    moderation: Optional[float] = None
+    # Pools containing every channel, more than one overlap completely
+    pools: int = 1
+    # Separate groups of pool_size channels with their own pools, messages are spread over them
+    busy_pools: int = 1
+    # Times every message is delivered by the gateway, like after a resume
+    deliveries: int = 1
+    # Messages per second to a channel from which they're batched, None disables batching
+    coalesce: Optional[float] = None
+    # Messages sent at the same time to a separate, quiet pool of 2 channels
+    quiet: int = 0
+    # Budget of the busy pools, see Budget in src/common/models.py
+    budget: Optional[Dict[str, Any]] = None
+
+
+SCENARIOS: List[Scenario] = [
+    Scenario("pool-2", pool_size=2, messages=20),
+    Scenario("pool-10", pool_size=10, messages=20),
+    Scenario("pool-30", pool_size=30, messages=20),
+    Scenario("pool-10-attachments", pool_size=10, messages=10, attachments=3),
+    Scenario("pool-10-burst", pool_size=10, messages=50, interval=0.0),
+    Scenario("pool-10-moderated", pool_size=10, messages=20, moderation=0.9),
+    Scenario("pool-10-burst-moderated", pool_size=10, messages=50, interval=0.0, moderation=0.9),
+    Scenario("pool-10-overlapping-duplicates", pool_size=10, messages=20, pools=3, deliveries=2),
+    Scenario("pool-10-busy", pool_size=10, messages=100, interval=0.02),
+    Scenario("pool-10-busy-coalesced", pool_size=10, messages=100, interval=0.02, coalesce=2.0),
+    Scenario("pool-10-reaction-storm", pool_size=10, messages=1, reactions=100),
+    Scenario("pool-10-reaction-churn", pool_size=10, messages=1, reactions=60, removals=60),
+    Scenario("pool-30-burst-with-quiet", pool_size=30, messages=50, interval=0.0, quiet=10, busy_pools=3),
+    Scenario(
+        "pool-30-burst-with-quiet-budgeted",
+        pool_size=30,
+        messages=50,
+        interval=0.0,
+        quiet=10,
+        busy_pools=3,
+        budget={"concurrency": 4},
+    ),
+]
+
+# Scenarios run without and with budgets on the busy pools, the quiet pool must be faster with them
+BUDGET_CHECKS: List[Tuple[str, str]] = [
+    ("pool-30-burst-with-quiet", "pool-30-burst-with-quiet-budgeted"),
+]
+
+
+async def run_scenario(scenario: Scenario, latency: float, rate_limit_chance: float) -> Dict[str, Any]:
+    discord = FakeDiscord(latency=latency, rate_limit_chance=rate_limit_chance)
+    groups = []
+    for g in range(scenario.busy_pools):
+        group = []
+        for i in range(scenario.pool_size):
+            guild = discord.add_guild(f"Guild {g}-{i}")
+            group.append(discord.add_channel(guild, "relay"))
+        groups.append(group)
+    # Interleaved, so consecutive messages go to different busy pools
+    channels = [channel for channels in zip(*groups) for channel in channels]
+    users = [discord.add_user(f"User {i}") for i in range(8)]
+    quiet_channels = []
+    if scenario.quiet:
+        for i in range(2):
+            guild = discord.add_guild(f"Quiet guild {i}")
+            quiet_channels.append(discord.add_channel(guild, "relay"))
+
+    harness = Harness(discord)
+    with redirect_stdout(harness.output):
+        pools = {
+            f"bench-{g * scenario.pools + i}": group
+            for g, group in enumerate(groups)
+            for i in range(scenario.pools)
+        }
+        pool_settings = {pool_name: {"budget": scenario.budget} for pool_name in pools}
+        if quiet_channels:
+            pools["quiet"] = quiet_channels
+        await harness.start(
+            pools,
+            pool_settings=pool_settings,
+            moderation=scenario.moderation,
+            coalesce=scenario.coalesce,
+        )
+
+        messages = [
+            discord.message(
+                channels[i % len(channels)],
+                users[i % len(users)],
+                f"Message {i}",
+                attachments=scenario.attachments,
+            )
+            for i in range(scenario.messages)
+        ]
+
+        async def relay(index: int) -> float:
+            await sleep(index * scenario.interval)
+            for _ in range(scenario.deliveries - 1):
+                await harness.cog.on_message(messages[index])
+            return await harness.timed(harness.cog.on_message, messages[index])
+
+        quiet_messages = [
+            discord.message(quiet_channels[i % 2], users[i % len(users)], f"Quiet message {i}")
+            for i in range(scenario.quiet)
+        ]
+
+        async def relay_quiet(index: int) -> float:
+            # Spread over the burst of the busy pools
+            await sleep(index * 0.05)
+            return await harness.timed(harness.cog.on_message, quiet_messages[index])
+
+        start = perf_counter()
+        results = await gather(
+            gather(*(relay(i) for i in range(len(messages)))),
+            gather(*(relay_quiet(i) for i in range(len(quiet_messages)))),
+        )
+        latencies, quiet_latencies = list(results[0]), list(results[1])
+        await harness.settle()
+        elapsed = perf_counter() - start
+        calls_after_messages = discord.rest_calls()
+
+        reaction_latencies: List[float] = []
+        if scenario.reactions:
+            source = messages[0]
+            payloads = [
+                FakeReactionPayload(
+                    users[i % len(users)].id,
+                    source.channel.id,
+                    source.id,
+                    ["👍", "🔥", "😂"][i % 3],
+                    source.guild.id,
+                )
+                for i in range(scenario.reactions)
+            ]
+            reaction_latencies = list(
+                await gather(
+                    *(harness.timed(harness.cog.on_raw_reaction_add, p) for p in payloads),
+                    *(
+                        harness.timed(harness.cog.on_raw_reaction_remove, p)
+                        for p in payloads[:scenario.removals]
+                    ),
+                )
+            )
+            await harness.settle()
+
+        await harness.stop()
+
+    moderation = harness.cog.moderation
+    return {
+        "scenario": scenario.name,
+        "msgs/s": len(messages) / elapsed if elapsed else 0.0,
+        "p50 ms": percentile(latencies, 50) * 1000,
+        "p99 ms": percentile(latencies, 99) * 1000,
+        "REST/msg": calls_after_messages / len(messages),
+        "CDN/msg": discord.calls["cdn_download"] / len(messages),
+        "reaction REST": discord.rest_calls() - calls_after_messages,
+        "reaction p99 ms": percentile(reaction_latencies, 99) * 1000,
+        "quiet p50 ms": percentile(quiet_latencies, 50) * 1000,
+        "quiet p99 ms": percentile(quiet_latencies, 99) * 1000,
+        "429s": discord.calls["429"],
+        "moderated/s": moderation.stats["texts"] / moderation.scoring_seconds
+        if moderation.scoring_seconds
+        else 0.0,
+        "loop lag p99 ms": harness.bot.metrics.histograms["relay_loop_lag_seconds"][()].quantile(0.99) * 1000,
+        "db ops": sum(harness.db.stats.values()),
+        "errors": harness.errors(),
+    }
+
+
+async def main() -> None:
+    parser = ArgumentParser(prog="python -m bench", description=__doc__.splitlines()[1])
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated REST latency in seconds")
+    parser.add_argument("--rate-limit-chance", type=float, default=0.0, help="chance of a 429 per request")
+    parser.add_argument("--scenario", action="append", help="only run the named scenario(s)")
+    args = parser.parse_args()
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    results = []
+    for scenario in scenarios:
+        results.append(await run_scenario(scenario, args.latency, args.rate_limit_chance))
+
+    print(tabulate(results, headers="keys", floatfmt=".1f"))
+
+    by_name = {result["scenario"]: result for result in results}
+    for unbudgeted, budgeted in BUDGET_CHECKS:
+        if unbudgeted in by_name and budgeted in by_name:
+            assert by_name[budgeted]["quiet p50 ms"] < by_name[unbudgeted]["quiet p50 ms"], (
+                f"Budgets of the busy pools didn't lower the latency of the quiet pool in {budgeted}"
+            )
+
+
+if __name__ == "__main__":
+    run(main())
@@ -0,0 +1,275 @@
+"""
+Local stand-ins for the parts of nextcord the relay touches.
+
+``FakeDiscord`` owns the guilds, channels, webhooks and messages, and every
+object that would make a REST call goes through :meth:`FakeDiscord.rest`, which
+simulates latency and 429 responses and counts the calls per route.
+"""
+from asyncio import sleep
+from collections import Counter
+from itertools import count
+from random import Random
+from typing import *
+
+
+class FakeAsset:
+    def __init__(self, url: str) -> None:
+        self.url = url
+
+
+class FakeUser:
+    def __init__(self, discord: "FakeDiscord", name: str, bot: bool = False) -> None:
+        self.id = discord.snowflake()
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.avatar = FakeAsset(f"https://cdn.example/avatars/{self.id}.png")
+        self.display_avatar = self.avatar
+
+    def __eq__(self, other) -> bool:
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+
+class FakeGuild:
+    def __init__(self, discord: "FakeDiscord", name: str) -> None:
+        self.discord = discord
+        self.id = discord.snowflake()
+        self.name = name
+        self.channels: List[FakeChannel] = []
+        self.emojis: List[Any] = []
+
+    def get_member(self, user_id: int) -> None:
+        return None
+
+
+class FakeAttachment:
+    def __init__(self, discord: "FakeDiscord", filename: str, size: int) -> None:
+        self.discord = discord
+        self.id = discord.snowflake()
+        self.filename = filename
+        self.size = size
+        self.url = f"https://cdn.example/attachments/{self.id}/{filename}"
+        self.description = None
+
+    def is_spoiler(self) -> bool:
+        return False
+
+    async def read(self, *, use_cached: bool = False) -> bytes:
+        await self.discord.rest("cdn_download")
+        return bytes(self.size)
+
+
+class FakeReaction:
+    def __init__(self, emoji: str) -> None:
+        self.emoji = emoji
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        discord: "FakeDiscord",
+        channel: "FakeChannel",
+        author: FakeUser,
+        content: str,
+        attachments: Optional[List[FakeAttachment]] = None,
+        webhook_id: Optional[int] = None,
+    ) -> None:
+        self.discord = discord
+        self.id = discord.snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.attachments = attachments or []
+        self.reactions: List[FakeReaction] = []
+        self.webhook_id = webhook_id
+
+    async def add_reaction(self, emoji: Any) -> None:
+        await self.discord.rest("add_reaction")
+
+
+class FakePartialMessage:
+    def __init__(self, discord: "FakeDiscord", channel_id: int, message_id: int) -> None:
+        self.discord = discord
+        self.channel_id = channel_id
+        self.id = message_id
+
+    async def add_reaction(self, emoji: Any) -> None:
+        await self.discord.rest("add_reaction")
+
+    async def remove_reaction(self, emoji: Any, member: Any) -> None:
+        await self.discord.rest("remove_reaction")
+
+    async def clear_reaction(self, emoji: Any) -> None:
+        await self.discord.rest("clear_reaction")
+
+    async def clear_reactions(self) -> None:
+        await self.discord.rest("clear_reactions")
+
+
+class FakePartialMessageable:
+    def __init__(self, discord: "FakeDiscord", channel_id: int) -> None:
+        self.discord = discord
+        self.id = channel_id
+
+    def get_partial_message(self, message_id: int) -> FakePartialMessage:
+        return FakePartialMessage(self.discord, self.id, message_id)
+
+
+class FakeWebhook:
+    def __init__(self, discord: "FakeDiscord", channel: "FakeChannel", name: str) -> None:
+        self.discord = discord
+        self.id = discord.snowflake()
+        self.token = f"token-{self.id}"
+        self.name = name
+        self.channel = channel
+        self.channel_id = channel.id
+        self.user = discord.user
+
+    async def send(self, content: str = "", *, username: str = "", wait: bool = False, **kwargs):
+        await self.discord.rest("execute_webhook")
+        author = FakeUser(self.discord, username, bot=True)
+        message = FakeMessage(self.discord, self.channel, author, content, webhook_id=self.id)
+        self.discord.delivered[self.channel.id] += 1
+        return message if wait else None
+
+    async def edit_message(self, message_id: int, **kwargs) -> None:
+        await self.discord.rest("edit_webhook_message")
+
+    async def delete_message(self, message_id: int) -> None:
+        await self.discord.rest("delete_webhook_message")
+
+
+class FakeChannel:
+    def __init__(self, discord: "FakeDiscord", guild: FakeGuild, name: str) -> None:
+        self.discord = discord
+        self.id = discord.snowflake()
+        self.guild = guild
+        self.name = name
+        self.mention = f"<#{self.id}>"
+        self.hooks: List[FakeWebhook] = []
+
+    async def webhooks(self) -> List[FakeWebhook]:
+        await self.discord.rest("list_webhooks")
+        return list(self.hooks)
+
+    async def create_webhook(self, *, name: str) -> FakeWebhook:
+        await self.discord.rest("create_webhook")
+        webhook = FakeWebhook(self.discord, self, name)
+        self.hooks.append(webhook)
+        return webhook
+
+    async def delete_messages(self, messages: List[Any]) -> None:
+        await self.discord.rest("bulk_delete")
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        await self.discord.rest("fetch_message")
+        return FakeMessage(self.discord, self, self.discord.user, "")
+
+    def get_partial_message(self, message_id: int) -> FakePartialMessage:
+        return FakePartialMessage(self.discord, self.id, message_id)
+
+
+class FakeReactionPayload:
+    """Mirrors RawReactionActionEvent."""
+
+    def __init__(self, user_id: int, channel_id: int, message_id: int, emoji: str, guild_id: int) -> None:
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.emoji = emoji
+        self.guild_id = guild_id
+        self.member = None
+
+
+class FakeReactionClearPayload:
+    """Mirrors RawReactionClearEvent, and RawReactionClearEmojiEvent when an emoji is given."""
+
+    def __init__(self, channel_id: int, message_id: int, guild_id: int, emoji: Optional[str] = None) -> None:
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.guild_id = guild_id
+        self.emoji = emoji
+
+
+class FakeDiscord:
+    """
+    The fake Discord API.
+
+    :param latency: Simulated REST round trip, in seconds.
+    :param rate_limit_chance: Probability that a request is answered with a 429 first.
+    :param retry_after: How long a 429 makes the request wait before it is retried.
+    :param seed: Seed for the 429 simulation, so runs are repeatable.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        rate_limit_chance: float = 0.0,
+        retry_after: float = 0.05,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.rate_limit_chance = rate_limit_chance
+        self.retry_after = retry_after
+        self.random = Random(seed)
+        self.ids = count(1 << 40)
+        self.calls: Counter = Counter()
+        self.delivered: Counter = Counter()
+        self.guilds: Dict[int, FakeGuild] = {}
+        self.channels: Dict[int, FakeChannel] = {}
+        self.user = FakeUser(self, "RelayBot", bot=True)
+
+    def snowflake(self) -> int:
+        return next(self.ids)
+
+    async def rest(self, route: str) -> None:
+        """Simulate one REST request, retried like nextcord does after a 429."""
+        self.calls[route] += 1
+        while self.random.random() < self.rate_limit_chance:
+            self.calls["429"] += 1
+            await sleep(self.latency + self.retry_after)
+        await sleep(self.latency)
+
+    def rest_calls(self) -> int:
+        """Total REST requests to the API, excluding CDN downloads and 429 retries."""
+        return sum(n for route, n in self.calls.items() if route not in ("cdn_download", "429"))
+
+    def add_user(self, name: str) -> FakeUser:
+        return FakeUser(self, name)
+
+    def add_guild(self, name: str) -> FakeGuild:
+        guild = FakeGuild(self, name)
+        self.guilds[guild.id] = guild
+        return guild
+
+    def add_channel(self, guild: FakeGuild, name: str) -> FakeChannel:
+        channel = FakeChannel(self, guild, name)
+        guild.channels.append(channel)
+        self.channels[channel.id] = channel
+        return channel
+
+    def message(
+        self,
+        channel: FakeChannel,
+        author: FakeUser,
+        content: str,
+        attachments: int = 0,
+        attachment_size: int = 256 * 1024,
+    ) -> FakeMessage:
+        files = [
+            FakeAttachment(self, f"image{i}.png", attachment_size) for i in range(attachments)
+        ]
+        return FakeMessage(self, channel, author, content, files)
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+    def get_guild(self, guild_id: int) -> Optional[FakeGuild]:
+        return self.guilds.get(guild_id)
+
+    def get_partial_messageable(self, channel_id: int, **kwargs) -> FakePartialMessageable:
+        return FakePartialMessageable(self, channel_id)
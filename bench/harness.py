@@ -0,0 +1,127 @@
+"""
+Runs the real RelayBot and Relay cog against the fakes, fully offline.
+"""
+import sys
+from asyncio import sleep
+from io import StringIO
+from time import perf_counter
+from typing import *
+
+from bench.fakes import FakeChannel, FakeDiscord
+from bench.memdb import MemoryDatabase
+
+
+def install_database(database: Any) -> None:
+    """Point every loaded module of the bot at the given database handle."""
+    for name, module in list(sys.modules.items()):
+        if (name == "bot" or name.startswith("src.")) and hasattr(module, "db"):
+            module.db = database
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile, q in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+class Harness:
+    """
+    A RelayBot with the Relay cog loaded, wired to a FakeDiscord and a MemoryDatabase.
+
+    The bot never connects to the gateway. Channel, guild and user lookups are
+    answered by the fake and events are fed by calling the cog's listeners.
+    """
+
+    def __init__(self, discord: FakeDiscord) -> None:
+        self.discord = discord
+        self.db = MemoryDatabase()
+        # Everything the bot prints while a scenario runs, see errors()
+        self.output = StringIO()
+        self.bot = None
+        self.cog = None
+        # When the event with the given payload finished processing, by id() of the payload
+        self.processed: Dict[int, float] = {}
+
+    async def start(
+        self,
+        pools: Dict[str, List[FakeChannel]],
+        pool_settings: Optional[Dict[str, Dict[str, Any]]] = None,
+        **settings: Any,
+    ) -> None:
+        """
+        Create the bot and cog inside the running loop and load the given pools.
+
+        :param pools: The channels of every pool, by pool name.
+        :param pool_settings: Settings of single pools, by pool name, over ``settings``.
+        :param settings: Settings of every pool, like ``moderation`` or ``coalesce``.
+        """
+        from bot import RelayBot
+        from src.cogs.relay import Relay
+
+        install_database(self.db)
+
+        self.bot = RelayBot()
+        self.bot._connection.user = self.discord.user  # noqa
+        self.bot.get_channel = self.discord.get_channel
+        self.bot.get_guild = self.discord.get_guild
+        self.bot.get_partial_messageable = self.discord.get_partial_messageable
+        self.bot.loop_monitor.start()
+
+        for pool_name, channels in pools.items():
+            servers: Dict[str, Dict[str, Any]] = {}
+            for channel in channels:
+                server = servers.setdefault(
+                    str(channel.guild.id), {"channels": [], "message_count": 0}
+                )
+                server["channels"].append(channel.id)
+            await self.db.relay_pools.insert_one(
+                {
+                    "_id": pool_name,
+                    "password": None,
+                    "servers": servers,
+                    **settings,
+                    **(pool_settings or {}).get(pool_name, {}),
+                }
+            )
+
+        self.cog = Relay(self.bot)
+        await self.cog.startup()
+
+        # Listeners only queue events, record when the ingest workers finish each one
+        handler = self.cog.ingest.handler
+
+        async def process(pool_name: str, item: Any) -> None:
+            await handler(pool_name, item)
+            self.processed[id(item.payload)] = perf_counter()
+
+        self.cog.ingest.handler = process
+
+    async def settle(self) -> None:
+        """Wait until the queued events, batched messages, debounced reactions and the requests they scheduled are done."""
+        await self.cog.ingest.join()
+        await self.cog.coalescer.close()
+        await self.cog.reactions.close()
+        while self.bot.scheduler.depth or self.bot.scheduler.in_flight:
+            await sleep(0.005)
+
+    async def stop(self) -> None:
+        for hook in reversed(self.bot.shutdown_hooks):
+            await hook()
+
+    def errors(self) -> int:
+        """Number of errors the bot printed."""
+        return sum(1 for line in self.output.getvalue().splitlines() if line.startswith("Error"))
+
+    async def timed(self, listener: Callable[[Any], Awaitable[Any]], payload: Any) -> float:
+        """
+        Feed an event to a listener and wait for the ingest workers to process it.
+
+        :return: How long it took from the event to the end of its processing, in seconds.
+        """
+        start = perf_counter()
+        await listener(payload)
+        await self.cog.ingest.join()
+        return self.processed.get(id(payload), perf_counter()) - start
@@ -0,0 +1,332 @@
+"""
+An in-memory stand-in for the motor database handle in ``src.common.common``.
+
+Only the subset of the MongoDB query and update language the bot uses is
+supported. Every operation yields to the event loop once, like a real round
+trip, and is counted so benchmarks can report database load.
+"""
+from asyncio import sleep
+from collections import Counter
+from copy import deepcopy
+from datetime import datetime
+from typing import *
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+MISSING = object()
+
+
+def get_path(document: Dict[str, Any], path: str) -> Any:
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def set_path(document: Dict[str, Any], path: str, value: Any) -> None:
+    *parents, last = path.split(".")
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[last] = value
+
+
+def unset_path(document: Dict[str, Any], path: str) -> None:
+    *parents, last = path.split(".")
+    for part in parents:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(last, None)
+
+
+def compare(value: Any, condition: Any) -> bool:
+    """Check a single field value against a query condition."""
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        for op, operand in condition.items():
+            if op == "$exists":
+                if (value is not MISSING) != bool(operand):
+                    return False
+            elif op == "$in":
+                if not any(compare(value, item) for item in operand):
+                    return False
+            elif op == "$nin":
+                if any(compare(value, item) for item in operand):
+                    return False
+            elif op == "$ne":
+                if compare(value, operand):
+                    return False
+            elif op in ("$lt", "$lte", "$gt", "$gte"):
+                if value is MISSING or value is None:
+                    return False
+                if op == "$lt" and not value < operand:
+                    return False
+                if op == "$lte" and not value <= operand:
+                    return False
+                if op == "$gt" and not value > operand:
+                    return False
+                if op == "$gte" and not value >= operand:
+                    return False
+            else:
+                raise NotImplementedError(op)
+        return True
+
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+
+def matches(document: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(document, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, sub) for sub in condition):
+                return False
+        elif not compare(get_path(document, key), condition):
+            return False
+    return True
+
+
+def apply_update(document: Dict[str, Any], update: Dict[str, Any], inserted: bool) -> None:
+    for op, fields in update.items():
+        for path, value in fields.items():
+            current = get_path(document, path)
+            if op == "$set":
+                set_path(document, path, deepcopy(value))
+            elif op == "$setOnInsert":
+                if inserted:
+                    set_path(document, path, deepcopy(value))
+            elif op == "$unset":
+                unset_path(document, path)
+            elif op == "$inc":
+                set_path(document, path, (0 if current is MISSING else current) + value)
+            elif op == "$currentDate":
+                set_path(document, path, datetime.utcnow())
+            elif op == "$max":
+                if current is MISSING or value > current:
+                    set_path(document, path, value)
+            elif op == "$min":
+                if current is MISSING or value < current:
+                    set_path(document, path, value)
+            elif op in ("$push", "$addToSet"):
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                target = [] if current is MISSING else current
+                for item in deepcopy(items):
+                    if op == "$push" or item not in target:
+                        target.append(item)
+                if op == "$push" and isinstance(value, dict) and "$slice" in value:
+                    target = target[value["$slice"]:] if value["$slice"] < 0 else target[:value["$slice"]]
+                set_path(document, path, target)
+            elif op == "$pull":
+                if current is not MISSING:
+                    set_path(document, path, [item for item in current if not compare(item, value)])
+            else:
+                raise NotImplementedError(op)
+
+
+class Result:
+    def __init__(self, **kwargs) -> None:
+        self.__dict__.update(kwargs)
+
+
+class MemoryCursor:
+    def __init__(self, documents: List[Dict[str, Any]]) -> None:
+        self.documents = documents
+
+    def sort(self, key: Union[str, List[Tuple[str, int]]], direction: int = 1) -> "MemoryCursor":
+        keys = [(key, direction)] if isinstance(key, str) else key
+        for field, order in reversed(keys):
+            self.documents.sort(
+                key=lambda document: get_path(document, field), reverse=order < 0
+            )
+        return self
+
+    def limit(self, count: int) -> "MemoryCursor":
+        if count:
+            self.documents = self.documents[:count]
+        return self
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        await sleep(0)
+        return self.documents[:length] if length else self.documents
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        await sleep(0)
+        for document in self.documents:
+            yield document
+
+
+class MemoryCollection:
+    def __init__(self, stats: Counter) -> None:
+        self.documents: Dict[Any, Dict[str, Any]] = {}
+        self.stats = stats
+        self.next_id = 0
+
+    async def op(self, name: str) -> None:
+        self.stats[name] += 1
+        await sleep(0)
+
+    def select(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if "_id" in query and not isinstance(query["_id"], dict):
+            document = self.documents.get(query["_id"])
+            return [document] if document is not None and matches(document, query) else []
+        return [document for document in self.documents.values() if matches(document, query)]
+
+    async def create_index(self, *args, **kwargs) -> str:
+        await self.op("create_index")
+        return "index"
+
+    async def find_one(self, query: Optional[Dict[str, Any]] = None, *args, **kwargs):
+        await self.op("find_one")
+        found = self.select(query or {})
+        return deepcopy(found[0]) if found else None
+
+    def find(self, query: Optional[Dict[str, Any]] = None, *args, **kwargs) -> MemoryCursor:
+        self.stats["find"] += 1
+        return MemoryCursor([deepcopy(document) for document in self.select(query or {})])
+
+    async def count_documents(self, query: Dict[str, Any], *args, **kwargs) -> int:
+        await self.op("count_documents")
+        return len(self.select(query))
+
+    def insert(self, document: Dict[str, Any]) -> Any:
+        document = deepcopy(document)
+        if "_id" not in document:
+            self.next_id += 1
+            document["_id"] = self.next_id
+        self.documents[document["_id"]] = document
+        return document["_id"]
+
+    async def insert_one(self, document: Dict[str, Any], *args, **kwargs) -> Result:
+        await self.op("insert_one")
+        return Result(inserted_id=self.insert(document))
+
+    async def insert_many(self, documents: Iterable[Dict[str, Any]], *args, **kwargs) -> Result:
+        await self.op("insert_many")
+        inserted, errors = [], []
+        for index, document in enumerate(documents):
+            if document.get("_id") in self.documents:
+                errors.append({"index": index, "code": 11000})
+            else:
+                inserted.append(self.insert(document))
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+        return Result(inserted_ids=inserted)
+
+    def update(self, query: Dict[str, Any], update: Dict[str, Any], upsert: bool, many: bool) -> int:
+        found = self.select(query)
+        if not found:
+            if not upsert:
+                return 0
+            document = {key: deepcopy(value) for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict)}
+            if document.get("_id") in self.documents:
+                # The _id matched, but not the rest of the query
+                raise DuplicateKeyError("E11000 duplicate key error", 11000)
+            apply_update(document, update, inserted=True)
+            self.insert(document)
+            return 1
+        for document in found if many else found[:1]:
+            apply_update(document, update, inserted=False)
+        return len(found)
+
+    async def update_one(self, query, update, upsert: bool = False, *args, **kwargs) -> Result:
+        await self.op("update_one")
+        return Result(modified_count=self.update(query, update, upsert, many=False))
+
+    async def update_many(self, query, update, upsert: bool = False, *args, **kwargs) -> Result:
+        await self.op("update_many")
+        return Result(modified_count=self.update(query, update, upsert, many=True))
+
+    async def find_one_and_update(
+        self, query, update, upsert: bool = False, return_document: bool = False, *args, **kwargs
+    ) -> Optional[Dict[str, Any]]:
+        """Always returns the updated document, like ReturnDocument.AFTER."""
+        await self.op("find_one_and_update")
+        self.update(query, update, upsert, many=False)
+        found = self.select(query)
+        return deepcopy(found[0]) if found else None
+
+    async def replace_one(self, query, document, upsert: bool = False, *args, **kwargs) -> Result:
+        await self.op("replace_one")
+        found = self.select(query)
+        if found:
+            document = {**deepcopy(document), "_id": found[0]["_id"]}
+            self.documents[document["_id"]] = document
+        elif upsert:
+            self.insert({**query, **document})
+        return Result(modified_count=len(found[:1]))
+
+    async def delete_one(self, query, *args, **kwargs) -> Result:
+        await self.op("delete_one")
+        found = self.select(query)[:1]
+        for document in found:
+            del self.documents[document["_id"]]
+        return Result(deleted_count=len(found))
+
+    async def delete_many(self, query, *args, **kwargs) -> Result:
+        await self.op("delete_many")
+        found = self.select(query)
+        for document in found:
+            del self.documents[document["_id"]]
+        return Result(deleted_count=len(found))
+
+    async def bulk_write(self, requests, *args, **kwargs) -> Result:
+        """Apply pymongo UpdateOne, UpdateMany, ReplaceOne, InsertOne and DeleteOne requests."""
+        await self.op("bulk_write")
+        errors = []
+        for index, request in enumerate(requests):
+            try:
+                self.apply(request)
+            except DuplicateKeyError:
+                errors.append({"index": index, "code": 11000})
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+        return Result(acknowledged=True)
+
+    def apply(self, request: Any) -> None:
+        """Apply one request of a bulk write."""
+        kind = type(request).__name__
+        if kind == "InsertOne":
+            self.insert(request._doc)  # noqa
+        elif kind == "DeleteOne":
+            for document in self.select(request._filter)[:1]:  # noqa
+                del self.documents[document["_id"]]
+        elif kind == "DeleteMany":
+            for document in self.select(request._filter):  # noqa
+                del self.documents[document["_id"]]
+        elif kind == "ReplaceOne":
+            found = self.select(request._filter)[:1]  # noqa
+            if found or request._upsert:  # noqa
+                for document in found:
+                    del self.documents[document["_id"]]
+                self.insert(request._doc)  # noqa
+        elif kind in ("UpdateOne", "UpdateMany"):
+            self.update(
+                request._filter, request._doc, bool(request._upsert), kind == "UpdateMany"  # noqa
+            )
+        else:
+            raise NotImplementedError(kind)
+
+
+class MemoryDatabase:
+    """Collections are created on first access, like with motor."""
+
+    def __init__(self) -> None:
+        self.stats: Counter = Counter()
+        self.collections: Dict[str, MemoryCollection] = {}
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self.stats)
+        return self.collections[name]
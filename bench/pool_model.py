@@ -0,0 +1,119 @@
+"""
+Pool configuration model benchmark.
+
+Compares the memory use and hot path lookup times of the typed pool model
+with the nested dicts it replaced, for a large number of channels::
+
+    python -m bench.pool_model
+    python -m bench.pool_model --pools 100 --servers 50 --channels 4
+"""
+import tracemalloc
+from argparse import ArgumentParser
+from random import Random
+from timeit import timeit
+from typing import *
+
+from bson import BSON
+from tabulate import tabulate
+
+from src.common.models import Pool
+
+
+def documents(pools: int, servers: int, channels: int) -> Dict[str, Dict[str, Any]]:
+    """Build pool documents in the stored format, with Discord-sized IDs."""
+    rng = Random(0)
+    snowflake = lambda: rng.randrange(10 ** 17, 2 ** 63)  # noqa
+    return {
+        f"pool-{p}": {
+            "password": None,
+            "moderation": None,
+            "coalesce": None,
+            "servers": {
+                str(snowflake()): {
+                    "channels": [snowflake() for _ in range(channels)],
+                    "message_count": rng.randrange(10000),
+                }
+                for _ in range(servers)
+            },
+        }
+        for p in range(pools)
+    }
+
+
+def measure(build: Callable[[], Any]) -> Tuple[Any, int]:
+    """Build a structure and return it with the bytes it allocated."""
+    tracemalloc.start()
+    value = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, size
+
+
+def main() -> None:
+    parser = ArgumentParser(prog="python -m bench.pool_model", description=__doc__.splitlines()[1])
+    parser.add_argument("--pools", type=int, default=50, help="number of pools")
+    parser.add_argument("--servers", type=int, default=100, help="servers per pool")
+    parser.add_argument("--channels", type=int, default=3, help="channels per server")
+    parser.add_argument("--lookups", type=int, default=100000, help="lookups timed per operation")
+    args = parser.parse_args()
+
+    source = documents(args.pools, args.servers, args.channels)
+    total = args.pools * args.servers * args.channels
+
+    # Both are built from decoded BSON, like the documents the store reads from MongoDB
+    encoded = {name: BSON.encode(document) for name, document in source.items()}
+    legacy, legacy_bytes = measure(
+        lambda: {name: document.decode() for name, document in encoded.items()}
+    )
+    typed, typed_bytes = measure(
+        lambda: {name: Pool.from_document(name, document.decode()) for name, document in encoded.items()}
+    )
+
+    # Look up the last channel of a server, the worst case of a list scan
+    pool_name = "pool-0"
+    guild_key = next(iter(source[pool_name]["servers"]))
+    guild_id = int(guild_key)
+    channel_id = source[pool_name]["servers"][guild_key]["channels"][-1]
+    legacy_pool, typed_pool = legacy[pool_name], typed[pool_name]
+
+    def legacy_increment() -> None:
+        legacy[pool_name]["servers"][str(guild_id)]["message_count"] += 1
+
+    def typed_increment() -> None:
+        typed[pool_name].servers[guild_id].message_count += 1
+
+    def legacy_membership() -> bool:
+        return channel_id in legacy_pool["servers"].get(str(guild_id), {}).get("channels", [])
+
+    def typed_membership() -> bool:
+        return typed_pool.has_channel(guild_id, channel_id)
+
+    def legacy_settings() -> bool:
+        return legacy_pool.get("moderation") is not None and legacy_pool.get("coalesce") is not None
+
+    def typed_settings() -> bool:
+        return typed_pool.moderation is not None and typed_pool.coalesce is not None
+
+    rows = [
+        ["memory (MiB)", legacy_bytes / 2 ** 20, typed_bytes / 2 ** 20],
+        ["bytes per channel", legacy_bytes / total, typed_bytes / total],
+    ]
+    for name, old, new in (
+        ("message count increment (ns)", legacy_increment, typed_increment),
+        ("channel membership check (ns)", legacy_membership, typed_membership),
+        ("pool settings read (ns)", legacy_settings, typed_settings),
+    ):
+        rows.append(
+            [
+                name,
+                timeit(old, number=args.lookups) / args.lookups * 1e9,
+                timeit(new, number=args.lookups) / args.lookups * 1e9,
+            ]
+        )
+
+    print(f"{args.pools} pools, {args.pools * args.servers} servers, {total} channels")
+    print(tabulate(rows, headers=["", "nested dicts", "typed model"], floatfmt=".1f"))
+
+
+if __name__ == "__main__":
+    main()
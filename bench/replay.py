@@ -0,0 +1,340 @@
+"""
+Replays captured relay traffic offline.
+
+Feeds a capture recorded with ``--capture`` (see bot.py and launcher.py) back
+through the real Relay cog and RelayBot against a fake Discord and an
+in-memory database, at the captured pace, N times faster or as fast as the
+relay keeps up, and reports throughput, latency percentiles and REST calls::
+
+    python -m bench.replay traffic.jsonl.gz
+    python -m bench.replay traffic.*.jsonl.gz --speed 4
+    python -m bench.replay traffic.jsonl.gz --speed 0 --max-gap 1
+"""
+import gzip
+from argparse import ArgumentParser
+from asyncio import Task, create_task, gather, run, sleep
+from collections import Counter
+from contextlib import redirect_stdout
+from heapq import merge
+from time import perf_counter
+from typing import *
+
+import orjson
+from tabulate import tabulate
+
+from bench.fakes import (
+    FakeAttachment,
+    FakeChannel,
+    FakeDiscord,
+    FakeGuild,
+    FakeMessage,
+    FakeReactionClearPayload,
+    FakeReactionPayload,
+    FakeUser,
+)
+from bench.harness import Harness, percentile
+from src.common.ingest import BLOCK
+from src.common.models import Pool
+
+# Stands in for the text of replayed messages, which isn't captured
+FILLER: str = "lorem ipsum dolor sit amet consectetur adipiscing elit "
+
+# Seconds a reaction waits at most for its message to be relayed by the replay
+REACTION_WAIT: float = 30.0
+
+
+def read_capture(path: str) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    """
+    Read the events of a capture file.
+
+    A file holds one segment per run of the bot, each starting with a header.
+    A file cut off by a killed process is read up to its last complete event.
+
+    :param path: The capture file.
+    :return: The events with their wall clock time, in the order they were written.
+    """
+    started = 0.0
+    with gzip.open(path, "rb") as file:
+        try:
+            for line in file:
+                record = orjson.loads(line)
+                if record["e"] == "header":
+                    started = record["started"]
+                    continue
+                yield started + record["t"], record
+        except (EOFError, orjson.JSONDecodeError):
+            return
+
+
+class Replay:
+    """
+    Turns captured events back into fake gateway events and feeds them to the cog's listeners.
+
+    Guilds, channels and users are created as the events refer to them. The
+    replayed source messages are kept by their captured ID, reactions on
+    relayed copies are replayed on the copy the replay relayed to the same channel.
+    A reaction on a message the replay is still relaying waits for it, without
+    holding up the events after it.
+    """
+
+    def __init__(self, discord: FakeDiscord, harness: Harness) -> None:
+        self.discord = discord
+        self.harness = harness
+        self.guilds: Dict[int, FakeGuild] = {}
+        self.channels: Dict[int, FakeChannel] = {}
+        self.users: Dict[int, FakeUser] = {}
+        self.messages: Dict[int, FakeMessage] = {}
+        # Every event fed to a listener, with when it was fed
+        self.sent: List[Tuple[str, Any, float]] = []
+        self.events: Counter = Counter()
+        self.skipped: Counter = Counter()
+        self.waiting: List[Task] = []
+
+    def channel(self, guild_id: int, channel_id: int) -> FakeChannel:
+        if channel_id not in self.channels:
+            if guild_id not in self.guilds:
+                self.guilds[guild_id] = self.discord.add_guild(f"Guild {len(self.guilds)}")
+            self.channels[channel_id] = self.discord.add_channel(self.guilds[guild_id], "relay")
+        return self.channels[channel_id]
+
+    def user(self, user_id: int) -> FakeUser:
+        if user_id not in self.users:
+            self.users[user_id] = self.discord.add_user(f"User {len(self.users)}")
+        return self.users[user_id]
+
+    async def pools(self, record: Dict[str, Any]) -> None:
+        """Load the captured pools, or replace the loaded ones when they changed during the capture."""
+        channels: Dict[str, List[FakeChannel]] = {}
+        settings: Dict[str, Dict[str, Any]] = {}
+        for name, pool in record["pools"].items():
+            channels[name] = [
+                self.channel(int(guild_id), channel_id)
+                for guild_id, channel_ids in pool["servers"].items()
+                for channel_id in channel_ids
+            ]
+            settings[name] = {
+                "moderation": pool["moderation"],
+                "coalesce": pool["coalesce"],
+                "budget": pool.get("budget"),
+            }
+
+        cog = self.harness.cog
+        if cog is None:
+            await self.harness.start(channels, pool_settings=settings)
+            return
+
+        cog.pools = {name: Pool.from_document(name, settings[name]) for name in channels}
+        for name, pool_channels in channels.items():
+            for channel in pool_channels:
+                cog.pools[name].add_channel(channel.guild.id, channel.id)
+        cog.routes.rebuild(cog.pools)
+
+    async def feed(self, record: Dict[str, Any]) -> None:
+        """Feed one captured event to the cog."""
+        event = record["e"]
+        if event == "pools":
+            await self.pools(record)
+            return
+        if self.harness.cog is None:
+            # Nothing can be relayed before the pools are known
+            self.skipped[event] += 1
+            return
+
+        cog = self.harness.cog
+        channel = self.channels.get(record["channel"])
+        if channel is None:
+            self.skipped[event] += 1
+            return
+
+        if event == "message":
+            message = FakeMessage(
+                self.discord,
+                channel,
+                self.user(record["author"]),
+                (FILLER * (record["length"] // len(FILLER) + 1))[: record["length"]],
+                [FakeAttachment(self.discord, f"file{i}", size) for i, size in enumerate(record["attachments"])],
+            )
+            self.messages[record["id"]] = message
+            await self.send(event, cog.on_message, message)
+            return
+
+        source = self.messages.get(record["source"])
+        if source is None:
+            # Relayed before the capture started
+            self.skipped[event] += 1
+            return
+        if id(source) not in self.harness.processed:
+            self.waiting.append(create_task(self.feed_reaction(record, channel, source, wait=True)))
+            return
+        await self.feed_reaction(record, channel, source)
+
+    async def feed_reaction(
+        self, record: Dict[str, Any], channel: FakeChannel, source: FakeMessage, wait: bool = False
+    ) -> None:
+        """Feed a captured reaction event, on the replayed source message or one of its copies."""
+        if wait:
+            deadline = perf_counter() + REACTION_WAIT
+            while id(source) not in self.harness.processed:
+                if perf_counter() > deadline:
+                    self.skipped[record["e"]] += 1
+                    return
+                await sleep(0.01)
+
+        event = record["e"]
+        cog = self.harness.cog
+        message_id = source.id
+        if record["message"] != record["source"]:
+            relayed = await cog.messages.get(source.id)
+            message_id = next(
+                (copy_id for channel_id, copy_id in (relayed.messages() if relayed else ()) if channel_id == channel.id),
+                None,
+            )
+            if message_id is None:
+                self.skipped[event] += 1
+                return
+
+        if event == "reaction_clear":
+            payload = FakeReactionClearPayload(channel.id, message_id, channel.guild.id, record["emoji"])
+            listener = cog.on_raw_reaction_clear if record["emoji"] is None else cog.on_raw_reaction_clear_emoji
+        else:
+            payload = FakeReactionPayload(
+                self.user(record["user"]).id, channel.id, message_id, record["emoji"], channel.guild.id
+            )
+            listener = cog.on_raw_reaction_add if event == "reaction_add" else cog.on_raw_reaction_remove
+        await self.send(event, listener, payload)
+
+    async def send(self, event: str, listener: Callable[[Any], Awaitable[Any]], payload: Any) -> None:
+        self.events[event] += 1
+        self.sent.append((event, payload, perf_counter()))
+        await listener(payload)
+
+    def latencies(self, *events: str) -> List[float]:
+        """Seconds from feeding each event of the given kinds until the cog finished processing it."""
+        processed = self.harness.processed
+        return [
+            processed[id(payload)] - sent_at
+            for event, payload, sent_at in self.sent
+            if event in events and id(payload) in processed
+        ]
+
+
+async def replay(
+    paths: List[str],
+    speed: float,
+    max_gap: Optional[float],
+    limit: Optional[int],
+    latency: float,
+    rate_limit_chance: float,
+) -> Dict[str, Any]:
+    """
+    Replay capture files, merged by time.
+
+    :param paths: The capture files, one per process of the captured bot.
+    :param speed: How many times faster than captured to replay, 0 for as fast as the relay keeps up.
+    :param max_gap: Seconds idle periods of the capture are shortened to, None to keep them.
+    :param limit: Events replayed at most, None for all of them.
+    :param latency: Simulated REST latency, in seconds.
+    :param rate_limit_chance: Chance of a 429 per request.
+    :return: The results of the replay.
+    """
+    discord = FakeDiscord(latency=latency, rate_limit_chance=rate_limit_chance)
+    harness = Harness(discord)
+    feeder = Replay(discord, harness)
+    # How late every event was fed compared to the replay schedule
+    lateness: List[float] = []
+    first = previous = None
+    skipped_time = 0.0
+
+    with redirect_stdout(harness.output):
+        start = perf_counter()
+        events = merge(*(read_capture(path) for path in paths), key=lambda event: event[0])
+        for count, (at, record) in enumerate(events):
+            if limit is not None and count >= limit:
+                break
+            if first is None:
+                first = previous = at
+            if max_gap is not None and at - previous > max_gap:
+                skipped_time += at - previous - max_gap
+            previous = max(previous, at)
+
+            if speed:
+                delay = start + (at - first - skipped_time) / speed - perf_counter()
+                if delay > 0:
+                    await sleep(delay)
+                else:
+                    lateness.append(-delay)
+
+            was_started = harness.cog is not None
+            await feeder.feed(record)
+            if not was_started and harness.cog is not None:
+                # The schedule starts once the bot is ready
+                start, first, skipped_time = perf_counter(), at, 0.0
+                if not speed:
+                    # Listeners wait for room in the queues instead of dropping events
+                    harness.cog.ingest.policy = BLOCK
+
+        if harness.cog is None:
+            raise SystemExit("No pools in the capture, nothing was replayed")
+        await gather(*feeder.waiting)
+        await harness.settle()
+        elapsed = perf_counter() - start
+        await harness.stop()
+
+    messages = feeder.events["message"]
+    message_latencies = feeder.latencies("message")
+    reaction_latencies = feeder.latencies("reaction_add", "reaction_remove", "reaction_clear")
+    return {
+        "summary": [
+            ["captured seconds", (previous or 0.0) - (first or 0.0)],
+            ["replayed seconds", elapsed],
+            ["messages", messages],
+            ["reaction events", sum(n for event, n in feeder.events.items() if event.startswith("reaction"))],
+            ["skipped events", sum(feeder.skipped.values())],
+            ["msgs/s", messages / elapsed if elapsed else 0.0],
+            ["message p50 ms", percentile(message_latencies, 50) * 1000],
+            ["message p95 ms", percentile(message_latencies, 95) * 1000],
+            ["message p99 ms", percentile(message_latencies, 99) * 1000],
+            ["message max ms", max(message_latencies, default=0.0) * 1000],
+            ["reaction p99 ms", percentile(reaction_latencies, 99) * 1000],
+            ["REST calls", discord.rest_calls()],
+            ["REST/msg", discord.rest_calls() / messages if messages else 0.0],
+            ["CDN downloads", discord.calls["cdn_download"]],
+            ["429s", discord.calls["429"]],
+            ["ingest dropped", harness.cog.ingest.stats["dropped"]],
+            ["feed lag p99 ms", percentile(lateness, 99) * 1000],
+            ["loop lag p99 ms", harness.bot.metrics.histograms["relay_loop_lag_seconds"][()].quantile(0.99) * 1000],
+            ["errors", harness.errors()],
+        ],
+        "routes": sorted(
+            ([route, n] for route, n in discord.calls.items() if route not in ("cdn_download", "429")),
+            key=lambda row: -row[1],
+        ),
+    }
+
+
+def main() -> None:
+    parser = ArgumentParser(prog="python -m bench.replay", description=__doc__.splitlines()[1])
+    parser.add_argument("captures", nargs="+", help="capture files, one per process")
+    parser.add_argument("--speed", type=float, default=1.0, help="times faster than captured, 0 for max speed")
+    parser.add_argument("--max-gap", type=float, help="shorten idle periods to this many seconds")
+    parser.add_argument("--limit", type=int, help="replay at most this many events")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated REST latency in seconds")
+    parser.add_argument("--rate-limit-chance", type=float, default=0.0, help="chance of a 429 per request")
+    args = parser.parse_args()
+
+    results = run(
+        replay(args.captures, args.speed, args.max_gap, args.limit, args.latency, args.rate_limit_chance)
+    )
+    print(
+        tabulate(
+            [[name, f"{value:.1f}" if isinstance(value, float) else value] for name, value in results["summary"]],
+            colalign=("left", "right"),
+            disable_numparse=True,
+        )
+    )
+    print()
+    print(tabulate(results["routes"], headers=["route", "REST calls"]))
+
+
+if __name__ == "__main__":
+    main()
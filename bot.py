@@ -1,7 +1,13 @@
+from argparse import ArgumentParser
+from asyncio import Task, create_task, gather
 from datetime import timedelta, datetime
+from hashlib import sha256
+from json import dumps
 from os import listdir
 from os.path import splitext
+from time import perf_counter
 
+from aiohttp import ClientSession, TCPConnector, TraceConfig
 from cooldowns import CallableOnCooldown
 from nextcord import (
     Intents,
@@ -9,6 +15,8 @@ from nextcord import (
     InteractionResponded,
     ApplicationInvokeError,
     Webhook,
+    NotFound,
+    Forbidden,
 )
 from nextcord.ext.commands import (
     CheckFailure,
@@ -18,11 +26,34 @@ from nextcord.ext.commands import (
     CommandOnCooldown,
 )
 
+from src.common.capture import TrafficCapture, load_capture_key
 from src.common.common import *
+from src.common.connections import add_trace, create_connector, create_response_trace, create_session
+from src.common.loop_monitor import LoopMonitor
+from src.common.metrics import METRICS_PORT, Metrics, peak_memory
+from src.common.scheduler import SendScheduler
+from src.common.webhooks import WebhookCache
 
 
 class RelayBot(AutoShardedBot):
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        shard_ids: Optional[List[int]] = None,
+        shard_count: Optional[int] = None,
+        cluster_id: int = 0,
+        fast_startup: bool = False,
+        capture: Optional[str] = None,
+        capture_key: Optional[bytes] = None,
+    ) -> None:
+        """
+        :param shard_ids: The shards this process connects, None for all of them.
+        :param shard_count: The total number of shards across every process.
+        :param cluster_id: The index of this process when running several, see launcher.py.
+        :param fast_startup: Don't download every member at startup and fill the caches
+            while the gateway connects instead of once the bot is ready.
+        :param capture: A file to record the relayed traffic to, for ``python -m bench.replay``.
+        :param capture_key: The anonymization key of the capture, shared by every process.
+        """
         # Make sure the bot can't be abused to mass ping
         allowed_mentions = AllowedMentions(roles=True, everyone=True, users=True)
 
@@ -40,7 +71,9 @@ class RelayBot(AutoShardedBot):
 
         super().__init__(
             description="GalverseRelay",
-            chunk_guilds_at_startup=True,
+            # Relaying only needs channels, webhooks and message authors, members are
+            # still cached as they show up in events
+            chunk_guilds_at_startup=not fast_startup,
             heartbeat_timeout=150.0,
             allowed_mentions=allowed_mentions,
             intents=intents,
@@ -48,28 +81,214 @@ class RelayBot(AutoShardedBot):
                 770715610464124969,  # Devin
             ],
             case_insensitive=True,
+            shard_ids=shard_ids,
+            shard_count=shard_count,
+        )
+
+        self.cluster_id: int = cluster_id
+        self.fast_startup: bool = fast_startup
+        # Set once the commands were synced or associated, reconnects don't repeat it
+        self.commands_synced: bool = False
+
+        self.webhook_cache: WebhookCache = WebhookCache(self, "RelayBot")
+        self.scheduler: SendScheduler = SendScheduler()
+        # Feeds the rate-limit headers of every Discord response to the scheduler's buckets
+        self.response_trace: TraceConfig = create_response_trace(self.scheduler.on_request_end)
+        self.metrics: Metrics = Metrics()
+        self.metrics.collect(
+            "relay_queue_depth",
+            "gauge",
+            lambda: {(("pool", pool),): depth for pool, depth in self.scheduler.depths().items()},
+        )
+        self.metrics.collect(
+            "relay_requests_total",
+            "counter",
+            lambda: {(("event", event),): n for event, n in self.scheduler.stats.items()},
+        )
+        self.metrics.collect(
+            "relay_requests_in_flight", "gauge", lambda: {(): self.scheduler.in_flight}
+        )
+        self.metrics.collect(
+            "relay_webhooks_cached", "gauge", lambda: {(): len(self.webhook_cache)}
+        )
+        # One connection pool for Discord REST, CDN downloads and any other outbound call,
+        # created by start() in the running loop
+        self.connector: Optional[TCPConnector] = None
+        self.session: Optional[ClientSession] = None
+
+        self.loop_monitor: LoopMonitor = LoopMonitor(
+            lambda lag: self.metrics.observe("relay_loop_lag_seconds", lag)
+        )
+        self.metrics.collect(
+            "relay_loop_blocked_total", "counter", lambda: {(): self.loop_monitor.stats["blocked"]}
+        )
+        self.metrics.describe(
+            "relay_loop_lag_seconds", "How late the event loop runs scheduled callbacks."
+        )
+        self.metrics.describe("relay_stage_seconds", "Time spent in each relay pipeline stage.")
+        self.metrics.describe("relay_queue_depth", "Requests waiting in the send scheduler per pool.")
+        self.metrics.describe(
+            "relay_requests_total", "Send scheduler events, rate_limited counts 429 responses."
         )
 
-    @staticmethod
-    async def find_or_create_webhook(channel, webhook_name) -> Webhook:
+        # Coroutines filling caches at startup, run concurrently by ensure_started()
+        self.startup_hooks: List[Callable[[], Awaitable[Any]]] = [self.webhook_cache.load]
+        self.startup_task: Optional[Task] = None
+        # Seconds from start() to each startup phase, see report_startup()
+        self.startup_times: Dict[str, float] = {}
+        self.launched_at: float = perf_counter()
+        self.metrics.collect(
+            "relay_startup_seconds",
+            "gauge",
+            lambda: {(("phase", phase),): t for phase, t in self.startup_times.items()},
+        )
+        self.metrics.collect("relay_peak_memory_bytes", "gauge", lambda: {(): peak_memory()})
+
+        # Coroutines to run before the bot disconnects, e.g. to flush buffered writes.
+        # They run last to first, so hooks added by cogs run before the bot's own.
+        self.shutdown_hooks: List[Callable[[], Awaitable[Any]]] = [
+            self.close_session,
+            self.loop_monitor.close,
+            self.scheduler.close,
+            self.metrics.close,
+        ]
+
+        # Anonymized recording of the events the relay acts on, None unless capturing
+        self.capture: Optional[TrafficCapture] = None
+        if capture is not None:
+            self.capture = TrafficCapture(capture, capture_key)
+            # Closed last, after the cogs relayed and recorded the queued events
+            self.shutdown_hooks.insert(0, self.capture.close)
+            self.metrics.collect(
+                "relay_capture_events_total",
+                "counter",
+                lambda: {(("event", event),): n for event, n in self.capture.stats.items()},
+            )
+
+    async def find_or_create_webhook(self, channel_id: int) -> Optional[Webhook]:
         """
-        Finds an existing webhook with the given name or creates a new one.
+        Finds the relay webhook of a channel or creates a new one.
 
-        :param channel: The channel to search for the webhook in.
-        :param webhook_name: The name of the webhook to find or create.
-        :return: The found or created webhook.
+        Webhooks are served from the webhook cache, so only the first message
+        relayed to a channel needs to list or create its webhooks. Channels of
+        servers on another process' shards aren't in this process' cache, their
+        webhook is read from the database or the channel is fetched over REST.
+
+        :param channel_id: The ID of the channel to search for the webhook in.
+        :return: The found or created webhook, or None if the channel isn't available.
         """
-        # Fetch the list of webhooks in the channel
-        webhooks = await channel.webhooks()
+        webhook = self.webhook_cache.cached(channel_id)
+        self.metrics.inc(
+            "relay_webhook_lookups_total", result="miss" if webhook is None else "hit"
+        )
+        if webhook is not None:
+            return webhook
 
-        # Check if a webhook with the given name exists
-        webhook = next((wh for wh in webhooks if wh.name == webhook_name), None)
+        with self.metrics.time("relay_stage_seconds", stage="webhook_lookup"):
+            channel = self.get_channel(channel_id)
+            if channel is None:
+                webhook = await self.webhook_cache.lookup(channel_id)
+                if webhook is not None:
+                    return webhook
+                try:
+                    channel = await self.fetch_channel(channel_id)
+                except (NotFound, Forbidden):
+                    return None
+            return await self.webhook_cache.get(channel)
 
-        # If the webhook doesn't exist, create a new one
-        if webhook is None:
-            webhook = await channel.create_webhook(name=webhook_name)
+    async def start(self, token: str, *, reconnect: bool = True) -> None:
+        self.launched_at = perf_counter()
+        self.loop_monitor.start()
+        self.open_session()
+        if self.capture is not None:
+            self.capture.start()
+        if self.fast_startup:
+            self.ensure_started()
+        await super().start(token, reconnect=reconnect)
 
-        return webhook
+    def open_session(self) -> None:
+        """
+        Create the shared connection pool and the session for outbound calls.
+
+        nextcord's own session, used for REST, webhooks and attachment downloads,
+        is created at login over the same connector, and closes it with the bot.
+        """
+        if self.connector is None:
+            self.connector = create_connector()
+            self.http.connector = self.connector
+            self.session = create_session(self.connector)
+
+    async def close_session(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    def ensure_started(self) -> Task:
+        """
+        Run the startup hooks, once.
+
+        :return: The task running the hooks, await it to wait until the caches are filled.
+        """
+        if self.startup_task is None:
+            self.startup_task = create_task(self.run_startup_hooks())
+        return self.startup_task
+
+    async def run_startup_hooks(self) -> None:
+        results = await gather(*(hook() for hook in self.startup_hooks), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Error in startup hook: {result}")
+        self.startup_times["caches"] = perf_counter() - self.launched_at
+
+    async def on_connect(self) -> None:
+        """
+        Add the application commands locally, without nextcord's default sync on every connect.
+
+        Syncing with Discord is left to :meth:`sync_commands_if_changed`, other
+        processes find the IDs of the commands as they're first used. The
+        response trace is added to nextcord's session here, as it's recreated
+        before reconnects.
+        """
+        add_trace(self.http._HTTPClient__session, self.response_trace)  # noqa
+        self.add_all_application_commands()
+
+    async def sync_commands_if_changed(self) -> None:
+        """
+        Sync the application commands, unless they haven't changed since the last sync, once per process.
+
+        A hash of the global command payloads is stored in the database, so restarts
+        don't have to compare every command with Discord again. When nothing changed
+        the commands registered on Discord are only fetched to learn their IDs.
+        """
+        if self.commands_synced:
+            return
+
+        payloads = sorted(
+            dumps(command.get_payload(None), sort_keys=True, default=str)
+            for command in self.get_all_application_commands()
+            if command.is_global
+        )
+        digest = sha256("\n".join(payloads).encode()).hexdigest()
+
+        stored = await db.command_sync.find_one({"_id": "global"})
+        if stored is not None and stored["hash"] == digest:
+            await self.discover_application_commands(
+                guild_id=None, associate_known=True, delete_unknown=False, update_known=False
+            )
+        else:
+            await self.sync_all_application_commands()
+            await db.command_sync.update_one(
+                {"_id": "global"}, {"$set": {"hash": digest}}, upsert=True
+            )
+        self.commands_synced = True
+
+    def report_startup(self) -> None:
+        """Print how long the bot took to become ready and its peak memory."""
+        self.startup_times["ready"] = perf_counter() - self.launched_at
+        print(
+            f"Ready in {self.startup_times['ready']:.1f}s, "
+            f"caches filled after {self.startup_times.get('caches', 0.0):.1f}s, "
+            f"peak memory {peak_memory() / 2 ** 20:.0f} MiB"
+        )
 
     def get_interaction(self, data, *, cls=CustomInteraction) -> CustomInteraction:
         i = super().get_interaction(data, cls=cls)
@@ -149,13 +368,60 @@ class RelayBot(AutoShardedBot):
         except Exception:
             raise err
 
+    async def close(self) -> None:
+        """Run the shutdown hooks, then close the connection to Discord."""
+        for hook in reversed(self.shutdown_hooks):
+            try:
+                await hook()
+            except Exception as e:
+                print(f"Error in shutdown hook: {e}")
+
+        await super().close()
+
     async def on_ready(self) -> None:  # noqa
-        await self.sync_all_application_commands()
-        print("Ready")
+        await self.ensure_started()
+        try:
+            # One endpoint per process when several shard clusters run on the same host
+            await self.metrics.serve(port=METRICS_PORT + self.cluster_id)
+        except OSError as e:
+            print(f"Error serving metrics: {e}")
+        # Commands are global, syncing them once is enough
+        if self.cluster_id == 0:
+            await self.sync_commands_if_changed()
+        print(f"Ready (cluster {self.cluster_id}, shards {self.shard_ids or 'all'})")
+        if "ready" not in self.startup_times:
+            self.report_startup()
 
 
-if __name__ == "__main__":
-    bot = RelayBot()
+def main(
+    shard_ids: Optional[List[int]] = None,
+    shard_count: Optional[int] = None,
+    cluster_id: int = 0,
+    fast_startup: bool = False,
+    capture: Optional[str] = None,
+    capture_key: Optional[bytes] = None,
+) -> None:
+    """
+    Load the cogs and run the bot until it's stopped.
+
+    :param shard_ids: The shards to connect, None for all of them.
+    :param shard_count: The total number of shards across every process.
+    :param cluster_id: The index of this process when running several.
+    :param fast_startup: Skip chunking at startup and fill the caches while connecting.
+    :param capture: A file to record the relayed traffic to, None to not record it.
+    :param capture_key: The anonymization key of the capture, by default the one stored next to it.
+    """
+    if capture is not None and capture_key is None:
+        capture_key = load_capture_key(capture)
+
+    bot = RelayBot(
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        cluster_id=cluster_id,
+        fast_startup=fast_startup,
+        capture=capture,
+        capture_key=capture_key,
+    )
 
     # Remove the default help command so a better one can be added
     bot.remove_command("help")
@@ -170,3 +436,19 @@ if __name__ == "__main__":
     # Code written after this block may not run
     with open("./data/token.txt", "r") as token:
         bot.run(token.readline())
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="python bot.py")
+    parser.add_argument(
+        "--fast-startup",
+        action="store_true",
+        help="chunk guilds on demand and fill the caches while connecting",
+    )
+    parser.add_argument(
+        "--capture",
+        metavar="PATH",
+        help="record anonymized relay traffic to a gzipped file, see python -m bench.replay",
+    )
+    args = parser.parse_args()
+    main(fast_startup=args.fast_startup, capture=args.capture)
@@ -0,0 +1,124 @@
+"""
+Runs the bot as several processes, each connecting its own cluster of shards.
+
+Every process relays the messages of the servers on its shards. Pools are
+shared through the database and kept in sync with change notifications, and
+messages for servers on another process' shards are sent through their
+webhooks, so relaying works across processes::
+
+    python launcher.py --clusters 4
+    python launcher.py --clusters 2 --shards 8
+    python launcher.py --clusters 4 --capture traffic.jsonl.gz
+"""
+from argparse import ArgumentParser
+from asyncio import run
+from multiprocessing import get_context
+from multiprocessing.process import BaseProcess
+from os import cpu_count
+from time import sleep
+from typing import *
+
+from aiohttp import ClientSession
+
+import bot
+from src.common.capture import capture_path, load_capture_key
+from src.common.connections import create_connector
+
+# Seconds to wait before restarting a cluster that exited with an error
+RESTART_DELAY: float = 5.0
+
+
+async def recommended_shards(token: str) -> int:
+    """Ask Discord how many shards the bot should run."""
+    async with ClientSession(connector=create_connector()) as session:
+        async with session.get(
+            "https://discord.com/api/v10/gateway/bot",
+            headers={"Authorization": f"Bot {token}"},
+        ) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+
+def shard_clusters(shard_count: int, clusters: int) -> List[List[int]]:
+    """
+    Split the shards into contiguous, evenly sized clusters.
+
+    :param shard_count: The total number of shards.
+    :param clusters: The number of processes to split them over.
+    :return: The shard IDs of every cluster, empty clusters are left out.
+    """
+    size, extra = divmod(shard_count, clusters)
+    result, start = [], 0
+    for cluster_id in range(clusters):
+        end = start + size + (cluster_id < extra)
+        if end > start:
+            result.append(list(range(start, end)))
+        start = end
+    return result
+
+
+def main() -> None:
+    parser = ArgumentParser(prog="python launcher.py", description=__doc__.splitlines()[1])
+    parser.add_argument("--clusters", type=int, default=cpu_count() or 1, help="number of processes")
+    parser.add_argument("--shards", type=int, help="total number of shards, defaults to Discord's recommendation")
+    parser.add_argument(
+        "--fast-startup",
+        action="store_true",
+        help="chunk guilds on demand and fill the caches while connecting",
+    )
+    parser.add_argument(
+        "--capture",
+        metavar="PATH",
+        help="record anonymized relay traffic, one gzipped file per process, see python -m bench.replay",
+    )
+    args = parser.parse_args()
+
+    with open("./data/token.txt", "r") as token:
+        shard_count = args.shards or run(recommended_shards(token.readline().strip()))
+
+    clusters = shard_clusters(shard_count, args.clusters)
+    print(f"Running {shard_count} shards in {len(clusters)} processes")
+
+    # Spawn rather than fork, so every process gets its own event loop and Mongo client
+    context = get_context("spawn")
+    # One key for every process and run, so the anonymized IDs of their captures match
+    capture_key = load_capture_key(args.capture) if args.capture else None
+
+    def start(cluster_id: int) -> BaseProcess:
+        process = context.Process(
+            target=bot.main,
+            args=(
+                clusters[cluster_id],
+                shard_count,
+                cluster_id,
+                args.fast_startup,
+                capture_path(args.capture, cluster_id) if args.capture else None,
+                capture_key,
+            ),
+            name=f"cluster-{cluster_id}",
+        )
+        process.start()
+        return process
+
+    processes = {cluster_id: start(cluster_id) for cluster_id in range(len(clusters))}
+    try:
+        while processes:
+            sleep(1.0)
+            for cluster_id, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                if process.exitcode == 0:
+                    del processes[cluster_id]
+                    continue
+                print(f"Cluster {cluster_id} exited with code {process.exitcode}, restarting")
+                sleep(RESTART_DELAY)
+                processes[cluster_id] = start(cluster_id)
+    except KeyboardInterrupt:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
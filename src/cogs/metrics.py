@@ -0,0 +1,58 @@
+from nextcord import slash_command
+from nextcord.ext import commands
+from tabulate import tabulate
+
+from bot import RelayBot
+from src.common.common import *
+
+
+class RelayMetrics(commands.Cog):
+    def __init__(self, bot: RelayBot):
+        self.bot: RelayBot = bot
+
+    @slash_command(
+        name="relay_metrics", description="Show relay pipeline latency and load."
+    )
+    async def relay_metrics(self, inter: CustomInteraction) -> None:
+        if inter.user.id in self.bot.owner_ids:
+            metrics = self.bot.metrics
+
+            stages = [
+                [
+                    dict(labels).get("stage"),
+                    histogram.count,
+                    f"{histogram.quantile(0.5) * 1000:g}",
+                    f"{histogram.quantile(0.99) * 1000:g}",
+                ]
+                for labels, histogram in metrics.histograms.get("relay_stage_seconds", {}).items()
+            ]
+
+            pools: Dict[str, float] = {}
+            for labels, value in metrics.counters.get("relay_messages_total", {}).items():
+                pools[dict(labels)["pool"]] = value
+            depths = self.bot.scheduler.depths()
+            busiest = sorted(pools, key=pools.get, reverse=True)[:10]
+
+            stats = self.bot.scheduler.stats
+            # Webhook executes the Relay cog avoided by batching busy destinations
+            coalesce = metrics.collectors.get("relay_coalesce_total")
+            saved = coalesce[1]().get((("event", "saved"),), 0) if coalesce else 0
+            description = (
+                f"```\n{tabulate(stages, headers=['Stage', 'Count', 'p50 ms', 'p99 ms'])}\n```"
+                f"```\n{tabulate([[p, int(pools[p]), depths.get(p, 0)] for p in busiest], headers=['Pool', 'Messages', 'Queued'])}\n```"
+                f"429s: `{stats['rate_limited']}` · Queued: `{self.bot.scheduler.depth}` · "
+                f"In flight: `{self.bot.scheduler.in_flight}` · Shed: `{stats['shed']}` · "
+                f"Coalesced: `{stats['coalesced']}` · Saved by batching: `{int(saved)}`"
+            )
+
+            await inter.send(
+                embed=Embed(colour=Colours.neutral, description=description[:4096]),
+                ephemeral=True,
+            )
+
+        else:
+            await inter.error("This command is reserved for Admins.")
+
+
+def setup(bot):
+    bot.add_cog(RelayMetrics(bot))
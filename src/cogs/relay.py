@@ -1,17 +1,149 @@
-from nextcord import TextChannel, Message, RawReactionActionEvent, Emoji, PartialEmoji
+from asyncio import Future, gather
+from time import monotonic, perf_counter
+
+from nextcord import TextChannel, Message, RawReactionActionEvent, Emoji, PartialEmoji, HTTPException, WebhookMessage
+from nextcord import RawMessageUpdateEvent, RawMessageDeleteEvent, RawBulkMessageDeleteEvent, Object, File, NotFound
+from nextcord import Guild, Member, User, RawReactionClearEvent, RawReactionClearEmojiEvent
 from nextcord import slash_command, SlashOption
 from nextcord.ext import commands
 from nextcord.ext import application_checks
-from tabulate import tabulate
+from nextcord.ext import tasks
 
 from bot import RelayBot
+from src.common.analytics import ANALYTICS_FLUSH_INTERVAL, ANALYTICS_WINDOWS, RelayAnalytics, parse_window
+from src.common.attachments import RelayAttachments
+from src.common.coalesce import Coalescer
 from src.common.common import *
+from src.common.dedup import SeenSet
+from src.common.fanout import Delivery, FanOut
+from src.common.ingest import IngestPipeline, WorkItem
+from src.common.journal import BACKFILL_LIMIT, JOURNAL_FLUSH_INTERVAL, RETRY_INTERVAL, DeliveryJournal, PendingDelivery
+from src.common.message_map import MessageMap, RelayedMessage, group_by_channel
+from src.common.models import DEFAULT_BUDGET, Budget, Membership, Pool
+from src.common.moderation import ModerationBatcher
+from src.common.reactions import EmojiTable, ReactionMirror
+from src.common.render import MAX_USERNAME_LENGTH, RELAY_MENTIONS, RenderCache
+from src.common.reports import MembershipSnapshot, ReportMenu, TablePageSource
+from src.common.routing import RoutingIndex
+from src.common.scheduler import DELIVERY, MIRROR
+from src.common.store import FLUSH_INTERVAL, SYNC_INTERVAL, PoolStore
+from src.common.webhooks import is_unknown_webhook
 
 
 class Relay(commands.Cog):
     def __init__(self, bot: RelayBot):
         self.bot: RelayBot = bot
-        self.pools: Dict[str, Dict[str, Union[Dict[str, Dict[str, Union[List[int], int]]], str]]] = {}
+        self.pools: Dict[str, Pool] = {}
+        self.routes: RoutingIndex = RoutingIndex()
+        self.fanout: FanOut = FanOut()
+        self.store: PoolStore = PoolStore()
+        self.messages: MessageMap = MessageMap()
+        self.analytics: RelayAnalytics = RelayAnalytics()
+        self.ingest: IngestPipeline = IngestPipeline(self.process, budget_of=self.budget_of)
+        self.ingest.on_drop = self.dropped
+        # The pools each source message is still queued in, events about it wait for all of them
+        self.relaying: Dict[int, List[str]] = {}
+        self.renders: RenderCache = RenderCache()
+        self.moderation: ModerationBatcher = ModerationBatcher()
+        self.seen: SeenSet = SeenSet()
+        self.coalescer: Coalescer = Coalescer(self.send_batch)
+        self.journal: DeliveryJournal = DeliveryJournal(self.bot.cluster_id)
+        self.backfilled: bool = False
+        self.snapshot: MembershipSnapshot = MembershipSnapshot()
+        self.emojis: EmojiTable = EmojiTable(self.bot)
+        self.reactions: ReactionMirror = ReactionMirror(
+            self.emojis, self.mirror_reaction, self.unmirror_reaction
+        )
+
+        self.bot.startup_hooks.append(self.startup)
+        self.bot.scheduler.budget_of = self.budget_of
+
+        # Make sure buffered message counts and events are written before the bot shuts down
+        self.bot.shutdown_hooks.append(self.store.flush)
+        self.bot.shutdown_hooks.append(self.analytics.flush)
+        self.bot.shutdown_hooks.append(self.moderation.close)
+        self.bot.shutdown_hooks.append(self.coalescer.close)
+        self.bot.shutdown_hooks.append(self.journal.flush)
+        self.bot.shutdown_hooks.append(self.reactions.close)
+
+        # Hooks run last to first, so queued events are relayed before anything is flushed
+        self.bot.shutdown_hooks.append(self.ingest.close)
+
+        self.bot.metrics.collect(
+            "relay_ingest_depth",
+            "gauge",
+            lambda: {(("pool", pool),): depth for pool, depth in self.ingest.depths().items()},
+        )
+        self.bot.metrics.collect(
+            "relay_ingest_dropped_total",
+            "counter",
+            lambda: {(("pool", pool),): n for pool, n in self.ingest.dropped.items()},
+        )
+        self.bot.metrics.collect(
+            "relay_moderation_total",
+            "counter",
+            lambda: {(("event", event),): n for event, n in self.moderation.stats.items()},
+        )
+        self.bot.metrics.collect(
+            "relay_moderation_scoring_seconds_total",
+            "counter",
+            lambda: {(): self.moderation.scoring_seconds},
+        )
+        self.bot.metrics.collect(
+            "relay_coalesce_total",
+            "counter",
+            lambda: {(("event", event),): n for event, n in self.coalescer.stats.items()},
+        )
+        self.bot.metrics.describe(
+            "relay_coalesce_total", "Batched relaying, saved counts webhook executes avoided."
+        )
+        self.bot.metrics.collect("relay_seen_pairs", "gauge", lambda: {(): len(self.seen)})
+        self.bot.metrics.collect(
+            "relay_reaction_mirror_total",
+            "counter",
+            lambda: {(("event", event),): n for event, n in self.reactions.stats.items()},
+        )
+        self.bot.metrics.collect("relay_reaction_states", "gauge", lambda: {(): len(self.reactions)})
+        self.bot.metrics.collect("relay_pool_quota_exhausted_total", "counter", self.quota_exhaustions)
+        self.bot.metrics.describe(
+            "relay_pool_quota_exhausted_total",
+            "Times a pool ran out of a budget quota, rate, concurrency or queue (events dropped).",
+        )
+        self.bot.metrics.collect(
+            "relay_pool_in_flight",
+            "gauge",
+            lambda: {(("pool", pool),): n for pool, n in self.bot.scheduler.in_flight_by_pool().items()},
+        )
+        self.bot.metrics.collect(
+            "relay_journal_total",
+            "counter",
+            lambda: {(("event", event),): n for event, n in self.journal.stats.items()},
+        )
+        self.bot.metrics.collect(
+            "relay_analytics_events_total",
+            "counter",
+            lambda: {(("event", event),): n for event, n in self.analytics.stats.items()},
+        )
+        self.bot.metrics.collect(
+            "relay_ingest_total",
+            "counter",
+            lambda: {(("event", event),): n for event, n in self.ingest.stats.items()},
+        )
+
+    def budget_of(self, pool_name: str) -> Budget:
+        """The budget of a pool, the default one for pools that don't exist (anymore)."""
+        pool = self.pools.get(pool_name)
+        return pool.budget if pool is not None else DEFAULT_BUDGET
+
+    def quota_exhaustions(self) -> Dict[Tuple[Tuple[str, str], ...], int]:
+        """Times every pool ran out of each quota, from the send scheduler and the ingest queues."""
+        values = {
+            (("pool", pool_name), ("quota", quota)): n
+            for (pool_name, quota), n in self.bot.scheduler.exhausted.items()
+        }
+        for pool_name, n in self.ingest.dropped.items():
+            values[("pool", pool_name), ("quota", "queue")] = n
+        return values
 
     async def init_analytics(self, pool_name: str, guild_id: int) -> None:
         """
@@ -21,142 +153,861 @@ class Relay(commands.Cog):
         :param guild_id: The ID of the guild for which the analytics data should be initialized.
         """
         if pool_name not in self.pools:
-            self.pools[pool_name] = {"password": None, "servers": {}}
-
-        str_guild_id = str(guild_id)
+            self.pools[pool_name] = Pool(pool_name)
 
-        if str_guild_id not in self.pools[pool_name]["servers"]:
-            self.pools[pool_name]["servers"][str_guild_id] = {"channels": [], "message_count": 0}
+        pool = self.pools[pool_name]
+        if guild_id not in pool.servers:
+            pool.servers[guild_id] = Membership(guild_id)
 
-        await self.save_pools()
+        await self.save_pool(pool_name)
 
     async def load_pools(self) -> None:
         """Load pools from the database."""
-        pools = await db.pools.find_one({"_id": "pools"})
-        if not pools:
-            await db.pools.insert_one({"_id": "pools", "data": {}})
-            pools = {"data": {}}
-        self.pools = pools["data"]
+        self.pools = await self.store.load()
+        self.routes.rebuild(self.pools)
 
-    async def save_pools(self) -> None:
-        """Save pools to the database."""
-        await db.pools.update_one({"_id": "pools"}, {"$set": {"data": self.pools}})
+    async def save_pool(self, pool_name: str) -> None:
+        """
+        Write the configuration of a pool to the database.
+
+        :param pool_name: The name of the pool to save.
+        """
+        await self.store.save_pool(self.pools[pool_name])
+
+    async def apply_pool_change(self, pool_name: str, pool: Optional[Pool]) -> None:
+        """
+        Apply a pool change made by another process to the pools and routes.
+
+        :param pool_name: The name of the pool that changed.
+        :param pool: The new state of the pool, or None if it was deleted.
+        """
+        if pool is None:
+            self.pools.pop(pool_name, None)
+        else:
+            self.pools[pool_name] = pool
+        self.routes.update_pool(pool_name, pool)
+
+    @tasks.loop(seconds=SYNC_INTERVAL)
+    async def sync_pools(self) -> None:
+        """Keep the pools in sync with the processes running the other shards."""
+        try:
+            await self.store.sync(self.apply_pool_change)
+        except Exception as e:
+            print(f"Error syncing pools: {e}")
+
+    @tasks.loop(seconds=FLUSH_INTERVAL)
+    async def flush_pools(self) -> None:
+        """Periodically write buffered message counts to the database."""
+        try:
+            with self.bot.metrics.time("relay_stage_seconds", stage="flush"):
+                await self.store.flush()
+        except Exception as e:
+            print(f"Error flushing pools: {e}")
+
+    @tasks.loop(seconds=ANALYTICS_FLUSH_INTERVAL)
+    async def flush_analytics(self) -> None:
+        """Periodically write buffered relay events and rollups to the database."""
+        try:
+            with self.bot.metrics.time("relay_stage_seconds", stage="analytics"):
+                await self.analytics.flush()
+        except Exception as e:
+            print(f"Error flushing analytics: {e}")
+
+    @tasks.loop(seconds=JOURNAL_FLUSH_INTERVAL)
+    async def flush_journal(self) -> None:
+        """Periodically write buffered journal changes to the database."""
+        try:
+            with self.bot.metrics.time("relay_stage_seconds", stage="journal"):
+                await self.journal.flush()
+        except Exception as e:
+            print(f"Error flushing journal: {e}")
+
+    @tasks.loop(seconds=RETRY_INTERVAL)
+    async def retry_deliveries(self) -> None:
+        """Retry journaled deliveries that failed or were cut off by a restart."""
+        try:
+            # Write the state of the last pass first, so its deliveries aren't due again
+            await self.journal.flush()
+            for pending, attempts in await self.journal.due():
+                await self.retry_delivery(pending, attempts)
+        except Exception as e:
+            print(f"Error retrying deliveries: {e}")
+
+    async def retry_delivery(self, pending: PendingDelivery, attempts: int) -> None:
+        """
+        Relay a journaled message again to the destinations it didn't reach.
+
+        :param pending: The deliveries to retry.
+        :param attempts: The number of failed attempts so far.
+        """
+        channel = self.bot.get_channel(pending.source_channel_id)
+        current = self.routes.get(pending.source_channel_id).get(pending.pool_name, ())
+        destinations = tuple(channel_id for channel_id in pending.destinations if channel_id in current)
+
+        # Destinations that left the pool since are dropped
+        if len(destinations) < len(pending.destinations):
+            self.journal.discard(
+                pending._replace(
+                    destinations=tuple(c for c in pending.destinations if c not in destinations)
+                )
+            )
+        if channel is None or not destinations:
+            return
+
+        try:
+            message = await channel.fetch_message(pending.message_id)
+        except NotFound:
+            self.journal.discard(pending._replace(destinations=destinations))
+            return
+
+        await self.relay_message(message, pending.pool_name, destinations, attempts)
+
+    async def backfill(self, marks: Dict[int, int]) -> None:
+        """
+        Relay the messages sent in pooled channels while the bot was down.
+
+        Messages are relayed directly and in order rather than through the ingest
+        queues, which could drop them while the high-water mark moves past them.
+
+        :param marks: The high-water marks by channel ID, as stored before live messages moved them.
+        """
+        for channel_id, mark in marks.items():
+            # Channels of other processes are backfilled by them
+            channel = self.bot.get_channel(channel_id)
+            if channel is None or channel_id not in self.routes:
+                continue
+
+            try:
+                async for message in channel.history(
+                    after=Object(id=mark), limit=BACKFILL_LIMIT, oldest_first=True
+                ):
+                    if self.is_own_copy(message) or message.author.bot:
+                        continue
+                    for pool_name, destinations in self.routes.get(channel_id).items():
+                        if not destinations:
+                            continue
+                        try:
+                            await self.relay_message(message, pool_name)
+                        except Exception as e:
+                            self.bot.metrics.inc("relay_errors_total", pool=pool_name)
+                            print(f"Error relaying message: {e}")
+            except Exception as e:
+                print(f"Error backfilling {channel_id}: {e}")
+
+    def cog_unload(self) -> None:
+        self.flush_pools.cancel()
+        self.flush_analytics.cancel()
+        self.flush_journal.cancel()
+        self.retry_deliveries.cancel()
+        self.sync_pools.cancel()
+        self.bot.startup_hooks.remove(self.startup)
+        self.bot.scheduler.budget_of = lambda pool_name: DEFAULT_BUDGET
+        self.bot.shutdown_hooks.remove(self.store.flush)
+        self.bot.shutdown_hooks.remove(self.analytics.flush)
+        self.bot.shutdown_hooks.remove(self.moderation.close)
+        self.bot.shutdown_hooks.remove(self.coalescer.close)
+        self.bot.shutdown_hooks.remove(self.journal.flush)
+        self.bot.shutdown_hooks.remove(self.reactions.close)
+        self.bot.shutdown_hooks.remove(self.ingest.close)
+        for task in self.ingest.tasks:
+            task.cancel()
+
+    async def startup(self) -> None:
+        """Load pools and create indexes, run with the bot's other startup hooks."""
+        await gather(
+            self.load_pools(),
+            self.messages.ensure_indexes(),
+            self.analytics.ensure_indexes(),
+            self.store.ensure_indexes(),
+            self.journal.ensure_indexes(),
+        )
+        if any(pool.moderation is not None for pool in self.pools.values()):
+            await self.moderation.warm_up()
 
     @commands.Cog.listener()
     async def on_ready(self) -> None:
-        """Load pools when the bot is ready."""
-        await self.load_pools()
+        """Start the background loops once the pools are loaded."""
+        await self.bot.ensure_started()
+
+        # on_ready fires again after reconnects, the gap is only backfilled after a restart
+        marks = None
+        if not self.backfilled:
+            self.backfilled = True
+            # Read before the journal is flushed, which writes the marks moved by live messages
+            try:
+                marks = await self.journal.load_watermarks(self.routes)
+            except Exception as e:
+                print(f"Error loading watermarks: {e}")
+
+        if not self.sync_pools.is_running():
+            self.sync_pools.start()
+        if not self.flush_pools.is_running():
+            self.flush_pools.start()
+        if not self.flush_analytics.is_running():
+            self.flush_analytics.start()
+        if not self.flush_journal.is_running():
+            self.flush_journal.start()
+        if not self.retry_deliveries.is_running():
+            self.retry_deliveries.start()
+
+        if marks:
+            await self.backfill(marks)
 
     @commands.Cog.listener()
     async def on_message(self, message: Message) -> None:
         """Relay messages between channels in the same pool."""
-        for pool_name, pool_data in self.pools.items():
-            str_guild_id = str(message.guild.id)  # Convert the guild_id to a string
-            server_data = pool_data.get("servers", {}).get(str_guild_id)
-            if server_data and message.channel.id in server_data["channels"]:
+        routes = self.routes.get(message.channel.id)
+        if not routes:
+            return
+
+        # Copies sent by the bot's own webhooks would loop back into the pool
+        if self.is_own_copy(message):
+            self.bot.metrics.inc("relay_loops_dropped_total")
+            return
+
+        # Ignore messages from the bot or other bots
+        if message.author.bot:
+            return
+
+        if self.bot.capture is not None:
+            self.bot.capture.pools(self.routes.version, self.pools)
+            self.bot.capture.message(message)
+
+        with self.bot.metrics.time("relay_stage_seconds", stage="on_message"):
+            for pool_name, destinations in routes.items():
+                # Every destination is reached through an earlier pool of the channel
+                if not destinations:
+                    continue
+                # Score while queued, so messages waiting in the same pool are scored together
+                if self.is_moderated(message, pool_name):
+                    self.moderation.prefetch(message.id, message.content)
+                self.relaying.setdefault(message.id, []).append(pool_name)
+                if not await self.ingest.put(pool_name, "message", message):
+                    self.relayed(message.id, pool_name)
+
+    def is_own_copy(self, message: Message) -> bool:
+        """Check whether a message was sent by one of the bot's relay webhooks."""
+        return message.webhook_id is not None and message.webhook_id in self.bot.webhook_cache.ids()
+
+    async def process(self, pool_name: str, item: WorkItem) -> None:
+        """
+        Relay a queued gateway event, called by the ingest workers.
+
+        :param pool_name: The name of the pool the event was queued for.
+        :param item: The queued event.
+        """
+        metrics = self.bot.metrics
+        metrics.observe("relay_ingest_wait_seconds", monotonic() - item.enqueued_at, pool=pool_name)
+
+        if item.kind == "message":
+            with metrics.time("relay_stage_seconds", stage="relay"):
                 try:
-                    await self.relay_message(message, pool_name)
+                    await self.relay_message(item.payload, pool_name)
                 except Exception as e:
+                    metrics.inc("relay_errors_total", pool=pool_name)
                     print(f"Error relaying message: {e}")
+                finally:
+                    self.relayed(item.payload.id, pool_name)
+            return
+
+        # The message is still queued in another of its pools, wait behind it there
+        message_ids = item.payload.message_ids if item.kind == "bulk_delete" else (item.payload.message_id,)
+        waiting = next(
+            (other for message_id in message_ids for other in self.relaying.get(message_id, ()) if other != pool_name),
+            None,
+        )
+        if waiting is not None:
+            metrics.inc("relay_events_requeued_total", pool=waiting)
+            await self.ingest.put(waiting, item.kind, item.payload)
+            return
+
+        if item.kind == "reaction":
+            await self.relay_reaction(item, 1, pool_name)
+        elif item.kind == "reaction_remove":
+            await self.relay_reaction(item, -1, pool_name)
+        elif item.kind == "reaction_clear":
+            await self.relay_reaction_clear(item, pool_name)
+        elif item.kind == "edit":
+            await self.propagate_edit(item.payload, pool_name)
+        elif item.kind == "delete":
+            await self.propagate_delete(item.payload.message_id, pool_name)
+        elif item.kind == "bulk_delete":
+            await self.propagate_bulk_delete(item.payload.message_ids, pool_name)
+
+    def relayed(self, message_id: int, pool_name: str) -> None:
+        """Forget that a source message is queued in a pool, once it was relayed through it or dropped."""
+        pools = self.relaying.get(message_id)
+        if pools is None:
+            return
+        if pool_name in pools:
+            pools.remove(pool_name)
+        if not pools:
+            del self.relaying[message_id]
+
+    def dropped(self, pool_name: str, item: WorkItem) -> None:
+        if item.kind == "message":
+            self.relayed(item.payload.id, pool_name)
 
     def get_pools_for_channel(self, channel_id: int) -> List[str]:
-        pools = []
-        for pool_name, pool_data in self.pools.items():
-            for guild_id, server_data in pool_data["servers"].items():
-                if channel_id in server_data["channels"]:
-                    pools.append(pool_name)
-                    break
-        return pools
+        return list(self.routes.get(channel_id))
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: Member, after: Member) -> None:
+        """Re-render a member on their next message after a nickname or avatar change."""
+        self.renders.invalidate(after.guild.id, after.id)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: User, after: User) -> None:
+        self.renders.invalidate_user(after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before: Guild, after: Guild) -> None:
+        if before.name != after.name:
+            self.renders.invalidate_guild(after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild: Guild, before: Any, after: Any) -> None:
+        self.emojis.invalidate_guild(guild.id)
 
     @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload: RawReactionActionEvent):
+    async def on_raw_reaction_add(self, payload: RawReactionActionEvent) -> None:
+        """Mirror reactions on relayed messages, checked against the pools before any request."""
         # Ignore reactions from the bot itself
         if payload.user_id == self.bot.user.id:
             return
 
-        channel = self.bot.get_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
-        pools = self.get_pools_for_channel(channel.id)
+        if payload.channel_id not in self.routes:
+            return
+
+        await self.ingest.put(self.routes.pool_of(payload.channel_id), "reaction", payload)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: RawReactionActionEvent) -> None:
+        # The bot removing its own mirrored reactions comes back as an event too
+        if payload.user_id == self.bot.user.id:
+            return
+
+        if payload.channel_id not in self.routes:
+            return
+
+        await self.ingest.put(self.routes.pool_of(payload.channel_id), "reaction_remove", payload)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload: RawReactionClearEvent) -> None:
+        if payload.channel_id in self.routes:
+            await self.ingest.put(self.routes.pool_of(payload.channel_id), "reaction_clear", payload)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload: RawReactionClearEmojiEvent) -> None:
+        if payload.channel_id in self.routes:
+            await self.ingest.put(self.routes.pool_of(payload.channel_id), "reaction_clear", payload)
+
+    async def relay_reaction(self, item: WorkItem, delta: int, pool_name: str) -> None:
+        """
+        Record a reaction added or removed on a relayed message, to be mirrored onto its relay group.
+
+        :param item: The queued reaction event, on the source or a relayed copy.
+        :param delta: 1 for an added reaction, -1 for a removed one.
+        :param pool_name: The name of the pool the reaction is mirrored for.
+        """
+        payload: RawReactionActionEvent = item.payload
+        relayed = await self.messages.get(payload.message_id)
+        if relayed is None:
+            return
+
+        if self.bot.capture is not None:
+            self.bot.capture.reaction(
+                "reaction_add" if delta > 0 else "reaction_remove", payload, relayed.message_id, item.enqueued_at
+            )
+
+        self.bot.metrics.inc(
+            "relay_reactions_total", pool=pool_name, action="add" if delta > 0 else "remove"
+        )
+        # Events are debounced per message and emoji, the requests are queued once the burst is over
+        self.reactions.record(relayed, payload.message_id, payload.emoji, delta, pool_name)
+
+    async def relay_reaction_clear(self, item: WorkItem, pool_name: str) -> None:
+        """
+        Record that the reactions of a relayed message were cleared by a moderator.
+
+        :param item: The queued clear event, of every reaction or of one emoji.
+        :param pool_name: The name of the pool the reactions were mirrored for.
+        """
+        payload: Union[RawReactionClearEvent, RawReactionClearEmojiEvent] = item.payload
+        relayed = await self.messages.get(payload.message_id)
+        if relayed is None:
+            return
+
+        if self.bot.capture is not None:
+            self.bot.capture.reaction("reaction_clear", payload, relayed.message_id, item.enqueued_at)
+        self.reactions.clear(relayed, payload.message_id, getattr(payload, "emoji", None), pool_name)
+
+    def mirror_reaction(
+        self,
+        channel_id: int,
+        message_id: int,
+        emoji: Union[Emoji, PartialEmoji, str],
+        pool_name: str,
+    ) -> Future:
+        """
+        Queue adding a reaction to a message as low priority work.
+
+        :param channel_id: The ID of the channel the message is in.
+        :param message_id: The ID of the message to react to.
+        :param emoji: The emoji to add.
+        :param pool_name: The name of the pool the reaction is mirrored for.
+        :return: A future resolved once the reaction was added, coalesced or shed.
+        """
+        message = self.bot.get_partial_messageable(channel_id).get_partial_message(message_id)
+        return self.bot.scheduler.submit(
+            ("channel", channel_id),
+            pool_name,
+            MIRROR,
+            lambda: message.add_reaction(emoji),
+            coalesce_key=(message_id, str(emoji)),
+        )
+
+    def unmirror_reaction(
+        self,
+        channel_id: int,
+        message_id: int,
+        emoji: Union[Emoji, PartialEmoji, str],
+        pool_name: str,
+    ) -> Future:
+        """
+        Queue removing the bot's own reaction from a message as low priority work.
+
+        :param channel_id: The ID of the channel the message is in.
+        :param message_id: The ID of the message.
+        :param emoji: The emoji to remove.
+        :param pool_name: The name of the pool the reaction was mirrored for.
+        :return: A future resolved once the reaction was removed, coalesced or shed.
+        """
+        message = self.bot.get_partial_messageable(channel_id).get_partial_message(message_id)
+        return self.bot.scheduler.submit(
+            ("channel", channel_id),
+            pool_name,
+            MIRROR,
+            lambda: message.remove_reaction(emoji, self.bot.user),
+            # Shared with adding it, so only the latest of the two is sent
+            coalesce_key=(message_id, str(emoji)),
+        )
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: RawMessageUpdateEvent) -> None:
+        """Propagate edits of relayed messages to their copies."""
+        if payload.channel_id not in self.routes or "content" not in payload.data:
+            return
+
+        content = payload.data["content"]
+        if payload.cached_message and payload.cached_message.content == content:
+            return  # Embed or attachment update, the text didn't change
+
+        await self.ingest.put(self.routes.pool_of(payload.channel_id), "edit", payload)
+
+    async def propagate_edit(self, payload: RawMessageUpdateEvent, pool_name: str) -> None:
+        """
+        Apply an edit of a source message to its relayed copies.
+
+        :param payload: The edit event of the source message.
+        :param pool_name: The name of the pool the message was relayed through.
+        """
+        relayed = await self.messages.get(payload.message_id)
+
+        # Only edits of the source are propagated, the copies are edited by the bot itself
+        if relayed is None or relayed.message_id != payload.message_id:
+            return
+
+        content = payload.data["content"]
+        copies = group_by_channel(relayed.copies)
+        deliveries = await self.fanout.run(
+            copies,
+            lambda channel_id: self.edit_copies(channel_id, copies[channel_id], content, pool_name),
+            pool_name,
+        )
+        self.report_failures(deliveries, "editing message")
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: RawMessageDeleteEvent) -> None:
+        """Delete the copies of a relayed message when the source is deleted."""
+        if payload.channel_id not in self.routes:
+            return
+
+        await self.ingest.put(self.routes.pool_of(payload.channel_id), "delete", payload)
+
+    async def propagate_delete(self, message_id: int, pool_name: str) -> None:
+        """
+        Delete the relayed copies of a deleted source message.
 
-        if not all((channel, pools, message)):
+        :param message_id: The ID of the deleted message.
+        :param pool_name: The name of the pool the message was relayed through.
+        """
+        relayed = await self.messages.get(message_id)
+
+        # Deleting a copy only removes it from that server
+        if relayed is None or relayed.message_id != message_id:
             return
 
-        for pool in pools:
-            await self.relay_reaction(pool, message, payload.emoji)
+        await self.delete_relayed([relayed], pool_name)
 
-    async def relay_reaction(self, pool_name: str, message: Message, emoji: Union[Emoji, PartialEmoji, str]):
-        print(f"Relaying {emoji} on pool {pool_name}")
-        servers = self.pools[pool_name]["servers"]
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: RawBulkMessageDeleteEvent) -> None:
+        """Delete the copies of bulk deleted messages, batched per destination channel."""
+        if payload.channel_id not in self.routes:
+            return
 
-        for guild_id, server_data in servers.items():
-            for channel_id in server_data["channels"]:
-                channel = self.bot.get_channel(channel_id)
-                if channel and channel.id != message.channel.id:
-                    history = await channel.history(limit=20).flatten()
-                    for relayed_message in history:
-                        if relayed_message.content == message.content:
-                            existing_reaction = None
-                            for reaction in relayed_message.reactions:
-                                if reaction.emoji == emoji:
-                                    existing_reaction = reaction
-                                    break
+        await self.ingest.put(self.routes.pool_of(payload.channel_id), "bulk_delete", payload)
+
+    async def propagate_bulk_delete(self, message_ids: Iterable[int], pool_name: str) -> None:
+        """
+        Delete the relayed copies of bulk deleted source messages.
+
+        :param message_ids: The IDs of the deleted messages.
+        :param pool_name: The name of the pool the messages were relayed through.
+        """
+        relayed = await self.messages.get_sources(message_ids)
+        if relayed:
+            await self.delete_relayed(relayed, pool_name)
+
+    async def delete_relayed(self, relayed: List[RelayedMessage], pool_name: str) -> None:
+        """
+        Delete every copy of the given relayed messages and forget them.
+
+        :param relayed: The relay groups of the deleted source messages.
+        :param pool_name: The name of the pool the source messages were relayed through.
+        """
+        copies = group_by_channel(copy for entry in relayed for copy in entry.copies)
+        deliveries = await self.fanout.run(
+            copies,
+            lambda channel_id: self.delete_copies(channel_id, copies[channel_id], pool_name),
+            pool_name,
+        )
+        self.report_failures(deliveries, "deleting message")
+
+        await self.messages.remove_many([entry.message_id for entry in relayed])
+
+    async def edit_copies(
+        self, channel_id: int, message_ids: List[int], content: str, pool_name: str
+    ) -> None:
+        """
+        Edit relayed copies in a channel through the webhook that sent them.
+
+        :param channel_id: The ID of the channel the copies are in.
+        :param message_ids: The IDs of the copies.
+        :param content: The new content of the copies.
+        :param pool_name: The name of the pool the copies were relayed through.
+        """
+        webhook = await self.bot.webhook_cache.lookup(channel_id)
+        if webhook is None:
+            return
+
+        for message_id in message_ids:
+            await self.bot.scheduler.send(
+                ("webhook", webhook.id),
+                pool_name,
+                DELIVERY,
+                lambda m=message_id: webhook.edit_message(m, content=content),
+            )
+
+    async def delete_copies(self, channel_id: int, message_ids: List[int], pool_name: str) -> None:
+        """
+        Delete relayed copies in a channel.
+
+        Several copies are removed with bulk deletes of up to 100 messages, falling back
+        to deleting them one by one through the webhook when the bot can't bulk delete.
+
+        :param channel_id: The ID of the channel the copies are in.
+        :param message_ids: The IDs of the copies.
+        :param pool_name: The name of the pool the copies were relayed through.
+        """
+        channel = self.bot.get_channel(channel_id)
+        if channel is not None and len(message_ids) > 1:
+            try:
+                while message_ids:
+                    batch = [Object(id=m) for m in message_ids[:100]]
+                    await self.bot.scheduler.send(
+                        ("channel", channel_id),
+                        pool_name,
+                        DELIVERY,
+                        lambda: channel.delete_messages(batch),
+                    )
+                    message_ids = message_ids[100:]
+                return
+            except HTTPException:
+                pass
+
+        webhook = await self.bot.webhook_cache.lookup(channel_id)
+        if webhook is None:
+            return
 
-                            if not existing_reaction:
-                                await relayed_message.add_reaction(emoji)
+        for message_id in message_ids:
+            await self.bot.scheduler.send(
+                ("webhook", webhook.id),
+                pool_name,
+                DELIVERY,
+                lambda m=message_id: webhook.delete_message(m),
+            )
 
-    async def relay_message(self, message: Message, pool_name: str) -> None:
+    @staticmethod
+    def report_failures(deliveries: List[Delivery], action: str) -> None:
+        """Print the destinations a fan-out failed for."""
+        for delivery in deliveries:
+            if not delivery.ok:
+                print(
+                    f"Error {action} in {delivery.channel_id} "
+                    f"after {delivery.elapsed:.3f}s: {delivery.error}"
+                )
+
+    async def relay_message(
+        self,
+        message: Message,
+        pool_name: str,
+        destinations: Optional[Tuple[int, ...]] = None,
+        attempts: int = 0,
+    ) -> List[Delivery]:
         """
         Relay a message to other channels in the same pool.
 
+        All destinations are sent to concurrently, a failing channel doesn't stop the others.
+        Deliveries are journaled, so failed ones are retried by the ``retry_deliveries`` loop.
+
         :param message: The message object that needs to be relayed.
         :param pool_name: The name of the pool in which the message should be relayed.
+        :param destinations: The channels to retry, by default every other channel of the pool.
+        :param attempts: The number of failed attempts so far, for retries.
+        :return: The outcome and timing of the relay for every destination channel.
         """
 
         # Ignore messages from the bot or other bots
         if message.author == self.bot.user or message.author.bot:
-            return
+            return []
+
+        pool = self.pools[pool_name]
+        guild_id = message.guild.id
+
+        retry = destinations is not None
+        if not retry:
+            destinations = self.routes.destinations(message.channel.id, pool_name)
+
+        # Skip channels the message already reached, e.g. when the gateway sent it twice
+        claimed = tuple(
+            channel_id for channel_id in destinations if self.seen.claim(message.id, channel_id)
+        )
+        if len(claimed) < len(destinations):
+            self.bot.metrics.inc(
+                "relay_duplicates_total", len(destinations) - len(claimed), pool=pool_name
+            )
+        destinations = claimed
+        if not destinations:
+            return []
+
+        metrics = self.bot.metrics
+
+        if self.is_moderated(message, pool_name) and await self.is_offensive(message, pool_name):
+            metrics.inc("relay_moderated_total", pool=pool_name)
+            return []
+
+        # Download any attachments once for all destinations
+        with metrics.time("relay_stage_seconds", stage="attachments"):
+            attachments = await RelayAttachments.download(message.attachments)
+
+        # The same username, avatar and content are sent to every destination
+        payload = self.renders.payload(message, attachments)
 
-        servers = self.pools[pool_name]["servers"]
-        originating_guild_id = str(message.guild.id)
+        # Busy destinations get the message in the next batch, files can't be batched
+        threshold = pool.coalesce
+        batched: Set[int] = set()
+        if threshold is not None and not attachments.buffers:
+            batched = self.coalescer.select(destinations, threshold)
 
-        message_relayed = False
+        # Every delivery is journaled before it's sent, send_batch settles the batched ones
+        self.journal.begin(message, pool_name, destinations, attempts, stored=retry)
+        if not retry:
+            # Only moved once the message is journaled, so backfill never skips one that wasn't relayed
+            self.journal.advance(message.channel.id, message.id)
+
+        for channel_id in batched:
+            self.coalescer.add(pool_name, channel_id, message.id, payload)
+        destinations = tuple(channel_id for channel_id in destinations if channel_id not in batched)
 
         # Relay the message to the other channels in the pool
-        for guild_id, server_data in servers.items():
-            for channel_id in server_data["channels"]:
-                if channel_id != message.channel.id:
-                    channel = self.bot.get_channel(channel_id)
-                    if channel:
-                        webhook = await self.bot.find_or_create_webhook(channel, "RelayBot")
-                        
-                        # Check for any attachments in the message
-                        files = []
-                        for attachment in message.attachments:
-                            file = await attachment.to_file()
-                            files.append(file)
-
-                        relayed_message = await webhook.send(
-                            message.content,
-                            username=f"{message.author.display_name} · {message.guild.name}",
-                            avatar_url=message.author.avatar.url,
-                            files=files,
-                            wait=True
-                        )
-
-                        # Add reactions to the relayed message
-                        for reaction in message.reactions:
-                            try:
-                                await relayed_message.add_reaction(reaction.emoji)
-                            except Exception:
-                                pass
-
-                        message_relayed = True
-
-        # Increment the message count only for the sending server
-        if message_relayed:
-            servers[originating_guild_id]["message_count"] += 1
-
-        await self.save_pools()  # Save the updated pools
+        with metrics.time("relay_fanout_seconds", pool=pool_name):
+            deliveries = await self.fanout.run(
+                destinations,
+                lambda channel_id: self.relay_to_channel(
+                    message, channel_id, payload, attachments, pool_name
+                ),
+                pool_name,
+            )
+        self.journal.finish(message.id, deliveries)
+
+        self.report_failures(deliveries, "relaying message")
+
+        # Failed destinations may be retried
+        for delivery in deliveries:
+            if not delivery.ok:
+                self.seen.release(message.id, delivery.channel_id)
+
+        metrics.inc("relay_messages_total", pool=pool_name)
+        for delivery in deliveries:
+            metrics.inc(
+                "relay_deliveries_total",
+                pool=pool_name,
+                channel=delivery.channel_id,
+                result="ok" if delivery.ok else "error",
+            )
+            metrics.observe("relay_delivery_seconds", delivery.elapsed, pool=pool_name)
+
+        copies = [
+            (delivery.channel_id, delivery.result.id)
+            for delivery in deliveries
+            if delivery.result is not None
+        ]
+
+        # Increment the message count only for the sending server, once per message
+        if not retry and (copies or batched):
+            membership = pool.servers.get(guild_id)
+            if membership is not None:
+                membership.message_count += 1
+                self.store.increment(pool_name, guild_id)
+            self.analytics.record(pool_name, guild_id, message.channel.id, len(copies) + len(batched))
+
+        # Remember where the copies went so reactions can be mirrored onto them, batched
+        # copies hold several messages and aren't recorded, edits and deletes would hit them all
+        with metrics.time("relay_stage_seconds", stage="persist"):
+            await self.messages.add(message.channel.id, message.id, copies)
+            # The cache may only hold the retried copies, the next lookup reads them all
+            if retry:
+                self.messages.uncache(message.id)
+
+        return deliveries
+
+    def is_moderated(self, message: Message, pool_name: str) -> bool:
+        """Check whether a message needs to be scored before it's relayed in a pool."""
+        # Messages without text, like attachments only, have nothing to moderate
+        return self.pools[pool_name].moderation is not None and bool(message.content.strip())
+
+    async def is_offensive(self, message: Message, pool_name: str) -> bool:
+        """
+        Score a message with the moderation batcher.
+
+        Messages are relayed if scoring fails, so the relay keeps working without the model.
+
+        :param message: The message to score.
+        :param pool_name: The name of the pool, whose threshold is used.
+        :return: Whether the message should be held back.
+        """
+        try:
+            with self.bot.metrics.time("relay_stage_seconds", stage="moderation"):
+                score = await self.moderation.score_message(message.id, message.content)
+        except Exception as e:
+            print(f"Error moderating message: {e}")
+            return False
+        return score >= self.pools[pool_name].moderation
+
+    async def send_batch(
+        self, pool_name: str, channel_id: int, batch: List[Tuple[int, Dict[str, Any]]]
+    ) -> None:
+        """
+        Send messages collected for a busy destination as one webhook message.
+
+        Every message becomes an embed with its author, so attribution is kept.
+        The journaled delivery of every message is settled with the outcome of
+        the batch, so a failed batch is retried message by message.
+
+        :param pool_name: The name of the pool the messages were relayed through.
+        :param channel_id: The ID of the destination channel.
+        :param batch: The source message IDs and webhook send arguments of the messages, oldest first.
+        """
+        start = perf_counter()
+        try:
+            await self.send_embeds(pool_name, channel_id, [payload for _, payload in batch])
+        except Exception as e:
+            for message_id, _ in batch:
+                self.journal.finish(message_id, [Delivery(channel_id, None, e, perf_counter() - start)])
+                # The retry has to be able to claim the destination again
+                self.seen.release(message_id, channel_id)
+            raise
+
+        for message_id, _ in batch:
+            self.journal.finish(message_id, [Delivery(channel_id, True, None, perf_counter() - start)])
+
+    async def send_embeds(self, pool_name: str, channel_id: int, payloads: List[Dict[str, Any]]) -> None:
+        webhook = await self.bot.find_or_create_webhook(channel_id)
+        if webhook is None:
+            return
+
+        embeds = []
+        for payload in payloads:
+            embed = Embed(colour=Colours.neutral, description=payload["content"][:4096])
+            embed.set_author(name=payload["username"], icon_url=payload["avatar_url"])
+            embeds.append(embed)
+
+        try:
+            with self.bot.metrics.time("relay_stage_seconds", stage="send_batch"):
+                await self.bot.scheduler.send(
+                    ("webhook", webhook.id),
+                    pool_name,
+                    DELIVERY,
+                    lambda: webhook.send(
+                        username=pool_name[:MAX_USERNAME_LENGTH],
+                        embeds=embeds,
+                        allowed_mentions=RELAY_MENTIONS,
+                    ),
+                )
+        except HTTPException as e:
+            if is_unknown_webhook(e):
+                await self.bot.webhook_cache.evict(channel_id)
+            raise
+
+    async def relay_to_channel(
+        self,
+        message: Message,
+        channel_id: int,
+        payload: Dict[str, Any],
+        attachments: RelayAttachments,
+        pool_name: str,
+    ) -> Optional[WebhookMessage]:
+        """
+        Relay a message to a single channel through its webhook.
+
+        :param message: The message object that needs to be relayed.
+        :param channel_id: The ID of the channel to relay the message to.
+        :param payload: The webhook send arguments, built once for every channel.
+        :param attachments: The attachments of the message, downloaded once for every channel.
+        :param pool_name: The name of the pool in which the message is relayed.
+        :return: The relayed message, or None if the channel isn't available.
+        """
+        webhook = await self.bot.find_or_create_webhook(channel_id)
+        if webhook is None:
+            return None
+
+        try:
+            with self.bot.metrics.time("relay_stage_seconds", stage="send"):
+                relayed_message = await self.bot.scheduler.send(
+                    ("webhook", webhook.id),
+                    pool_name,
+                    DELIVERY,
+                    lambda: webhook.send(files=attachments.files(), **payload),
+                )
+        except HTTPException as e:
+            # The webhook was deleted, the next message will create a new one
+            if is_unknown_webhook(e):
+                await self.bot.webhook_cache.evict(channel_id)
+            raise
+
+        # Add reactions to the relayed message
+        if message.reactions:
+            with self.bot.metrics.time("relay_stage_seconds", stage="reactions"):
+                await gather(
+                    *(
+                        self.mirror_reaction(channel_id, relayed_message.id, reaction.emoji, pool_name)
+                        for reaction in message.reactions
+                    ),
+                    return_exceptions=True,
+                )
+
+        return relayed_message
 
     @slash_command(
         name="set_password", description="Set a password for the relay pool."
@@ -175,8 +1026,8 @@ class Relay(commands.Cog):
                 await inter.error(f"Pool `{pool_name}` does not exist.")
                 return
 
-            self.pools[pool_name]["password"] = password
-            await self.save_pools()
+            self.pools[pool_name].password = password
+            await self.save_pool(pool_name)
             await inter.success(f"Password set for pool `{pool_name}`.", ephemeral=True)
 
         else:
@@ -199,18 +1050,215 @@ class Relay(commands.Cog):
                 await inter.error(f"Pool `{pool_name}` does not exist.")
                 return
 
-            if self.pools[pool_name]["password"] is None:
+            if self.pools[pool_name].password is None:
                 await inter.error(f"Pool `{pool_name}` does not have a password.")
                 return
 
-            self.pools[pool_name]["password"] = ""
-            await self.save_pools()
+            self.pools[pool_name].password = ""
+            await self.save_pool(pool_name)
             await inter.success(f"Password removed for pool `{pool_name}`.", ephemeral=True)
 
         else:
             await inter.error("This command is reserved for Admins.")
 
 
+    @slash_command(
+        name="set_moderation", description="Hold back offensive messages in a relay pool."
+    )
+    async def set_moderation(
+        self,
+        inter: CustomInteraction,
+        pool_name: str = SlashOption(
+            description="The name of the pool to moderate."
+        ),
+        threshold: Optional[float] = SlashOption(
+            description="Profanity score from 0 to 1 from which messages aren't relayed, leave empty to disable.",
+            min_value=0.0,
+            max_value=1.0,
+            required=False,
+            default=None,
+        ),
+    ) -> None:
+        if(inter.user.id == 770715610464124969):
+
+            if pool_name not in self.pools:
+                await inter.error(f"Pool `{pool_name}` does not exist.")
+                return
+
+            self.pools[pool_name].moderation = threshold
+            await self.save_pool(pool_name)
+            if threshold is not None:
+                await inter.response.defer(ephemeral=True)
+                await self.moderation.warm_up()
+            if threshold is None:
+                await inter.success(f"Moderation disabled for pool `{pool_name}`.", ephemeral=True)
+            else:
+                await inter.success(
+                    f"Messages scoring `{threshold:g}` or more won't be relayed in pool `{pool_name}`.",
+                    ephemeral=True,
+                )
+
+        else:
+            await inter.error("This command is reserved for Admins.")
+
+    @slash_command(
+        name="set_coalescing", description="Batch messages to busy channels of a relay pool."
+    )
+    async def set_coalescing(
+        self,
+        inter: CustomInteraction,
+        pool_name: str = SlashOption(
+            description="The name of the pool to batch messages in."
+        ),
+        rate: Optional[float] = SlashOption(
+            description="Messages per second to a channel from which they're batched, leave empty to disable.",
+            min_value=0.1,
+            required=False,
+            default=None,
+        ),
+    ) -> None:
+        if(inter.user.id == 770715610464124969):
+
+            if pool_name not in self.pools:
+                await inter.error(f"Pool `{pool_name}` does not exist.")
+                return
+
+            self.pools[pool_name].coalesce = rate
+            await self.save_pool(pool_name)
+            if rate is None:
+                await inter.success(f"Batching disabled for pool `{pool_name}`.", ephemeral=True)
+            else:
+                await inter.success(
+                    f"Channels receiving `{rate:g}` messages per second or more in pool `{pool_name}` "
+                    f"get them in batches. Webhook calls saved so far: `{self.coalescer.stats['saved']}`.",
+                    ephemeral=True,
+                )
+
+        else:
+            await inter.error("This command is reserved for Admins.")
+
+    @slash_command(
+        name="set_pool_budget", description="Limit the share of the relay a pool may use."
+    )
+    async def set_pool_budget(
+        self,
+        inter: CustomInteraction,
+        pool_name: str = SlashOption(
+            description="The name of the pool to limit."
+        ),
+        rate: Optional[float] = SlashOption(
+            description="Requests per second the pool may send, 0 for no limit, leave empty to keep.",
+            min_value=0.0,
+            required=False,
+            default=None,
+        ),
+        concurrency: Optional[int] = SlashOption(
+            description="Requests the pool may have in flight at once, 0 for no limit, leave empty to keep.",
+            min_value=0,
+            required=False,
+            default=None,
+        ),
+        queue: Optional[int] = SlashOption(
+            description="Events waiting to be relayed from which they're dropped, 0 for the default.",
+            min_value=0,
+            required=False,
+            default=None,
+        ),
+        weight: Optional[int] = SlashOption(
+            description="Turns the pool gets for every turn of a pool with weight 1, leave empty to keep.",
+            min_value=1,
+            max_value=100,
+            required=False,
+            default=None,
+        ),
+    ) -> None:
+        if(inter.user.id == 770715610464124969):
+
+            if pool_name not in self.pools:
+                await inter.error(f"Pool `{pool_name}` does not exist.")
+                return
+
+            budget = self.pools[pool_name].budget
+            if rate is not None:
+                budget.rate = rate or None
+            if concurrency is not None:
+                budget.concurrency = concurrency or None
+            if queue is not None:
+                budget.queue = queue or None
+            if weight is not None:
+                budget.weight = weight
+            await self.save_pool(pool_name)
+            await inter.success(
+                f"Budget of pool `{pool_name}`: {self.describe_budget(pool_name)}.", ephemeral=True
+            )
+
+        else:
+            await inter.error("This command is reserved for Admins.")
+
+    @slash_command(
+        name="pool_budget", description="Show the budgets of the relay pools and what they use of them."
+    )
+    async def pool_budget(
+        self,
+        inter: CustomInteraction,
+        pool_name: Optional[str] = SlashOption(
+            description="The pool to show, leave empty for every pool.",
+            required=False,
+            default=None,
+        ),
+    ) -> None:
+        if(inter.user.id == 770715610464124969):
+
+            if pool_name is not None and pool_name not in self.pools:
+                await inter.error(f"Pool `{pool_name}` does not exist.")
+                return
+
+            rows = [pool_name] if pool_name is not None else sorted(self.pools)
+            if not rows:
+                await inter.error("No relay pools found.")
+                return
+
+            # Usage changes all the time, it's read for the rows shown
+            source = TablePageSource(
+                rows,
+                ["Pool", "Rate/s", "Concurrency", "Queue", "Weight", "In Flight", "Queued", "Exhausted"],
+                self.budget_row,
+            )
+            await ReportMenu(source).start_interaction(inter, ephemeral=True)
+
+        else:
+            await inter.error("This command is reserved for Admins.")
+
+    def describe_budget(self, pool_name: str) -> str:
+        """The limits of a pool's budget, for command responses."""
+        budget = self.budget_of(pool_name)
+        limits = [
+            f"`{budget.rate:g}` requests/s" if budget.rate is not None else "no rate limit",
+            f"`{budget.concurrency}` requests in flight" if budget.concurrency is not None else "no concurrency limit",
+            f"queue of `{self.ingest.limit(pool_name)}` events",
+            f"weight `{budget.weight}`",
+        ]
+        return ", ".join(limits)
+
+    def budget_row(self, pool_name: str) -> List[Any]:
+        """A pool's budget and its current use, as a row of the budget report."""
+        budget = self.budget_of(pool_name)
+        scheduler = self.bot.scheduler
+        share = scheduler.shares.get(pool_name)
+        exhausted = {quota: n for (name, quota), n in scheduler.exhausted.items() if name == pool_name}
+        if self.ingest.dropped[pool_name]:
+            exhausted["queue"] = self.ingest.dropped[pool_name]
+        return [
+            pool_name,
+            f"{budget.rate:g}" if budget.rate is not None else "-",
+            budget.concurrency if budget.concurrency is not None else "-",
+            self.ingest.limit(pool_name),
+            budget.weight,
+            share.in_flight if share is not None else 0,
+            scheduler.depths().get(pool_name, 0) + len(self.ingest.queues.get(pool_name, ())),
+            " ".join(f"{quota}:{n}" for quota, n in sorted(exhausted.items())) or "-",
+        ]
+
     @slash_command(name="add_to_pool", description="Add a channel to the relay pool.")
     async def add_to_pool(
             self,
@@ -230,15 +1278,13 @@ class Relay(commands.Cog):
             if not channel:
                 channel = inter.channel
 
-            guild_id = str(channel.guild.id)
-
             if pool_name not in self.pools:
-                self.pools[pool_name] = {"password": password, "servers": {}}
-                await self.save_pools()
+                self.pools[pool_name] = Pool(pool_name, password=password)
+                await self.save_pool(pool_name)
                 await inter.success(f"Pool `{pool_name}` created.", ephemeral=True)
 
-            pool_data = self.pools[pool_name]
-            pool_password = pool_data.get("password", None)
+            pool = self.pools[pool_name]
+            pool_password = pool.password
 
             if pool_password is not None and pool_password != password:
                 if password:
@@ -247,12 +1293,10 @@ class Relay(commands.Cog):
                     await inter.error(f"This pool requires a password.")
                 return
 
-            # Initialize the guild in the pool if it does not exist
-            if guild_id not in pool_data["servers"]:
-                pool_data["servers"][guild_id] = {"channels": [], "message_count": 0}
-
-            pool_data["servers"][guild_id]["channels"].append(channel.id)
-            await self.save_pools()
+            # Joins the guild to the pool if it isn't in it yet
+            pool.add_channel(channel.guild.id, channel.id)
+            self.routes.update_pool(pool_name, pool)
+            await self.save_pool(pool_name)
             await inter.success(
                 f"Channel {channel.mention} added to the `{pool_name}` pool.",
                 ephemeral=True,
@@ -284,13 +1328,11 @@ class Relay(commands.Cog):
                 await inter.error(f"Pool `{pool_name}` does not exist.")
                 return
 
-            guild_id = str(channel.guild.id)
+            guild_id = channel.guild.id
 
-            if guild_id not in self.pools[pool_name]["servers"] or channel.id not in \
-                    self.pools[pool_name]["servers"][guild_id]["channels"]:
+            if not self.pools[pool_name].has_channel(guild_id, channel.id):
                 # Find pools the channel is in
-                pools = [pool for pool, pool_data in self.pools.items() if
-                        channel.id in pool_data["servers"].get(guild_id, {}).get("channels", [])]
+                pools = [name for name, pool in self.pools.items() if pool.has_channel(guild_id, channel.id)]
                 if pools:
                     pools_str = "`, `".join(pools)
                     await inter.error(
@@ -301,8 +1343,9 @@ class Relay(commands.Cog):
                     await inter.error(f"Channel {channel.mention} is not in any pool.")
                 return
 
-            self.pools[pool_name]["servers"][guild_id]["channels"].remove(channel.id)
-            await self.save_pools()
+            self.pools[pool_name].remove_channel(guild_id, channel.id)
+            self.routes.update_pool(pool_name, self.pools[pool_name])
+            await self.save_pool(pool_name)
             await inter.success(f"Channel {channel.mention} removed from the `{pool_name}` pool.", ephemeral=True)
 
         else:
@@ -317,22 +1360,18 @@ class Relay(commands.Cog):
     async def list_pools(self, inter: CustomInteraction) -> None:
 
         if(inter.user.id == 770715610464124969):
-            table_data = []
-
-            for pool_name, pool_data in self.pools.items():
-                for guild_id, server_data in pool_data["servers"].items():
-                    for channel_id in server_data["channels"]:
-                        channel = self.bot.get_channel(channel_id)
-                        if channel:
-                            guild = channel.guild
-                            table_data.append([pool_name, guild.name, "#" + channel.name])
+            rows = self.snapshot.refresh(self.routes.version, self.pools).channels
 
-            if not table_data:
+            if not rows:
                 await inter.error("No relay pools found.")
                 return
 
-            table = tabulate(table_data, headers=["Pool", "Server", "Channel"])
-            await inter.send(f"```\n{table}\n```")
+            source = TablePageSource(
+                rows,
+                ["Pool", "Server", "Channel"],
+                lambda row: [row[0], self.guild_name(row[1]), self.channel_name(row[2])],
+            )
+            await ReportMenu(source).start_interaction(inter)
 
         else:
             await inter.error("This command is reserved for Admins.")
@@ -341,31 +1380,76 @@ class Relay(commands.Cog):
 
 
 
+    def guild_name(self, guild_id: int) -> str:
+        """Name of a server, or its ID if it's on another process' shards."""
+        guild = self.bot.get_guild(guild_id)
+        return guild.name if guild else str(guild_id)
+
+    def channel_name(self, channel_id: int) -> str:
+        """Name of a channel, or its ID if it's on another process' shards."""
+        channel = self.bot.get_channel(channel_id)
+        return "#" + channel.name if channel else str(channel_id)
+
+    def message_count(self, pool_name: str, guild_id: int) -> int:
+        """Messages relayed from a server in a pool since it joined, 0 if it left since."""
+        pool = self.pools.get(pool_name)
+        membership = pool.servers.get(guild_id) if pool is not None else None
+        return membership.message_count if membership is not None else 0
+
     @slash_command(
         name="pool_analytics", description="Display analytics for relay pools."
     )
-    async def pool_analytics(self, inter: CustomInteraction) -> None:
+    async def pool_analytics(
+        self,
+        inter: CustomInteraction,
+        window: str = SlashOption(
+            description="The time window to show analytics for.",
+            choices=ANALYTICS_WINDOWS,
+            required=False,
+            default="all",
+        ),
+    ) -> None:
 
         if(inter.user.id == 770715610464124969):
-            table_data = []
-
-            for pool_name, pool_data in self.pools.items():
-                servers = pool_data["servers"]
-                for guild_id, server_data in servers.items():
-                    guild = self.bot.get_guild(int(guild_id))
-                    if guild:
-                        table_data.append(
-                            [pool_name, guild.name, server_data["message_count"]]
-                        )
-
-            if table_data:
-                table = tabulate(table_data, headers=["Pool", "Server", "Message Count"])
-                await inter.send(f"```\n{table}\n```")
+            if window == "all":
+                # Counts change with every message, they're read for the rows shown
+                rows = self.snapshot.refresh(self.routes.version, self.pools).servers
+                render = lambda row: [row[0], self.guild_name(row[1]), self.message_count(*row)]
+            else:
+                await inter.response.defer()
+                summary = await self.analytics.summary(parse_window(window))
+                rows = list(summary[["pool", "guild_id", "messages"]].itertuples(index=False))
+                render = lambda row: [row[0], self.guild_name(int(row[1])), row[2]]
+
+            if rows:
+                source = TablePageSource(rows, ["Pool", "Server", "Message Count"], render)
+                await ReportMenu(source).start_interaction(inter)
             else:
                 await inter.error("No analytics available.")
         else: 
             await inter.error("This command is reserved for Admins.")            
 
+    @slash_command(
+        name="export_analytics", description="Export relay pool analytics to a spreadsheet."
+    )
+    async def export_analytics(
+        self,
+        inter: CustomInteraction,
+        window: str = SlashOption(
+            description="The time window to export.",
+            choices=ANALYTICS_WINDOWS,
+            required=False,
+            default="all",
+        ),
+    ) -> None:
+
+        if(inter.user.id == 770715610464124969):
+            await inter.response.defer(ephemeral=True)
+            workbook = await self.analytics.export(parse_window(window))
+            await inter.send(file=File(workbook, filename="pool_analytics.xlsx"), ephemeral=True)
+        else:
+            await inter.error("This command is reserved for Admins.")
+
 
 
 def setup(bot):
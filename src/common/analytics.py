@@ -0,0 +1,280 @@
+from asyncio import get_running_loop
+from collections import Counter
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.common.common import *
+
+# How often, in seconds, buffered relay events are written to the database
+ANALYTICS_FLUSH_INTERVAL: float = 30.0
+
+# Events per document of the relay_events collection, far below MongoDB's 16 MB document limit
+MAX_EVENTS_PER_DOCUMENT: int = 1000
+
+# Events kept at most for flushes that failed, the oldest are dropped beyond this
+MAX_PENDING_EVENTS: int = 100000
+
+# Flush IDs remembered per rollup, a failed flush is retried long before this many newer ones
+ROLLUP_FLUSH_HISTORY: int = 64
+
+# MongoDB's duplicate key error, a write of a retried flush that already went through
+DUPLICATE_KEY: int = 11000
+
+# Windows longer than this are answered from the daily rollups instead of the hourly ones
+HOURLY_WINDOW_LIMIT: timedelta = timedelta(days=2)
+
+# Time windows offered by the analytics commands
+ANALYTICS_WINDOWS: Dict[str, str] = {
+    "Last 24 hours": "24h",
+    "Last 7 days": "7d",
+    "Last 30 days": "30d",
+    "All time": "all",
+}
+
+ROLLUP_COLUMNS: List[str] = ["pool", "guild_id", "channel_id", "start", "messages", "deliveries"]
+
+
+def parse_window(window: str) -> Optional[timedelta]:
+    """Turn a window like "24h" or "7d" into a timedelta, "all" into None."""
+    if window == "all":
+        return None
+    amount, unit = int(window[:-1]), window[-1]
+    return timedelta(hours=amount) if unit == "h" else timedelta(days=amount)
+
+
+def hour_of(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def day_of(timestamp: datetime) -> datetime:
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class AnalyticsFlush:
+    """
+    The writes of one flush, kept until they went through.
+
+    Every write is idempotent, so a flush that failed halfway is simply retried:
+    event documents have IDs derived from the flush ID, and a rollup only takes
+    the ``$inc`` of a flush whose ID it hasn't recorded yet.
+    """
+
+    __slots__ = ("flush_id", "count", "documents", "rollups")
+
+    def __init__(self, flush_id: str, count: int, documents: List[Dict[str, Any]], rollups: List[UpdateOne]) -> None:
+        self.flush_id: str = flush_id
+        self.count: int = count
+        self.documents: List[Dict[str, Any]] = documents
+        self.rollups: List[UpdateOne] = rollups
+
+
+def failed_writes(e: BulkWriteError, requests: List[Any]) -> List[Any]:
+    """The requests of an unordered bulk write that failed, except the ones that had already been applied."""
+    return [
+        requests[error["index"]] for error in e.details.get("writeErrors", ()) if error.get("code") != DUPLICATE_KEY
+    ]
+
+
+class RelayAnalytics:
+    """
+    Time-series analytics of relayed messages.
+
+    :meth:`record` only appends to an in-memory buffer, so the relay path never
+    waits on analytics. :meth:`flush` writes the buffer to the append-only
+    ``relay_events`` collection, as documents of at most
+    :data:`MAX_EVENTS_PER_DOCUMENT` events per pool and hour, then applies
+    ``$inc`` updates to the hourly and daily rollups in ``relay_rollups``, per
+    pool, server and channel. Flushes that fail are retried at the next one, up
+    to :data:`MAX_PENDING_EVENTS` events. Queries only read rollups, and the
+    pandas work runs in a thread.
+    """
+
+    def __init__(self) -> None:
+        self.events: List[Tuple[datetime, str, int, int, int]] = []
+        self.pending: List[AnalyticsFlush] = []
+        self.stats: Counter = Counter()
+
+    async def ensure_indexes(self) -> None:
+        """Create the rollup lookup index."""
+        await db.relay_rollups.create_index([("granularity", ASCENDING), ("start", ASCENDING)])
+
+    def record(self, pool_name: str, guild_id: int, channel_id: int, deliveries: int) -> None:
+        """
+        Buffer a relayed message until the next flush.
+
+        :param pool_name: The name of the pool the message was relayed through.
+        :param guild_id: The ID of the server that sent the message.
+        :param channel_id: The ID of the channel that sent the message.
+        :param deliveries: The number of channels the message was delivered to.
+        """
+        self.events.append((datetime.utcnow(), pool_name, guild_id, channel_id, deliveries))
+
+    @staticmethod
+    def prepare(events: List[Tuple[datetime, str, int, int, int]]) -> AnalyticsFlush:
+        """Build the event documents and rollup updates of buffered events."""
+        flush_id = str(ObjectId())
+
+        buckets: Dict[Tuple[str, datetime], List[List[int]]] = {}
+        rollups: Dict[Tuple[str, str, int, int, datetime], List[int]] = {}
+        for timestamp, pool_name, guild_id, channel_id, deliveries in events:
+            hour = hour_of(timestamp)
+            buckets.setdefault((pool_name, hour), []).append(
+                [int((timestamp - hour).total_seconds() * 1000), guild_id, channel_id, deliveries]
+            )
+            for granularity, start in (("hour", hour), ("day", day_of(timestamp))):
+                totals = rollups.setdefault(
+                    (granularity, pool_name, guild_id, channel_id, start), [0, 0]
+                )
+                totals[0] += 1
+                totals[1] += deliveries
+
+        documents = [
+            {
+                "_id": f"{pool_name}|{hour.isoformat()}|{flush_id}|{index}",
+                "pool": pool_name,
+                "start": hour,
+                "count": len(bucket[index:index + MAX_EVENTS_PER_DOCUMENT]),
+                "events": bucket[index:index + MAX_EVENTS_PER_DOCUMENT],
+            }
+            for (pool_name, hour), bucket in buckets.items()
+            for index in range(0, len(bucket), MAX_EVENTS_PER_DOCUMENT)
+        ]
+        updates = [
+            UpdateOne(
+                {
+                    "_id": f"{granularity}|{pool_name}|{guild_id}|{channel_id}|{start.isoformat()}",
+                    "flushes": {"$ne": flush_id},
+                },
+                {
+                    "$setOnInsert": {
+                        "granularity": granularity,
+                        "pool": pool_name,
+                        "guild_id": guild_id,
+                        "channel_id": channel_id,
+                        "start": start,
+                    },
+                    "$inc": {"messages": messages, "deliveries": deliveries},
+                    "$push": {"flushes": {"$each": [flush_id], "$slice": -ROLLUP_FLUSH_HISTORY}},
+                },
+                upsert=True,
+            )
+            for (granularity, pool_name, guild_id, channel_id, start), (messages, deliveries)
+            in rollups.items()
+        ]
+        return AnalyticsFlush(flush_id, len(events), documents, updates)
+
+    async def flush(self) -> None:
+        """Write the buffered events and their rollups to the database, retrying failed flushes first."""
+        if self.events:
+            events, self.events = self.events, []
+            self.pending.append(self.prepare(events))
+
+        # Failed flushes aren't kept forever while the database is down
+        while sum(pending.count for pending in self.pending) > MAX_PENDING_EVENTS:
+            dropped = self.pending.pop(0)
+            self.stats["dropped"] += dropped.count
+            print(f"Dropped {dropped.count} analytics events that couldn't be written")
+
+        while self.pending:
+            pending = self.pending[0]
+            try:
+                await self.write(pending)
+            except Exception:
+                self.stats["failed"] += 1
+                raise
+            self.pending.pop(0)
+            self.stats["written"] += pending.count
+
+    async def write(self, pending: AnalyticsFlush) -> None:
+        """
+        Write the events, then the rollups of a flush.
+
+        Writes that went through are removed from the flush, so a retry only repeats the ones that failed.
+        """
+        if pending.documents:
+            try:
+                await db.relay_events.insert_many(pending.documents, ordered=False)
+            except BulkWriteError as e:
+                pending.documents = failed_writes(e, pending.documents)
+                if pending.documents:
+                    raise
+            pending.documents = []
+
+        if pending.rollups:
+            try:
+                await db.relay_rollups.bulk_write(pending.rollups, ordered=False)
+            except BulkWriteError as e:
+                pending.rollups = failed_writes(e, pending.rollups)
+                if pending.rollups:
+                    raise
+            pending.rollups = []
+
+    async def rollups(self, window: Optional[timedelta] = None) -> pd.DataFrame:
+        """
+        Load the rollups covering a time window.
+
+        :param window: How far back to look, or None for the full history.
+        :return: One row per pool, server, channel and period.
+        """
+        if window is not None and window <= HOURLY_WINDOW_LIMIT:
+            query = {"granularity": "hour", "start": {"$gte": hour_of(datetime.utcnow() - window)}}
+        elif window is not None:
+            query = {"granularity": "day", "start": {"$gte": day_of(datetime.utcnow() - window)}}
+        else:
+            query = {"granularity": "day"}
+
+        documents = await db.relay_rollups.find(query).to_list(None)
+        return await get_running_loop().run_in_executor(None, self.to_frame, documents)
+
+    @staticmethod
+    def to_frame(documents: List[Dict[str, Any]]) -> pd.DataFrame:
+        frame = pd.DataFrame(documents, columns=ROLLUP_COLUMNS)
+        frame["messages"] = frame["messages"].astype(np.int64)
+        frame["deliveries"] = frame["deliveries"].astype(np.int64)
+        return frame
+
+    async def summary(self, window: Optional[timedelta] = None) -> pd.DataFrame:
+        """
+        Total messages and deliveries per pool and server over a time window.
+
+        :param window: How far back to look, or None for the full history.
+        :return: One row per pool and server, by pool and busiest server first.
+        """
+        frame = await self.rollups(window)
+        return await get_running_loop().run_in_executor(None, self.summarize, frame)
+
+    @staticmethod
+    def summarize(frame: pd.DataFrame) -> pd.DataFrame:
+        return (
+            frame.groupby(["pool", "guild_id"], as_index=False)[["messages", "deliveries"]]
+            .sum()
+            .sort_values(["pool", "messages"], ascending=[True, False])
+        )
+
+    async def export(self, window: Optional[timedelta] = None) -> BytesIO:
+        """
+        Export the rollups of a time window to an xlsx workbook.
+
+        :param window: How far back to look, or None for the full history.
+        :return: The workbook, ready to be sent as a file.
+        """
+        frame = await self.rollups(window)
+        return await get_running_loop().run_in_executor(None, self.to_xlsx, frame)
+
+    @classmethod
+    def to_xlsx(cls, frame: pd.DataFrame) -> BytesIO:
+        buffer = BytesIO()
+        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+            cls.summarize(frame).to_excel(writer, sheet_name="Summary", index=False)
+            frame.pivot_table(
+                index="start", columns="pool", values="messages", aggfunc="sum", fill_value=0
+            ).to_excel(writer, sheet_name="Messages per pool")
+            frame.sort_values("start").to_excel(writer, sheet_name="Rollups", index=False)
+        buffer.seek(0)
+        return buffer
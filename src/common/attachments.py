@@ -0,0 +1,109 @@
+from asyncio import gather
+from io import BytesIO
+
+from nextcord import Attachment, File
+
+from src.common.common import *
+
+# Attachments above this size are relayed as links instead of being re-uploaded
+MAX_ATTACHMENT_SIZE: int = 8 * 1024 * 1024
+
+# Discord rejects message content longer than this
+MAX_CONTENT_LENGTH: int = 2000
+
+
+class BufferedAttachment:
+    """The bytes of an attachment, downloaded once and shared by every destination."""
+
+    __slots__ = ("filename", "description", "spoiler", "data")
+
+    def __init__(self, attachment: Attachment, data: bytes) -> None:
+        self.filename: str = attachment.filename
+        self.description: Optional[str] = attachment.description
+        self.spoiler: bool = attachment.is_spoiler()
+        self.data: bytes = data
+
+    def to_file(self) -> File:
+        """Create a new File over the shared bytes, without copying them."""
+        return File(
+            BytesIO(self.data),
+            filename=self.filename,
+            description=self.description,
+            spoiler=self.spoiler,
+        )
+
+
+class RelayAttachments:
+    """
+    The attachments of a source message, prepared once for the whole fan-out.
+
+    Attachments up to ``max_size`` are downloaded into memory and every send gets its
+    own cheap File view over the same bytes. Larger attachments, and any that fail to
+    download, fall back to being relayed as links.
+    """
+
+    def __init__(self, buffers: List[BufferedAttachment], links: List[str]) -> None:
+        self.buffers: List[BufferedAttachment] = buffers
+        self.links: List[str] = links
+
+    @classmethod
+    async def download(
+        cls, attachments: List[Attachment], max_size: int = MAX_ATTACHMENT_SIZE
+    ) -> "RelayAttachments":
+        """
+        Download the attachments of a message.
+
+        :param attachments: The attachments of the source message.
+        :param max_size: The largest attachment, in bytes, that is re-uploaded.
+        :return: The buffered attachments and link fallbacks.
+        """
+        buffered = [attachment for attachment in attachments if attachment.size <= max_size]
+        links = [attachment.url for attachment in attachments if attachment.size > max_size]
+
+        results = await gather(
+            *(attachment.read() for attachment in buffered), return_exceptions=True
+        )
+
+        buffers = []
+        for attachment, data in zip(buffered, results):
+            if isinstance(data, Exception):
+                links.append(attachment.url)
+            else:
+                buffers.append(BufferedAttachment(attachment, data))
+
+        return cls(buffers, links)
+
+    def files(self) -> List[File]:
+        """Create the files for a single send."""
+        return [buffer.to_file() for buffer in self.buffers]
+
+    def content(self, content: str, max_length: int = MAX_CONTENT_LENGTH) -> str:
+        """
+        Append the link fallbacks to the message content, within Discord's length limit.
+
+        The text is shortened first so every link that fits is kept, links that
+        don't fit even without any text are left out.
+
+        :param content: The content of the source message.
+        :param max_length: The longest content Discord accepts.
+        :return: The content to send.
+        """
+        if not self.links:
+            return content
+
+        links: List[str] = []
+        length = 0
+        for link in self.links:
+            if length + len(link) + (1 if links else 0) > max_length:
+                break
+            length += len(link) + (1 if links else 0)
+            links.append(link)
+        if not links:
+            return content
+
+        room = max_length - length - 1
+        if not content or room <= 0:
+            return "\n".join(links)
+        if len(content) > room:
+            content = content[:room - 1] + "…"
+        return "\n".join([content, *links])
@@ -0,0 +1,245 @@
+import gzip
+from asyncio import Lock, Task, get_running_loop, sleep
+from collections import Counter
+from hashlib import blake2b
+from os import open as open_descriptor, urandom
+from os.path import splitext
+from time import monotonic, time
+
+import orjson
+from nextcord import Emoji, Message, PartialEmoji
+
+from src.common.common import *
+from src.common.models import Pool
+
+# Version of the capture format, written in the header of every file
+CAPTURE_FORMAT: int = 1
+
+# Seconds between two writes of the buffered events to the capture file
+CAPTURE_FLUSH_INTERVAL: float = 5.0
+
+# Events buffered at most, newer events are dropped while the file can't keep up
+MAX_CAPTURE_BUFFER: int = 100000
+
+# Anonymized IDs stay positive signed 64-bit integers, like Discord IDs in MongoDB
+ANONYMOUS_ID_MASK: int = (1 << 63) - 1
+
+
+def capture_path(path: str, cluster_id: int) -> str:
+    """
+    The capture file of one process, ``traffic.jsonl.gz`` becomes ``traffic.2.jsonl.gz`` for cluster 2.
+
+    :param path: The capture file given on the command line.
+    :param cluster_id: The index of the process.
+    """
+    stem, extension = splitext(path)
+    if extension == ".gz":
+        stem, inner = splitext(stem)
+        extension = inner + extension
+    return f"{stem}.{cluster_id}{extension}"
+
+
+def load_capture_key(path: str) -> bytes:
+    """
+    The anonymization key of a capture, kept next to it in ``<path>.key``.
+
+    Capture files are appended to across restarts, so every run has to hash
+    IDs with the same key for the segments to match. The key is created on
+    first use, readable by its owner only. It must stay private, with it the
+    hashes of known IDs can be recomputed.
+
+    :param path: The capture file given on the command line.
+    :return: The stored key, or a new one.
+    """
+    key_path = f"{path}.key"
+    try:
+        with open(key_path, "rb") as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+
+    key = urandom(16)
+    with open(key_path, "xb", opener=lambda name, flags: open_descriptor(name, flags, 0o600)) as file:
+        file.write(key)
+    return key
+
+
+class TrafficCapture:
+    """
+    Records the gateway events the relay acts on, for replay with ``python -m bench.replay``.
+
+    Events are written as gzipped JSON lines: a header, then one line per
+    event with its time in seconds since the header's wall clock start time. IDs are replaced
+    by keyed hashes, so the same user, channel or message keeps the same ID
+    within a capture while the real IDs can't be recovered without the key.
+    The bot and the launcher store the key next to the capture in
+    ``<path>.key``, readable by its owner only, so it survives restarts, see
+    :func:`load_capture_key`. Anyone who can read that file can link the
+    hashed IDs back to known ones. Message text is reduced to its length and
+    attachments to their sizes. The pools are recorded the same way whenever
+    their channels change.
+
+    Lines are buffered and written from the default executor every
+    ``interval`` seconds, so the event loop never waits for the disk.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        key: Optional[bytes] = None,
+        interval: float = CAPTURE_FLUSH_INTERVAL,
+        max_buffer: int = MAX_CAPTURE_BUFFER,
+    ) -> None:
+        """
+        :param path: The file to write, appended to if it exists, e.g. after a restart.
+        :param key: The anonymization key, random by default. Processes and runs
+            capturing to the same files share one, see :func:`load_capture_key`.
+        :param interval: Seconds between two writes to the file.
+        :param max_buffer: Events buffered at most.
+        """
+        self.path: str = path
+        self.key: bytes = key or urandom(16)
+        self.interval: float = interval
+        self.max_buffer: int = max_buffer
+        self.file: Optional[gzip.GzipFile] = None
+        self.buffer: List[bytes] = []
+        self.started: float = monotonic()
+        self.version: int = -1
+        self.lock: Lock = Lock()
+        self.task: Optional[Task] = None
+        self.stats: Counter = Counter()
+
+    def start(self) -> None:
+        """Open the file and start writing, once."""
+        if self.task is not None:
+            return
+        self.file = gzip.open(self.path, "ab", compresslevel=6)
+        self.started = monotonic()
+        self.buffer.insert(
+            0, orjson.dumps({"e": "header", "format": CAPTURE_FORMAT, "started": time()}) + b"\n"
+        )
+        self.task = get_running_loop().create_task(self.run())
+
+    def anonymize(self, snowflake: Optional[int]) -> Optional[int]:
+        """Replace an ID with its keyed hash, None stays None."""
+        if snowflake is None:
+            return None
+        digest = blake2b(snowflake.to_bytes(8, "little"), key=self.key, digest_size=8).digest()
+        return int.from_bytes(digest, "little") & ANONYMOUS_ID_MASK
+
+    def anonymize_name(self, name: str) -> str:
+        """Replace a pool name with its keyed hash."""
+        return "pool-" + blake2b(name.encode(), key=self.key, digest_size=6).hexdigest()
+
+    def anonymize_emoji(self, emoji: Union[Emoji, PartialEmoji, str]) -> str:
+        """Unicode emoji are kept, custom emoji get an anonymized ID and no name."""
+        emoji_id = getattr(emoji, "id", None)
+        if emoji_id is None:
+            return str(emoji)
+        return f"<{'a' if getattr(emoji, 'animated', False) else ''}:_:{self.anonymize(emoji_id)}>"
+
+    def record(self, event: str, at: Optional[float] = None, **fields: Any) -> None:
+        """
+        Buffer one event.
+
+        :param event: The kind of event.
+        :param at: When the event was received, as ``time.monotonic()``, now by default.
+        :param fields: The anonymized fields of the event.
+        """
+        if self.task is None:
+            return
+        if len(self.buffer) >= self.max_buffer:
+            self.stats["dropped"] += 1
+            return
+        fields["e"] = event
+        fields["t"] = round((monotonic() if at is None else at) - self.started, 3)
+        self.buffer.append(orjson.dumps(fields) + b"\n")
+        self.stats[event] += 1
+
+    def pools(self, version: int, pools: Dict[str, Pool]) -> None:
+        """
+        Record the pools, if their channels changed since they were last recorded.
+
+        :param version: The version of the routing index.
+        :param pools: The pools, as stored on the Relay cog.
+        """
+        if version == self.version:
+            return
+        self.version = version
+        self.record(
+            "pools",
+            pools={
+                self.anonymize_name(name): {
+                    "moderation": pool.moderation,
+                    "coalesce": pool.coalesce,
+                    "budget": pool.budget.to_document(),
+                    "servers": {
+                        str(self.anonymize(guild_id)): [self.anonymize(c) for c in membership.channels]
+                        for guild_id, membership in pool.servers.items()
+                    },
+                }
+                for name, pool in pools.items()
+            },
+        )
+
+    def message(self, message: Message) -> None:
+        """Record a message the relay received."""
+        self.record(
+            "message",
+            id=self.anonymize(message.id),
+            channel=self.anonymize(message.channel.id),
+            author=self.anonymize(message.author.id),
+            length=len(message.content),
+            attachments=[attachment.size for attachment in message.attachments],
+        )
+
+    def reaction(self, event: str, payload: Any, source_id: int, at: Optional[float] = None) -> None:
+        """
+        Record a reaction event on a relayed message.
+
+        :param event: ``reaction_add``, ``reaction_remove`` or ``reaction_clear``.
+        :param payload: The raw reaction event.
+        :param source_id: The ID of the source message of the relay group, so
+            reactions on relayed copies can be replayed on the replayed copies.
+        :param at: When the event was received, as ``time.monotonic()``.
+        """
+        emoji = getattr(payload, "emoji", None)
+        self.record(
+            event,
+            at,
+            message=self.anonymize(payload.message_id),
+            source=self.anonymize(source_id),
+            channel=self.anonymize(payload.channel_id),
+            user=self.anonymize(getattr(payload, "user_id", None)),
+            emoji=None if emoji is None else self.anonymize_emoji(emoji),
+        )
+
+    async def run(self) -> None:
+        while True:
+            await sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error writing traffic capture: {e}")
+
+    async def flush(self) -> None:
+        """Write the buffered events to the file."""
+        async with self.lock:
+            if not self.buffer or self.file is None:
+                return
+            data, self.buffer = b"".join(self.buffer), []
+            await get_running_loop().run_in_executor(None, self.write, data)
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+        # Keep what was captured so far readable if the process is killed
+        self.file.flush()
+
+    async def close(self) -> None:
+        """Write the remaining events and close the file."""
+        if self.task is None:
+            return
+        self.task.cancel()
+        await self.flush()
+        await get_running_loop().run_in_executor(None, self.file.close)
+        print(f"Captured {sum(n for e, n in self.stats.items() if e != 'dropped')} events to {self.path}")
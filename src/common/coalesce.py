@@ -0,0 +1,129 @@
+from asyncio import Task, TimerHandle, gather, get_running_loop
+from collections import Counter, deque
+from time import monotonic
+
+from src.common.common import *
+
+# Seconds messages for a busy destination are collected before they're sent as one
+COALESCE_WINDOW: float = 1.0
+
+# Seconds of traffic the send rate to a destination is measured over
+RATE_WINDOW: float = 5.0
+
+# Discord allows 10 embeds per message and 6000 characters over all of them
+MAX_BATCH_EMBEDS: int = 10
+MAX_BATCH_CHARACTERS: int = 5800
+
+# A busy destination goes back to 1:1 relaying once its rate drops below this share of the threshold
+COOLDOWN_RATIO: float = 0.5
+
+
+class Coalescer:
+    """
+    Merges the messages relayed to busy destinations into batches.
+
+    :meth:`select` measures how many messages per second each destination of a
+    pool receives. Above the pool's threshold a destination is busy: its
+    messages are :meth:`add`-ed to a buffer and sent by ``send`` as one webhook
+    message every ``window`` seconds, one embed per message with its author.
+    Once the rate drops below half the threshold the destination goes back to
+    1:1 relaying, so a short burst doesn't flip the mode back and forth.
+    Buffered messages keep the ID of their source message, so ``send`` can
+    settle their journaled deliveries.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, int, List[Tuple[int, Dict[str, Any]]]], Awaitable[Any]],
+        window: float = COALESCE_WINDOW,
+    ) -> None:
+        self.send = send
+        self.window: float = window
+        self.arrivals: Dict[int, Deque[float]] = {}
+        self.busy: Set[int] = set()
+        self.buffers: Dict[Tuple[str, int], List[Tuple[int, Dict[str, Any]]]] = {}
+        self.timers: Dict[Tuple[str, int], TimerHandle] = {}
+        self.tasks: Set[Task] = set()
+        self.stats: Counter = Counter()
+
+    def select(self, destinations: Iterable[int], threshold: float) -> Set[int]:
+        """
+        Record a message for every destination and pick the ones that are busy.
+
+        :param destinations: The IDs of the destination channels.
+        :param threshold: Messages per second from which a destination is busy.
+        :return: The IDs of the destinations the message should be batched for.
+        """
+        now = monotonic()
+        busy = set()
+        for channel_id in destinations:
+            arrivals = self.arrivals.setdefault(channel_id, deque())
+            arrivals.append(now)
+            while arrivals[0] < now - RATE_WINDOW:
+                arrivals.popleft()
+
+            rate = len(arrivals) / RATE_WINDOW
+            if rate >= threshold:
+                self.busy.add(channel_id)
+            elif rate < threshold * COOLDOWN_RATIO:
+                self.busy.discard(channel_id)
+
+            if channel_id in self.busy:
+                busy.add(channel_id)
+        return busy
+
+    def add(self, pool_name: str, channel_id: int, message_id: int, payload: Dict[str, Any]) -> None:
+        """
+        Buffer a message for a busy destination.
+
+        :param pool_name: The name of the pool the message is relayed through.
+        :param channel_id: The ID of the destination channel.
+        :param message_id: The ID of the source message.
+        :param payload: The webhook send arguments of the message.
+        """
+        key = (pool_name, channel_id)
+        buffer = self.buffers.setdefault(key, [])
+
+        characters = sum(len(entry["content"]) + len(entry["username"]) for _, entry in buffer)
+        if buffer and characters + len(payload["content"]) + len(payload["username"]) > MAX_BATCH_CHARACTERS:
+            self.flush(key)
+            buffer = self.buffers.setdefault(key, [])
+
+        buffer.append((message_id, payload))
+        self.stats["messages"] += 1
+
+        if len(buffer) >= MAX_BATCH_EMBEDS:
+            self.flush(key)
+        elif key not in self.timers:
+            self.timers[key] = get_running_loop().call_later(self.window, self.flush, key)
+
+    def flush(self, key: Tuple[str, int]) -> None:
+        """Start sending the buffered messages of a destination as one batch."""
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self.buffers.pop(key, None)
+        if not batch:
+            return
+
+        self.stats["batches"] += 1
+        self.stats["saved"] += len(batch) - 1
+
+        task = get_running_loop().create_task(self.run(*key, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, pool_name: str, channel_id: int, batch: List[Tuple[int, Dict[str, Any]]]) -> None:
+        try:
+            await self.send(pool_name, channel_id, batch)
+        except Exception as e:
+            self.stats["failed"] += len(batch)
+            print(f"Error relaying batch of {len(batch)} messages to {channel_id}: {e}")
+
+    async def close(self) -> None:
+        """Send every buffered batch and wait for them."""
+        for key in list(self.buffers):
+            self.flush(key)
+        if self.tasks:
+            await gather(*self.tasks, return_exceptions=True)
@@ -13,7 +13,6 @@ from nextcord import (
     PartialInteractionMessage,
 )
 from nextcord.ext.commands import Context
-from requests import post
 
 DEFAULT_PREFIX: str = "!"
 
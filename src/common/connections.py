@@ -0,0 +1,75 @@
+from aiohttp import AsyncResolver, ClientSession, ClientTimeout, TCPConnector, TraceConfig
+
+from src.common.common import *
+
+# Open connections at most, shared by Discord REST, CDN downloads and any other call
+MAX_CONNECTIONS: int = 100
+
+# Open connections per host at most, above the send scheduler's requests in flight
+MAX_CONNECTIONS_PER_HOST: int = 32
+
+# Seconds resolved addresses are reused
+DNS_CACHE_TTL: int = 300
+
+# Seconds idle connections are kept open for the next request
+KEEPALIVE_TIMEOUT: float = 30.0
+
+# Total seconds an outbound call may take
+HTTP_TIMEOUT: float = 30.0
+
+
+def create_connector() -> TCPConnector:
+    """
+    Create the connection pool of the process, call it in the running event loop.
+
+    Host names are resolved with aiodns instead of the default resolver, which
+    blocks a thread of the executor per lookup, and cached for ``DNS_CACHE_TTL``.
+
+    :return: A connector keeping connections to every host alive between calls.
+    """
+    return TCPConnector(
+        limit=MAX_CONNECTIONS,
+        limit_per_host=MAX_CONNECTIONS_PER_HOST,
+        resolver=AsyncResolver(),
+        use_dns_cache=True,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+
+
+def create_session(connector: TCPConnector) -> ClientSession:
+    """
+    Create a client session over a shared connector.
+
+    :param connector: The connection pool, it stays open when the session is closed.
+    :return: The session to make outbound calls with.
+    """
+    return ClientSession(
+        connector=connector,
+        connector_owner=False,
+        timeout=ClientTimeout(total=HTTP_TIMEOUT),
+    )
+
+
+def create_response_trace(on_request_end: Callable[..., Awaitable[None]]) -> TraceConfig:
+    """
+    Create a trace config that sees every response of the sessions it's added to.
+
+    :param on_request_end: Called with the session, the trace context and the request end parameters.
+    :return: The frozen trace config.
+    """
+    trace = TraceConfig()
+    trace.on_request_end.append(on_request_end)
+    trace.freeze()
+    return trace
+
+
+def add_trace(session: ClientSession, trace: TraceConfig) -> None:
+    """
+    Add a trace config to a session created elsewhere, once.
+
+    :param session: The session, like nextcord's, which is created without trace configs.
+    :param trace: The trace config to add.
+    """
+    if trace not in session.trace_configs:
+        session.trace_configs.append(trace)
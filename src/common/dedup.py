@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from time import monotonic
+
+from src.common.common import *
+
+# Seconds a (message, destination) pair is remembered
+SEEN_WINDOW: float = 15 * 60.0
+
+# Pairs remembered at most, the oldest ones are forgotten first
+MAX_SEEN: int = 100000
+
+
+class SeenSet:
+    """
+    A bounded, time-windowed set of the (source message, destination channel) pairs relayed.
+
+    A destination is claimed right before a message is sent to it, so a message
+    delivered twice by the gateway, e.g. after a resume, or relayed through
+    several pools, reaches every channel once. Pairs are forgotten after
+    ``window`` seconds or once ``max_size`` newer pairs were claimed.
+    """
+
+    def __init__(self, window: float = SEEN_WINDOW, max_size: int = MAX_SEEN) -> None:
+        self.window: float = window
+        self.max_size: int = max_size
+        self.entries: OrderedDict[Tuple[int, int], float] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def claim(self, message_id: int, channel_id: int) -> bool:
+        """
+        Claim a destination for a message.
+
+        :param message_id: The ID of the source message.
+        :param channel_id: The ID of the destination channel.
+        :return: Whether the pair wasn't seen yet, False means it's a duplicate.
+        """
+        now = monotonic()
+        self.expire(now)
+
+        key = (message_id, channel_id)
+        if key in self.entries:
+            return False
+
+        self.entries[key] = now
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return True
+
+    def release(self, message_id: int, channel_id: int) -> None:
+        """Forget a claimed pair, e.g. after the send failed, so it can be retried."""
+        self.entries.pop((message_id, channel_id), None)
+
+    def expire(self, now: float) -> None:
+        """Forget the pairs that are older than the window."""
+        deadline = now - self.window
+        while self.entries:
+            key, claimed_at = next(iter(self.entries.items()))
+            if claimed_at > deadline:
+                break
+            del self.entries[key]
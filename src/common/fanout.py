@@ -0,0 +1,74 @@
+from asyncio import Semaphore, gather
+from time import perf_counter
+
+from src.common.common import *
+
+# Maximum number of destinations being prepared or queued at once per pool, across all
+# relayed messages, the send scheduler paces the actual requests
+DEFAULT_CONCURRENCY: int = 64
+
+
+class Delivery(NamedTuple):
+    """The outcome of sending a relayed message to one destination."""
+
+    channel_id: int
+    result: Any
+    error: Optional[Exception]
+    elapsed: float
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class FanOut:
+    """
+    Sends one relayed message to all of its destinations concurrently.
+
+    Every destination runs in its own task, so a failing or slow channel neither
+    aborts nor delays the others. A semaphore per pool caps the number of sends
+    in flight so large pools can't flood the HTTP client. Sends of a pool held
+    back by its budget wait in the scheduler while holding their slots, so the
+    slots aren't shared with other pools.
+    """
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY) -> None:
+        self.concurrency: int = concurrency
+        self.semaphores: Dict[str, Semaphore] = {}
+
+    async def deliver(
+        self, semaphore: Semaphore, channel_id: int, send: Callable[[int], Awaitable[Any]]
+    ) -> Delivery:
+        """
+        Run the send for a single destination, capturing its result or error.
+
+        :param semaphore: The semaphore of the pool the message is sent for.
+        :param channel_id: The ID of the destination channel.
+        :param send: The coroutine function sending the message to a channel ID.
+        :return: The delivery outcome, including how long the send took.
+        """
+        async with semaphore:
+            start = perf_counter()
+            try:
+                result = await send(channel_id)
+            except Exception as e:
+                return Delivery(channel_id, None, e, perf_counter() - start)
+            return Delivery(channel_id, result, None, perf_counter() - start)
+
+    async def run(
+        self, destinations: Iterable[int], send: Callable[[int], Awaitable[Any]], pool_name: str
+    ) -> List[Delivery]:
+        """
+        Send to every destination at once.
+
+        :param destinations: The IDs of the destination channels.
+        :param send: The coroutine function sending the message to a channel ID.
+        :param pool_name: The name of the pool the message is sent for.
+        :return: One delivery per destination, in destination order.
+        """
+        semaphore = self.semaphores.get(pool_name)
+        if semaphore is None:
+            semaphore = self.semaphores[pool_name] = Semaphore(self.concurrency)
+        return list(
+            await gather(*(self.deliver(semaphore, channel_id, send) for channel_id in destinations))
+        )
@@ -0,0 +1,183 @@
+from asyncio import Condition, Event, Queue, Task, TimeoutError, create_task, wait_for
+from collections import Counter, deque
+from time import monotonic
+
+from src.common.common import *
+from src.common.models import DEFAULT_BUDGET, Budget
+
+# Overflow policies of a full pool queue
+DROP_OLDEST: str = "drop_oldest"
+DROP_NEWEST: str = "drop_newest"
+BLOCK: str = "block"
+
+# Number of worker tasks draining the pool queues
+INGEST_WORKERS: int = 8
+
+# Maximum number of work items waiting per pool
+MAX_POOL_QUEUE: int = 200
+
+# How long a BLOCK enqueue waits for room before the item is dropped, in seconds
+BLOCK_TIMEOUT: float = 5.0
+
+# Items a worker processes from one pool before giving other pools a turn
+WORKER_BATCH: int = 16
+
+
+class WorkItem(NamedTuple):
+    """A lightweight gateway event waiting to be relayed."""
+
+    kind: str
+    payload: Any
+    enqueued_at: float
+
+
+class IngestPipeline:
+    """
+    Decouples gateway event handlers from relaying.
+
+    Listeners only :meth:`put` a work item in the bounded queue of its pool and
+    return. A fixed pool of worker tasks drains the queues: each pool is worked on
+    by at most one worker at a time, so items of a pool keep their order, while
+    different pools are relayed in parallel. When a pool queue is full, the
+    overflow policy either drops the oldest or the newest item, or blocks the
+    listener until there's room, dropping the item after ``block_timeout``.
+
+    The budget of a pool, looked up with ``budget_of``, can lower or raise its
+    queue size from ``max_queue``, and a worker processes up to its weight times
+    ``WORKER_BATCH`` items of a pool per turn.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str, WorkItem], Awaitable[Any]],
+        workers: int = INGEST_WORKERS,
+        max_queue: int = MAX_POOL_QUEUE,
+        policy: str = DROP_OLDEST,
+        block_timeout: float = BLOCK_TIMEOUT,
+        budget_of: Callable[[str], Budget] = lambda pool_name: DEFAULT_BUDGET,
+    ) -> None:
+        self.handler = handler
+        self.budget_of = budget_of
+        self.workers: int = workers
+        self.max_queue: int = max_queue
+        self.policy: str = policy
+        self.block_timeout: float = block_timeout
+        self.queues: Dict[str, Deque[WorkItem]] = {}
+        self.ready: Queue = Queue()
+        self.active: Set[str] = set()
+        self.room: Condition = Condition()
+        self.idle: Event = Event()
+        self.idle.set()
+        self.stats: Counter = Counter()
+        self.dropped: Counter = Counter()
+        # Called with every queued item dropped to make room for a newer one
+        self.on_drop: Callable[[str, WorkItem], Any] = lambda pool_name, item: None
+        self.tasks: List[Task] = []
+
+    def depths(self) -> Dict[str, int]:
+        """Return the number of queued items per pool."""
+        return {pool_name: len(queue) for pool_name, queue in self.queues.items() if queue}
+
+    def start(self) -> None:
+        """Start the worker tasks, if they aren't running yet."""
+        if not self.tasks:
+            self.tasks = [create_task(self.work()) for _ in range(self.workers)]
+
+    async def put(self, pool_name: str, kind: str, payload: Any) -> bool:
+        """
+        Queue a work item for a pool, applying the overflow policy when the queue is full.
+
+        :param pool_name: The name of the pool the item belongs to.
+        :param kind: The kind of work, used by the handler to dispatch it.
+        :param payload: The event to process.
+        :return: Whether the item was queued.
+        """
+        self.start()
+        queue = self.queues.setdefault(pool_name, deque())
+        limit = self.limit(pool_name)
+
+        if len(queue) >= limit:
+            if self.policy == DROP_NEWEST:
+                self.drop(pool_name)
+                return False
+            elif self.policy == DROP_OLDEST:
+                # More than one when the pool's queue limit was just lowered
+                while len(queue) >= limit:
+                    self.drop(pool_name)
+                    self.on_drop(pool_name, queue.popleft())
+            else:
+                try:
+                    async with self.room:
+                        await wait_for(
+                            self.room.wait_for(lambda: len(queue) < self.limit(pool_name)),
+                            self.block_timeout,
+                        )
+                except TimeoutError:
+                    self.drop(pool_name)
+                    return False
+                self.stats["blocked"] += 1
+
+        queue.append(WorkItem(kind, payload, monotonic()))
+        self.stats["enqueued"] += 1
+
+        # A pool already being worked on is picked up again by its worker
+        if len(queue) == 1 and pool_name not in self.active:
+            self.active.add(pool_name)
+            self.idle.clear()
+            self.ready.put_nowait(pool_name)
+
+        return True
+
+    def limit(self, pool_name: str) -> int:
+        """Return the number of items the queue of a pool holds at most."""
+        return self.budget_of(pool_name).queue or self.max_queue
+
+    async def join(self) -> None:
+        """Wait until every queued item has been processed."""
+        await self.idle.wait()
+
+    def drop(self, pool_name: str) -> None:
+        self.stats["dropped"] += 1
+        self.dropped[pool_name] += 1
+
+    async def work(self) -> None:
+        """Take ready pools in turn and process a batch of their items in order."""
+        while True:
+            pool_name = await self.ready.get()
+            queue = self.queues[pool_name]
+
+            for _ in range(WORKER_BATCH * self.budget_of(pool_name).weight):
+                if not queue:
+                    break
+                item = queue.popleft()
+                if self.policy == BLOCK:
+                    async with self.room:
+                        self.room.notify_all()
+                try:
+                    await self.handler(pool_name, item)
+                except Exception as e:
+                    print(f"Error processing {item.kind} for pool {pool_name}: {e}")
+                self.stats["processed"] += 1
+
+            # Go to the back of the line if there is more work, so other pools get a turn
+            if queue:
+                self.ready.put_nowait(pool_name)
+            else:
+                self.active.discard(pool_name)
+                if not self.active:
+                    self.idle.set()
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """
+        Give the workers some time to drain the queues, then stop them.
+
+        :param timeout: How long to wait for the queues to drain, in seconds.
+        """
+        try:
+            await wait_for(self.join(), timeout)
+        except TimeoutError:
+            pass
+
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
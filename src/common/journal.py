@@ -0,0 +1,258 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+from nextcord import Message
+from pymongo import ASCENDING, DeleteOne, ReplaceOne, UpdateOne
+
+from src.common.common import *
+from src.common.fanout import Delivery
+
+# How often, in seconds, buffered journal changes are written to the database
+JOURNAL_FLUSH_INTERVAL: float = 1.0
+
+# How often, in seconds, due retries are looked for
+RETRY_INTERVAL: float = 5.0
+
+# A delivery still in flight when the journal is flushed is retried after this, unless it finished
+IN_FLIGHT_GRACE: timedelta = timedelta(minutes=1)
+
+# Backoff of the first retry, doubled for every later one up to MAX_BACKOFF
+BASE_BACKOFF: timedelta = timedelta(seconds=5)
+MAX_BACKOFF: timedelta = timedelta(minutes=15)
+
+# Deliveries are given up after this many failed attempts
+MAX_ATTEMPTS: int = 8
+
+# Journal entries are removed by a TTL index after this long, whatever their state
+JOURNAL_TTL: int = 24 * 60 * 60
+
+# Due deliveries retried per pass at most
+RETRY_BATCH: int = 100
+
+# Messages backfilled per source channel at most after downtime
+BACKFILL_LIMIT: int = 100
+
+
+class PendingDelivery(NamedTuple):
+    """Journaled deliveries of one source message that are due for a retry."""
+
+    message_id: int
+    source_channel_id: int
+    pool_name: str
+    destinations: Tuple[int, ...]
+
+
+def backoff(attempts: int) -> timedelta:
+    """Delay before the next attempt after the given number of failed ones."""
+    return min(BASE_BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+class DeliveryJournal:
+    """
+    Durable record of relay deliveries that haven't succeeded yet.
+
+    Every (source message, destination) pair is journaled by :meth:`begin`
+    before it's sent and settled by :meth:`finish`. Changes are buffered and
+    written by :meth:`flush` as one bulk write, and a delivery that finishes
+    before the next flush never reaches the database. Failed deliveries are
+    retried with exponential backoff through :meth:`due`, deliveries left
+    unfinished by a restart are found the same way once their grace period is
+    over. Entries are given up after ``MAX_ATTEMPTS`` and expire after
+    ``JOURNAL_TTL`` seconds, so the journal stays bounded.
+
+    The journal also keeps a high-water mark, the newest message relayed from
+    each source channel, used to backfill messages sent while the bot was down.
+    """
+
+    def __init__(self, cluster_id: int = 0) -> None:
+        self.cluster_id: int = cluster_id
+        # Latest state of every changed entry by _id, None once it's settled
+        self.changes: Dict[str, Optional[Dict[str, Any]]] = {}
+        # Entries created since the last flush, they can be dropped without a write
+        self.unwritten: Set[str] = set()
+        self.attempts: Dict[str, int] = {}
+        self.watermarks: Dict[int, int] = {}
+        self.stats: Counter = Counter()
+
+    async def ensure_indexes(self) -> None:
+        """Create the TTL and retry lookup indexes."""
+        await db.relay_journal.create_index(
+            [("created_at", ASCENDING)], expireAfterSeconds=JOURNAL_TTL
+        )
+        await db.relay_journal.create_index([("cluster", ASCENDING), ("next_attempt", ASCENDING)])
+
+    @staticmethod
+    def key(message_id: int, channel_id: int) -> str:
+        return f"{message_id}:{channel_id}"
+
+    def advance(self, channel_id: int, message_id: int) -> None:
+        """
+        Move the high-water mark of a source channel.
+
+        :param channel_id: The ID of the source channel.
+        :param message_id: The ID of the message that is being relayed.
+        """
+        if message_id > self.watermarks.get(channel_id, 0):
+            self.watermarks[channel_id] = message_id
+
+    def begin(
+        self,
+        message: Message,
+        pool_name: str,
+        destinations: Iterable[int],
+        attempts: int = 0,
+        stored: bool = False,
+    ) -> None:
+        """
+        Journal the deliveries of a message before they're sent.
+
+        :param message: The source message.
+        :param pool_name: The name of the pool the message is relayed through.
+        :param destinations: The IDs of the destination channels.
+        :param attempts: The number of earlier failed attempts, for retries.
+        :param stored: Whether the deliveries are already in the database, for retries.
+        """
+        now = datetime.utcnow()
+        for channel_id in destinations:
+            key = self.key(message.id, channel_id)
+            self.attempts[key] = attempts
+            if stored:
+                # Only the retry state changes, created_at is kept so the entry still expires
+                entry = self.changes.get(key)
+                if entry is not None:
+                    entry.update(attempts=attempts, next_attempt=now + IN_FLIGHT_GRACE)
+                else:
+                    self.changes[key] = {"attempts": attempts, "next_attempt": now + IN_FLIGHT_GRACE}
+                continue
+
+            self.unwritten.add(key)
+            self.changes[key] = {
+                "_id": key,
+                "cluster": self.cluster_id,
+                "message_id": message.id,
+                "source_channel_id": message.channel.id,
+                "channel_id": channel_id,
+                "pool": pool_name,
+                "attempts": attempts,
+                "created_at": now,
+                "next_attempt": now + IN_FLIGHT_GRACE,
+            }
+
+    def finish(self, message_id: int, deliveries: List[Delivery]) -> None:
+        """
+        Settle the journaled deliveries of a message.
+
+        :param message_id: The ID of the source message.
+        :param deliveries: The outcome of every delivery.
+        """
+        now = datetime.utcnow()
+        for delivery in deliveries:
+            key = self.key(message_id, delivery.channel_id)
+            attempts = self.attempts.pop(key, 0)
+
+            if delivery.ok:
+                self.settle(key)
+                continue
+
+            attempts += 1
+            self.stats["failed"] += 1
+            if attempts >= MAX_ATTEMPTS:
+                self.stats["given_up"] += 1
+                self.settle(key)
+                continue
+
+            entry = self.changes.get(key)
+            if entry is not None:
+                entry.update(attempts=attempts, next_attempt=now + backoff(attempts))
+            else:
+                # Only the retry state changes, the rest of the entry is already stored
+                self.changes[key] = {"attempts": attempts, "next_attempt": now + backoff(attempts)}
+
+    def settle(self, key: str) -> None:
+        """Remove a finished or abandoned delivery from the journal."""
+        if key in self.unwritten:
+            self.unwritten.discard(key)
+            self.changes.pop(key, None)
+        else:
+            self.changes[key] = None
+
+    async def flush(self) -> None:
+        """Write the buffered journal changes and high-water marks in bulk."""
+        changes, self.changes = self.changes, {}
+        watermarks, self.watermarks = self.watermarks, {}
+        self.unwritten = set()
+
+        requests = []
+        for key, entry in changes.items():
+            if entry is None:
+                requests.append(DeleteOne({"_id": key}))
+            elif "_id" in entry:
+                requests.append(ReplaceOne({"_id": key}, entry, upsert=True))
+            else:
+                requests.append(UpdateOne({"_id": key}, {"$set": entry}))
+
+        try:
+            if requests:
+                await db.relay_journal.bulk_write(requests, ordered=False)
+            if watermarks:
+                await db.relay_watermarks.bulk_write(
+                    [
+                        UpdateOne({"_id": channel_id}, {"$max": {"message_id": message_id}}, upsert=True)
+                        for channel_id, message_id in watermarks.items()
+                    ],
+                    ordered=False,
+                )
+        except Exception:
+            # Keep the changes for the next flush, newer ones win
+            self.changes = {**changes, **self.changes}
+            for channel_id, message_id in watermarks.items():
+                self.advance(channel_id, message_id)
+            raise
+
+    async def due(self, limit: int = RETRY_BATCH) -> List[Tuple[PendingDelivery, int]]:
+        """
+        Find the deliveries of this process that are due for a retry, and claim them.
+
+        Claimed deliveries aren't due again for ``IN_FLIGHT_GRACE``, so one that is
+        still in flight, or whose retry is, isn't retried on every pass.
+
+        :param limit: The maximum number of deliveries to return.
+        :return: The due deliveries grouped per source message and pool, with their attempts so far.
+        """
+        now = datetime.utcnow()
+        entries = await db.relay_journal.find(
+            {"cluster": self.cluster_id, "next_attempt": {"$lte": now}}
+        ).sort("next_attempt", ASCENDING).limit(limit).to_list(None)
+        if not entries:
+            return []
+
+        await db.relay_journal.update_many(
+            {"_id": {"$in": [entry["_id"] for entry in entries]}},
+            {"$set": {"next_attempt": now + IN_FLIGHT_GRACE}},
+        )
+
+        groups: Dict[Tuple[int, int, str, int], List[int]] = {}
+        for entry in entries:
+            key = (entry["message_id"], entry["source_channel_id"], entry["pool"], entry["attempts"])
+            groups.setdefault(key, []).append(entry["channel_id"])
+
+        self.stats["retried"] += sum(len(destinations) for destinations in groups.values())
+        return [
+            (PendingDelivery(message_id, source_channel_id, pool_name, tuple(destinations)), attempts)
+            for (message_id, source_channel_id, pool_name, attempts), destinations in groups.items()
+        ]
+
+    def discard(self, pending: PendingDelivery) -> None:
+        """Give up on deliveries whose source message is gone."""
+        for channel_id in pending.destinations:
+            self.changes[self.key(pending.message_id, channel_id)] = None
+
+    async def load_watermarks(self, channel_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        Get the newest message relayed from every given source channel, in one query.
+
+        :param channel_ids: The IDs of the source channels.
+        :return: The ID of the message by channel ID, channels nothing was relayed from yet are missing.
+        """
+        documents = await db.relay_watermarks.find({"_id": {"$in": list(channel_ids)}}).to_list(None)
+        return {document["_id"]: document["message_id"] for document in documents}
@@ -0,0 +1,80 @@
+import sys
+from asyncio import Task, get_running_loop, sleep
+from collections import Counter
+from threading import Event, Thread, get_ident
+from time import monotonic, perf_counter
+from traceback import format_stack
+
+from src.common.common import *
+
+# Seconds between two lag samples
+LAG_INTERVAL: float = 0.25
+
+# Seconds the event loop may be busy with one callback before it's reported as blocked
+BLOCKED_THRESHOLD: float = 0.25
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag and reports blocking calls made on the loop.
+
+    A task sleeps ``interval`` seconds in a loop and records how late it wakes
+    up as ``relay_loop_lag_seconds``. A watchdog thread checks that the task
+    keeps waking up, once it didn't for ``threshold`` seconds the loop is stuck
+    in one callback and the stack of the loop's thread is printed, which points
+    at the blocking call.
+    """
+
+    def __init__(
+        self,
+        observe: Callable[[float], Any],
+        interval: float = LAG_INTERVAL,
+        threshold: float = BLOCKED_THRESHOLD,
+    ) -> None:
+        self.observe = observe
+        self.interval: float = interval
+        self.threshold: float = threshold
+        self.beat: float = monotonic()
+        self.thread_id: Optional[int] = None
+        self.task: Optional[Task] = None
+        self.watchdog: Optional[Thread] = None
+        self.stopped: Event = Event()
+        self.stats: Counter = Counter()
+
+    def start(self) -> None:
+        """Start monitoring the running event loop, once."""
+        if self.task is not None:
+            return
+        self.thread_id = get_ident()
+        self.beat = monotonic()
+        self.task = get_running_loop().create_task(self.run())
+        self.watchdog = Thread(target=self.watch, name="loop-monitor", daemon=True)
+        self.watchdog.start()
+
+    async def run(self) -> None:
+        while True:
+            start = perf_counter()
+            await sleep(self.interval)
+            self.observe(max(0.0, perf_counter() - start - self.interval))
+            self.beat = monotonic()
+
+    def watch(self) -> None:
+        """Report every stall of the loop once, from the watchdog thread."""
+        reported = 0.0
+        while not self.stopped.wait(self.threshold / 2):
+            beat = self.beat
+            blocked = monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == reported:
+                continue
+
+            reported = beat
+            self.stats["blocked"] += 1
+            frame = sys._current_frames().get(self.thread_id)  # noqa
+            stack = "".join(format_stack(frame)) if frame is not None else ""
+            print(f"Event loop blocked for {blocked:.2f}s, in:\n{stack}")
+
+    async def close(self) -> None:
+        """Stop the lag task and the watchdog thread."""
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,198 @@
+from collections import OrderedDict
+from datetime import datetime
+from time import monotonic
+
+from pymongo import ASCENDING
+
+from src.common.common import *
+
+# How long relayed message IDs are remembered, in seconds
+MESSAGE_TTL: int = 7 * 24 * 60 * 60
+
+# Maximum number of source messages kept in memory
+MAX_CACHED_MESSAGES: int = 10_000
+
+
+class RelayedMessage:
+    """A source message and every copy of it the bot relayed."""
+
+    __slots__ = ("source", "copies", "cached_at")
+
+    def __init__(self, source: Tuple[int, int], copies: List[Tuple[int, int]]) -> None:
+        self.source: Tuple[int, int] = source
+        self.copies: List[Tuple[int, int]] = copies
+        self.cached_at: float = monotonic()
+
+    @property
+    def message_id(self) -> int:
+        return self.source[1]
+
+    def messages(self) -> List[Tuple[int, int]]:
+        """Get the (channel ID, message ID) pairs of the source and every copy."""
+        return [self.source, *self.copies]
+
+    def targets(self, message_id: int) -> List[Tuple[int, int]]:
+        """
+        Get every message of the group except the given one.
+
+        :param message_id: The ID of the message to exclude, the source or any copy.
+        :return: The (channel ID, message ID) pairs of the other messages.
+        """
+        return [pair for pair in (self.source, *self.copies) if pair[1] != message_id]
+
+
+class MessageMap:
+    """
+    Maps source message IDs to the (channel ID, message ID) of their relayed copies.
+
+    The mapping is persisted in the ``relayed_messages`` collection, where a TTL index
+    expires entries after ``ttl`` seconds. A size-bounded LRU keeps recent messages in
+    memory, so most lookups never reach the database. Lookups work with the ID of the
+    source message or of any of its copies.
+    """
+
+    def __init__(self, max_size: int = MAX_CACHED_MESSAGES, ttl: int = MESSAGE_TTL) -> None:
+        self.max_size: int = max_size
+        self.ttl: int = ttl
+        self.entries: OrderedDict[int, RelayedMessage] = OrderedDict()
+        self.sources: Dict[int, int] = {}
+
+    async def ensure_indexes(self) -> None:
+        """Create the TTL and copy lookup indexes."""
+        await db.relayed_messages.create_index(
+            [("created_at", ASCENDING)], expireAfterSeconds=self.ttl
+        )
+        await db.relayed_messages.create_index([("copy_ids", ASCENDING)])
+
+    def cache(self, entry: RelayedMessage) -> None:
+        """Put an entry in the LRU, evicting the least recently used ones."""
+        self.entries[entry.message_id] = entry
+        self.entries.move_to_end(entry.message_id)
+        for _, message_id in entry.copies:
+            self.sources[message_id] = entry.message_id
+
+        while len(self.entries) > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            for _, message_id in evicted.copies:
+                self.sources.pop(message_id, None)
+
+    def uncache(self, source_id: int) -> Optional[RelayedMessage]:
+        """Remove an entry from the LRU."""
+        entry = self.entries.pop(source_id, None)
+        if entry is not None:
+            for _, message_id in entry.copies:
+                self.sources.pop(message_id, None)
+        return entry
+
+    async def add(
+        self, channel_id: int, message_id: int, copies: List[Tuple[int, int]]
+    ) -> None:
+        """
+        Record the relayed copies of a source message.
+
+        :param channel_id: The ID of the source channel.
+        :param message_id: The ID of the source message.
+        :param copies: The (channel ID, message ID) pairs of the relayed copies.
+        """
+        if not copies:
+            return
+
+        # A message relayed through several pools is recorded once per pool
+        entry = self.entries.get(message_id)
+        if entry is None:
+            entry = RelayedMessage((channel_id, message_id), [])
+        entry.copies.extend(copies)
+        self.cache(entry)
+
+        await db.relayed_messages.update_one(
+            {"_id": message_id},
+            {
+                "$setOnInsert": {"channel_id": channel_id, "created_at": datetime.utcnow()},
+                "$push": {
+                    "copies": {"$each": [list(copy) for copy in copies]},
+                    "copy_ids": {"$each": [copy[1] for copy in copies]},
+                },
+            },
+            upsert=True,
+        )
+
+    async def get(self, message_id: int) -> Optional[RelayedMessage]:
+        """
+        Find the relay group of a message.
+
+        :param message_id: The ID of the source message or of any relayed copy.
+        :return: The relay group, or None if the message was never relayed.
+        """
+        source_id = self.sources.get(message_id, message_id)
+        entry = self.entries.get(source_id)
+        if entry is not None:
+            if monotonic() - entry.cached_at < self.ttl:
+                self.entries.move_to_end(source_id)
+                return entry
+            self.uncache(source_id)
+
+        document = await db.relayed_messages.find_one(
+            {"$or": [{"_id": message_id}, {"copy_ids": message_id}]}
+        )
+        if document is None:
+            return None
+
+        entry = RelayedMessage(
+            (document["channel_id"], document["_id"]),
+            [tuple(copy) for copy in document["copies"]],
+        )
+        self.cache(entry)
+        return entry
+
+    async def get_sources(self, message_ids: Iterable[int]) -> List[RelayedMessage]:
+        """
+        Find the relay groups of several source messages with at most one query.
+
+        :param message_ids: The IDs of the source messages.
+        :return: The relay groups of the messages that were relayed.
+        """
+        found, missing = [], []
+        for message_id in message_ids:
+            entry = self.entries.get(message_id)
+            if entry is not None and monotonic() - entry.cached_at < self.ttl:
+                found.append(entry)
+            else:
+                missing.append(message_id)
+
+        if missing:
+            async for document in db.relayed_messages.find({"_id": {"$in": missing}}):
+                entry = RelayedMessage(
+                    (document["channel_id"], document["_id"]),
+                    [tuple(copy) for copy in document["copies"]],
+                )
+                self.cache(entry)
+                found.append(entry)
+
+        return found
+
+    async def remove(self, source_id: int) -> None:
+        """
+        Forget a source message and its copies, e.g. once it was deleted.
+
+        :param source_id: The ID of the source message.
+        """
+        self.uncache(source_id)
+        await db.relayed_messages.delete_one({"_id": source_id})
+
+    async def remove_many(self, source_ids: List[int]) -> None:
+        """
+        Forget several source messages and their copies.
+
+        :param source_ids: The IDs of the source messages.
+        """
+        for source_id in source_ids:
+            self.uncache(source_id)
+        await db.relayed_messages.delete_many({"_id": {"$in": source_ids}})
+
+
+def group_by_channel(copies: Iterable[Tuple[int, int]]) -> Dict[int, List[int]]:
+    """Group (channel ID, message ID) pairs by channel ID."""
+    grouped: Dict[int, List[int]] = {}
+    for channel_id, message_id in copies:
+        grouped.setdefault(channel_id, []).append(message_id)
+    return grouped
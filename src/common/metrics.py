@@ -0,0 +1,191 @@
+from bisect import bisect_left
+from collections import defaultdict
+from sys import platform
+from time import perf_counter
+
+from aiohttp import web
+
+from src.common.common import *
+
+# Address of the local Prometheus endpoint
+METRICS_HOST: str = "127.0.0.1"
+METRICS_PORT: int = 9108
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def peak_memory() -> int:
+    """Return the peak resident memory of the process in bytes, 0 where it can't be read."""
+    try:
+        from resource import RUSAGE_SELF, getrusage
+    except ImportError:  # Windows
+        return 0
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    maxrss = getrusage(RUSAGE_SELF).ru_maxrss
+    return maxrss if platform == "darwin" else maxrss * 1024
+
+
+class Histogram:
+    """A fixed-bucket histogram, observing a value is a bisect and two additions."""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Timer:
+    """Context manager observing the time spent in its block."""
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram: Histogram = histogram
+        self.start: float = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(perf_counter() - self.start)
+
+
+class Metrics:
+    """
+    In-process counters and histograms for the relay pipeline.
+
+    Recording only touches dicts and lists on the event loop, nothing is formatted
+    until the metrics are read. Values owned by other components, like queue
+    depths, are read through collectors at scrape time. The metrics are served in
+    the Prometheus text format on a local HTTP endpoint by :meth:`serve`.
+    """
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, Dict[Labels, float]] = defaultdict(lambda: defaultdict(float))
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = defaultdict(lambda: defaultdict(Histogram))
+        self.collectors: Dict[str, Tuple[str, Callable[[], Dict[Labels, float]]]] = {}
+        self.descriptions: Dict[str, str] = {}
+        self.runner: Optional[web.AppRunner] = None
+
+    def describe(self, name: str, description: str) -> None:
+        self.descriptions[name] = description
+
+    def inc(self, name: str, amount: float = 1, **labels: Any) -> None:
+        """Increment a counter."""
+        self.counters[name][tuple((k, str(v)) for k, v in labels.items())] += amount
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """Record a value, in seconds, in a histogram."""
+        self.histograms[name][tuple((k, str(v)) for k, v in labels.items())].observe(value)
+
+    def time(self, name: str, **labels: Any) -> Timer:
+        """Time a block into a histogram, e.g. ``with metrics.time("x", stage="send"):``."""
+        return Timer(self.histograms[name][tuple((k, str(v)) for k, v in labels.items())])
+
+    def collect(self, name: str, kind: str, callback: Callable[[], Dict[Labels, float]]) -> None:
+        """
+        Register a value read from another component at scrape time.
+
+        :param name: The name of the metric.
+        :param kind: The Prometheus type, "gauge" or "counter".
+        :param callback: Returns the current values by labels.
+        """
+        self.collectors[name] = (kind, callback)
+
+    def value(self, name: str) -> float:
+        """Sum a counter or collected value over all of its labels."""
+        if name in self.collectors:
+            return sum(self.collectors[name][1]().values())
+        return sum(self.counters.get(name, {}).values())
+
+    @staticmethod
+    def format_labels(labels: Labels, extra: Labels = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        inner = ",".join(
+            '%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{%s}" % inner
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+
+        def header(name: str, kind: str) -> None:
+            if name in self.descriptions:
+                lines.append(f"# HELP {name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, values in sorted(self.counters.items()):
+            header(name, "counter")
+            for labels, value in values.items():
+                lines.append(f"{name}{self.format_labels(labels)} {value}")
+
+        for name, (kind, callback) in sorted(self.collectors.items()):
+            header(name, kind)
+            for labels, value in callback().items():
+                lines.append(f"{name}{self.format_labels(labels)} {value}")
+
+        for name, histograms in sorted(self.histograms.items()):
+            header(name, "histogram")
+            for labels, histogram in histograms.items():
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += n
+                    lines.append(
+                        f"{name}_bucket{self.format_labels(labels, (('le', str(bound)),))} {cumulative}"
+                    )
+                lines.append(
+                    f"{name}_bucket{self.format_labels(labels, (('le', '+Inf'),))} {histogram.count}"
+                )
+                lines.append(f"{name}_sum{self.format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def serve(self, host: str = METRICS_HOST, port: int = METRICS_PORT) -> None:
+        """Serve the metrics on ``http://host:port/metrics``."""
+        if self.runner is not None:
+            return
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def close(self) -> None:
+        """Stop serving the metrics."""
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,201 @@
+from array import array
+
+from src.common.common import *
+
+# Type code of the channel ID arrays, Discord IDs are unsigned 64-bit integers
+ID_TYPECODE: str = "Q"
+
+
+class Membership:
+    """
+    The channels a server has in a pool and the messages it relayed through it.
+
+    Channel IDs are kept in a typed array, 8 bytes each instead of a list of int
+    objects, in the order they were added, which is the order they're relayed in.
+    """
+
+    __slots__ = ("guild_id", "channels", "message_count")
+
+    def __init__(
+        self, guild_id: int, channels: Iterable[int] = (), message_count: int = 0
+    ) -> None:
+        self.guild_id: int = guild_id
+        self.channels: array = array(ID_TYPECODE, channels)
+        self.message_count: int = message_count
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self.channels
+
+    def add(self, channel_id: int) -> None:
+        """Add a channel, a channel that is already a member isn't added twice."""
+        if channel_id not in self.channels:
+            self.channels.append(channel_id)
+
+    def remove(self, channel_id: int) -> bool:
+        """
+        Remove a channel.
+
+        :param channel_id: The ID of the channel.
+        :return: Whether the channel was a member.
+        """
+        if channel_id not in self.channels:
+            return False
+        self.channels.remove(channel_id)
+        return True
+
+
+class Budget:
+    """
+    The share of the relay a pool may use.
+
+    ``rate`` caps the requests per second the pool sends, ``concurrency`` the
+    requests it has in flight at once and ``queue`` the events waiting to be
+    relayed, None leaves them unlimited or at the default. Pools with work
+    get ``weight`` turns in every round of the schedulers, one by default.
+    """
+
+    __slots__ = ("rate", "concurrency", "queue", "weight")
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        concurrency: Optional[int] = None,
+        queue: Optional[int] = None,
+        weight: int = 1,
+    ) -> None:
+        self.rate: Optional[float] = rate
+        self.concurrency: Optional[int] = concurrency
+        self.queue: Optional[int] = queue
+        self.weight: int = weight
+
+    def __repr__(self) -> str:
+        return (
+            f"Budget(rate={self.rate}, concurrency={self.concurrency}, "
+            f"queue={self.queue}, weight={self.weight})"
+        )
+
+    @classmethod
+    def from_document(cls, document: Optional[Dict[str, Any]]) -> "Budget":
+        """Build a budget from its stored form, pools stored without one get the default."""
+        if not document:
+            return cls()
+        return cls(
+            rate=document.get("rate"),
+            concurrency=document.get("concurrency"),
+            queue=document.get("queue"),
+            weight=document.get("weight", 1),
+        )
+
+    def to_document(self) -> Dict[str, Any]:
+        return {
+            "rate": self.rate,
+            "concurrency": self.concurrency,
+            "queue": self.queue,
+            "weight": self.weight,
+        }
+
+
+# The budget of pools that weren't given one, shared and never changed
+DEFAULT_BUDGET: Budget = Budget()
+
+
+class Pool:
+    """
+    A relay pool: its settings and the memberships of its servers, keyed by integer server ID.
+
+    :meth:`from_document` and :meth:`to_document` convert from and to the document
+    stored in the ``relay_pools`` collection, whose server keys stay strings.
+    """
+
+    __slots__ = ("name", "password", "moderation", "coalesce", "budget", "servers")
+
+    def __init__(
+        self,
+        name: str,
+        password: Optional[str] = None,
+        moderation: Optional[float] = None,
+        coalesce: Optional[float] = None,
+        servers: Optional[Dict[int, Membership]] = None,
+        budget: Optional[Budget] = None,
+    ) -> None:
+        self.name: str = name
+        self.password: Optional[str] = password
+        # Profanity score from which messages are held back, None when not moderated
+        self.moderation: Optional[float] = moderation
+        # Messages per second to a channel from which they're batched, None when disabled
+        self.coalesce: Optional[float] = coalesce
+        self.budget: Budget = budget if budget is not None else Budget()
+        self.servers: Dict[int, Membership] = servers if servers is not None else {}
+
+    def __repr__(self) -> str:
+        return f"Pool({self.name!r}, servers={len(self.servers)})"
+
+    @classmethod
+    def from_document(cls, name: str, document: Dict[str, Any]) -> "Pool":
+        """
+        Build a pool from its stored document.
+
+        :param name: The name of the pool, the ``_id`` of the document.
+        :param document: The stored document, or the legacy pool data.
+        :return: The pool.
+        """
+        return cls(
+            name,
+            password=document.get("password"),
+            moderation=document.get("moderation"),
+            coalesce=document.get("coalesce"),
+            budget=Budget.from_document(document.get("budget")),
+            servers={
+                int(guild_id): Membership(
+                    int(guild_id),
+                    server_data.get("channels", ()),
+                    server_data.get("message_count", 0),
+                )
+                for guild_id, server_data in document.get("servers", {}).items()
+            },
+        )
+
+    def to_document(self) -> Dict[str, Any]:
+        """
+        Convert the pool to the stored document format, without the ``_id``.
+
+        :return: The settings and servers of the pool, with string server keys.
+        """
+        return {
+            "password": self.password,
+            "moderation": self.moderation,
+            "coalesce": self.coalesce,
+            "budget": self.budget.to_document(),
+            "servers": {
+                str(guild_id): {
+                    "channels": membership.channels.tolist(),
+                    "message_count": membership.message_count,
+                }
+                for guild_id, membership in self.servers.items()
+            },
+        }
+
+    def channel_ids(self) -> Iterator[int]:
+        """Iterate over the IDs of the channels of every server, in pool order."""
+        for membership in self.servers.values():
+            yield from membership.channels
+
+    def add_channel(self, guild_id: int, channel_id: int) -> None:
+        """Add a channel to the pool, joining its server to the pool if needed."""
+        membership = self.servers.get(guild_id)
+        if membership is None:
+            membership = self.servers[guild_id] = Membership(guild_id)
+        membership.add(channel_id)
+
+    def remove_channel(self, guild_id: int, channel_id: int) -> bool:
+        """
+        Remove a channel from the pool, its server keeps its membership and message count.
+
+        :return: Whether the channel was in the pool.
+        """
+        membership = self.servers.get(guild_id)
+        return membership is not None and membership.remove(channel_id)
+
+    def has_channel(self, guild_id: int, channel_id: int) -> bool:
+        membership = self.servers.get(guild_id)
+        return membership is not None and channel_id in membership
@@ -0,0 +1,137 @@
+from asyncio import Future, TimerHandle, get_running_loop
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from src.common.common import *
+
+# Seconds texts are collected before they're scored together
+MODERATION_WINDOW: float = 0.02
+
+# Texts scored in one call at most, a full batch is scored right away
+MAX_MODERATION_BATCH: int = 64
+
+# Scores of queued messages kept until they're relayed, oldest ones are dropped first
+MAX_PREFETCHED: int = 1000
+
+
+def predict_prob(texts: List[str]) -> List[float]:
+    """Score texts with alt-profanity-check, imported on first use since loading the model is slow."""
+    from profanity_check import predict_prob as predict
+
+    return predict(texts).tolist()
+
+
+class ModerationBatcher:
+    """
+    Scores message texts for profanity in micro-batches.
+
+    :meth:`score` queues a text and waits for its batch. A batch is scored
+    once ``window`` seconds passed since its first text or when it's full,
+    with a single vectorized ``predict_prob`` call on a dedicated thread, so
+    the event loop keeps running while the model works.
+
+    Messages of a pool are relayed one after the other, so they're scored
+    ahead of time with :meth:`prefetch` when they're queued, which lets
+    queued messages share a batch, and picked up by :meth:`score_message`.
+    """
+
+    def __init__(
+        self,
+        window: float = MODERATION_WINDOW,
+        max_batch: int = MAX_MODERATION_BATCH,
+        predict: Callable[[List[str]], List[float]] = predict_prob,
+    ) -> None:
+        self.window: float = window
+        self.max_batch: int = max_batch
+        self.predict = predict
+        self.pending: List[Tuple[str, Future]] = []
+        self.prefetched: OrderedDict[int, Future] = OrderedDict()
+        self.timer: Optional[TimerHandle] = None
+        # One thread, the model isn't shared between concurrent predictions
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(1, thread_name_prefix="moderation")
+        self.stats: Counter = Counter()
+        self.scoring_seconds: float = 0.0
+
+    def submit(self, text: str) -> Future:
+        """
+        Queue a text in the next batch.
+
+        :param text: The text to score.
+        :return: A future of the probability that the text is offensive, between 0 and 1.
+        """
+        loop = get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+
+        return future
+
+    async def score(self, text: str) -> float:
+        """Get the probability that a text is offensive, between 0 and 1."""
+        return await self.submit(text)
+
+    def prefetch(self, message_id: int, text: str) -> None:
+        """
+        Start scoring a message before it's relayed.
+
+        :param message_id: The ID of the message, to pick the score up with.
+        :param text: The text of the message.
+        """
+        if message_id in self.prefetched:
+            return
+        self.prefetched[message_id] = self.submit(text)
+        if len(self.prefetched) > MAX_PREFETCHED:
+            self.prefetched.popitem(last=False)
+
+    async def score_message(self, message_id: int, text: str) -> float:
+        """
+        Get the score of a message, prefetched or scored now.
+
+        :param message_id: The ID of the message.
+        :param text: The text of the message.
+        :return: The probability that the message is offensive, between 0 and 1.
+        """
+        future = self.prefetched.pop(message_id, None)
+        return await (future if future is not None else self.submit(text))
+
+    def flush(self) -> None:
+        """Start scoring the pending texts as one batch."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            batch, self.pending = self.pending, []
+            get_running_loop().create_task(self.run(batch))
+
+    async def run(self, batch: List[Tuple[str, Future]]) -> None:
+        start = perf_counter()
+        try:
+            scores = await get_running_loop().run_in_executor(
+                self.executor, self.predict, [text for text, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.scoring_seconds += perf_counter() - start
+
+        self.stats["batches"] += 1
+        self.stats["texts"] += len(batch)
+        for (_, future), score in zip(batch, scores):
+            if not future.done():
+                future.set_result(score)
+
+    async def warm_up(self) -> None:
+        """Load the model ahead of the first message, loading takes a second or more."""
+        await get_running_loop().run_in_executor(self.executor, self.predict, [""])
+
+    async def close(self) -> None:
+        """Stop the scoring thread once the running batch is done."""
+        self.executor.shutdown(wait=False)
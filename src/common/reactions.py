@@ -0,0 +1,257 @@
+from asyncio import Future, TimerHandle, get_running_loop
+from collections import Counter, OrderedDict
+from time import monotonic
+
+from nextcord import Emoji, HTTPException, PartialEmoji
+
+from src.common.common import *
+from src.common.message_map import RelayedMessage
+
+# Seconds reaction events on the same message and emoji are collected before they're mirrored
+REACTION_DEBOUNCE: float = 0.5
+
+# Reaction states kept at most, the least recently changed ones are forgotten first
+MAX_REACTION_STATES: int = 10000
+
+# Seconds an emoji is remembered as unusable in a channel
+EMOJI_UNUSABLE_TTL: float = 600.0
+
+# Discord error codes meaning the bot can't react with an emoji
+UNUSABLE_EMOJI_CODES: Set[int] = {10014, 50013}
+
+AnyEmoji = Union[Emoji, PartialEmoji, str]
+
+
+def emoji_key(emoji: AnyEmoji) -> str:
+    """The key of an emoji, the same for its Emoji, PartialEmoji and str forms."""
+    return str(emoji)
+
+
+class EmojiTable:
+    """
+    Caches whether the bot can react with an emoji in a channel.
+
+    Unicode emoji are usable everywhere. Custom emoji need the bot to be in
+    their server and, in the channels of other servers, the Use External Emojis
+    permission. Both are answered from the bot's cache; channels and emoji the
+    bot doesn't see are tried once and remembered as unusable when Discord
+    rejects them, so later reactions with them are skipped without a request.
+    """
+
+    def __init__(self, bot, ttl: float = EMOJI_UNUSABLE_TTL) -> None:
+        self.bot = bot
+        self.ttl: float = ttl
+        self.unusable: Dict[Tuple[int, int], float] = {}
+
+    def usable(self, emoji: AnyEmoji, channel_id: int) -> bool:
+        """
+        Check whether the bot can react with an emoji in a channel.
+
+        :param emoji: The emoji.
+        :param channel_id: The ID of the channel.
+        :return: False if the reaction is known to fail.
+        """
+        emoji_id = getattr(emoji, "id", None)
+        if emoji_id is None:
+            return True
+
+        rejected_at = self.unusable.get((emoji_id, channel_id))
+        if rejected_at is not None:
+            if monotonic() - rejected_at < self.ttl:
+                return False
+            del self.unusable[emoji_id, channel_id]
+
+        custom = self.bot.get_emoji(emoji_id)
+        channel = self.bot.get_channel(channel_id)
+        if custom is None or channel is None:
+            # Not in this process' cache, Discord decides
+            return True
+        if not custom.is_usable():
+            return False
+        if custom.guild_id == channel.guild.id:
+            return True
+        return channel.permissions_for(channel.guild.me).use_external_emojis
+
+    def reject(self, emoji: AnyEmoji, channel_id: int) -> None:
+        """Remember that Discord rejected a reaction with an emoji in a channel."""
+        emoji_id = getattr(emoji, "id", None)
+        if emoji_id is not None:
+            self.unusable[emoji_id, channel_id] = monotonic()
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        """Forget the rejections of a server's channels, e.g. after its emoji or permissions changed."""
+        channels = {channel.id for channel in getattr(self.bot.get_guild(guild_id), "channels", ())}
+        for key in [key for key in self.unusable if key[1] in channels]:
+            del self.unusable[key]
+
+
+class ReactionState:
+    """What is known about one emoji on the messages of one relay group."""
+
+    __slots__ = ("group", "emoji", "pool_name", "counts", "mirrored", "cleared", "timer")
+
+    def __init__(self, group: RelayedMessage, emoji: AnyEmoji, pool_name: str) -> None:
+        self.group: RelayedMessage = group
+        self.emoji: AnyEmoji = emoji
+        self.pool_name: str = pool_name
+        # Reactions of users per message of the group, net of removals
+        self.counts: Counter = Counter()
+        # Messages the bot added the emoji to
+        self.mirrored: Set[int] = set()
+        # Messages whose reactions were cleared by a moderator, not mirrored to again
+        self.cleared: Set[int] = set()
+        self.timer: Optional[TimerHandle] = None
+
+
+class ReactionMirror:
+    """
+    Mirrors the reactions on relayed messages onto the other messages of their relay group.
+
+    Events are collected per (relay group, emoji) for ``debounce`` seconds and
+    then reconciled at once: the bot's reaction is added to every message of the
+    group without a reaction of a user while any message has one, and removed
+    again once the last user reaction is gone. A burst of the same emoji on a
+    popular message costs one request per destination, and a reaction that is
+    added and removed within the window costs none.
+
+    ``add`` and ``remove`` queue the requests, see the Relay cog's ``mirror_reaction``.
+    """
+
+    def __init__(
+        self,
+        emojis: EmojiTable,
+        add: Callable[[int, int, AnyEmoji, str], Future],
+        remove: Callable[[int, int, AnyEmoji, str], Future],
+        debounce: float = REACTION_DEBOUNCE,
+        max_states: int = MAX_REACTION_STATES,
+    ) -> None:
+        self.emojis: EmojiTable = emojis
+        self.add = add
+        self.remove = remove
+        self.debounce: float = debounce
+        self.max_states: int = max_states
+        self.states: OrderedDict[Tuple[int, str], ReactionState] = OrderedDict()
+        self.stats: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def state(
+        self, group: RelayedMessage, emoji: AnyEmoji, pool_name: str, create: bool
+    ) -> Optional[ReactionState]:
+        """
+        Get the state of a group and emoji.
+
+        :param create: Whether to create the state if it isn't known.
+        :return: The state, or None if it isn't known and wasn't created.
+        """
+        key = (group.message_id, emoji_key(emoji))
+        state = self.states.get(key)
+        if state is None:
+            if not create:
+                return None
+            state = self.states[key] = ReactionState(group, emoji, pool_name)
+            if len(self.states) > self.max_states:
+                _, evicted = self.states.popitem(last=False)
+                if evicted.timer is not None:
+                    evicted.timer.cancel()
+        else:
+            state.group = group
+            self.states.move_to_end(key)
+        return state
+
+    def record(
+        self, group: RelayedMessage, message_id: int, emoji: AnyEmoji, delta: int, pool_name: str
+    ) -> None:
+        """
+        Record a reaction added or removed by a user.
+
+        :param group: The relay group of the reacted message.
+        :param message_id: The ID of the reacted message, the source or a copy.
+        :param emoji: The emoji.
+        :param delta: 1 for an added reaction, -1 for a removed one.
+        :param pool_name: The name of the pool the reaction is mirrored for.
+        """
+        state = self.state(group, emoji, pool_name, delta > 0)
+        if state is None:
+            # The reactions before a restart aren't known, other users may still have the
+            # emoji, so the mirrored reactions are left alone
+            self.stats["unknown"] += 1
+            return
+
+        state.counts[message_id] = max(0, state.counts[message_id] + delta)
+        state.cleared.discard(message_id)
+        self.stats["events"] += 1
+        self.schedule(state)
+
+    def clear(self, group: RelayedMessage, message_id: int, emoji: Optional[AnyEmoji], pool_name: str) -> None:
+        """
+        Record that the reactions of a message were cleared, all of them or one emoji.
+
+        :param group: The relay group of the message.
+        :param message_id: The ID of the cleared message.
+        :param emoji: The cleared emoji, None if every reaction was cleared.
+        :param pool_name: The name of the pool the reactions were mirrored for.
+        """
+        if emoji is not None:
+            states = [state for state in [self.state(group, emoji, pool_name, False)] if state]
+        else:
+            states = [state for (source_id, _), state in self.states.items() if source_id == group.message_id]
+
+        for state in states:
+            state.counts.pop(message_id, None)
+            state.mirrored.discard(message_id)
+            state.cleared.add(message_id)
+            self.stats["clears"] += 1
+            self.schedule(state)
+
+    def schedule(self, state: ReactionState) -> None:
+        if state.timer is None:
+            state.timer = get_running_loop().call_later(self.debounce, self.flush, state)
+
+    def flush(self, state: ReactionState) -> None:
+        """Reconcile the bot's reactions of a group and emoji with the recorded user reactions."""
+        state.timer = None
+        reacted = any(state.counts.values())
+
+        desired = set()
+        if reacted:
+            for channel_id, message_id in state.group.messages():
+                if state.counts[message_id] or message_id in state.cleared:
+                    continue
+                if not self.emojis.usable(state.emoji, channel_id):
+                    self.stats["unusable"] += 1
+                    continue
+                desired.add(message_id)
+
+        for channel_id, message_id in state.group.messages():
+            if message_id in desired and message_id not in state.mirrored:
+                future = self.add(channel_id, message_id, state.emoji, state.pool_name)
+                self.stats["added"] += 1
+            elif message_id not in desired and message_id in state.mirrored:
+                future = self.remove(channel_id, message_id, state.emoji, state.pool_name)
+                self.stats["removed"] += 1
+            else:
+                continue
+            future.add_done_callback(lambda f, c=channel_id: self.report(state.emoji, c, f))
+
+        state.mirrored = desired
+        if not reacted and not state.cleared:
+            self.states.pop((state.group.message_id, emoji_key(state.emoji)), None)
+
+    def report(self, emoji: AnyEmoji, channel_id: int, future: Future) -> None:
+        if future.cancelled() or future.exception() is None:
+            return
+        error = future.exception()
+        if isinstance(error, HTTPException) and error.code in UNUSABLE_EMOJI_CODES:
+            self.emojis.reject(emoji, channel_id)
+            self.stats["rejected"] += 1
+        else:
+            print(f"Error mirroring reaction {emoji} in {channel_id}: {error}")
+
+    async def close(self) -> None:
+        """Reconcile every pending group and emoji now."""
+        for state in list(self.states.values()):
+            if state.timer is not None:
+                state.timer.cancel()
+                self.flush(state)
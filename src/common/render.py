@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from time import monotonic
+
+from nextcord import AllowedMentions, Guild, Member, Message, User
+
+from src.common.attachments import RelayAttachments
+from src.common.common import *
+
+# Discord rejects webhook usernames longer than this
+MAX_USERNAME_LENGTH: int = 80
+
+# Rendered authors kept in memory, least recently used ones are evicted first
+MAX_CACHED_AUTHORS: int = 10000
+
+# Seconds a rendered author is reused, members that aren't cached get no update events
+RENDER_TTL: float = 600.0
+
+# Relayed messages may ping users, but never a whole server or role of another server
+RELAY_MENTIONS: AllowedMentions = AllowedMentions(everyone=False, roles=False, users=True)
+
+
+class AuthorRender(NamedTuple):
+    """How a message author is shown on relayed copies."""
+
+    username: str
+    avatar_url: str
+    rendered_at: float
+
+
+def render_username(display_name: str, guild_name: str) -> str:
+    """
+    Build the webhook username of a relayed message, within Discord's length limit.
+
+    The display name is shortened first, so the server the message came from stays visible.
+
+    :param display_name: The display name of the author.
+    :param guild_name: The name of the server the message was sent in.
+    :return: The username, at most ``MAX_USERNAME_LENGTH`` characters long.
+    """
+    username = f"{display_name} · {guild_name}"
+    if len(username) <= MAX_USERNAME_LENGTH:
+        return username
+
+    suffix = f"… · {guild_name}"
+    if len(suffix) < MAX_USERNAME_LENGTH - 1:
+        return display_name[:MAX_USERNAME_LENGTH - len(suffix)] + suffix
+    return username[:MAX_USERNAME_LENGTH - 1] + "…"
+
+
+class RenderCache:
+    """
+    Caches the rendered username and avatar of message authors per (guild, user).
+
+    Every destination of a relayed message shares the payload built by
+    :meth:`payload`, so the author is rendered at most once per message and
+    usually once per :data:`RENDER_TTL`. Entries are dropped by the member, user
+    and guild update listeners of the Relay cog.
+    """
+
+    def __init__(self, max_size: int = MAX_CACHED_AUTHORS, ttl: float = RENDER_TTL) -> None:
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self.entries: OrderedDict[Tuple[int, int], AuthorRender] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, author: Union[Member, User], guild: Guild) -> AuthorRender:
+        """
+        Get the rendered author, rendering it on a miss.
+
+        :param author: The author of the message.
+        :param guild: The server the message was sent in.
+        :return: The username and avatar to send the message with.
+        """
+        key = (guild.id, author.id)
+        render = self.entries.get(key)
+        now = monotonic()
+        if render is not None and now - render.rendered_at < self.ttl:
+            self.entries.move_to_end(key)
+            return render
+
+        # display_avatar falls back to the default avatar for users without a custom one
+        render = AuthorRender(
+            render_username(author.display_name, guild.name), author.display_avatar.url, now
+        )
+        self.entries[key] = render
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return render
+
+    def payload(self, message: Message, attachments: RelayAttachments) -> Dict[str, Any]:
+        """
+        Build the webhook send arguments of a message, shared by every destination.
+
+        Files can only be sent once, so they're added per destination from the attachments.
+
+        :param message: The message that is relayed.
+        :param attachments: The downloaded attachments of the message.
+        :return: The keyword arguments for ``Webhook.send``.
+        """
+        render = self.get(message.author, message.guild)
+        return {
+            "content": attachments.content(message.content),
+            "username": render.username,
+            "avatar_url": render.avatar_url,
+            "allowed_mentions": RELAY_MENTIONS,
+            "wait": True,
+        }
+
+    def invalidate(self, guild_id: int, user_id: int) -> None:
+        """Drop the render of a member, e.g. after their nickname or server avatar changed."""
+        self.entries.pop((guild_id, user_id), None)
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Drop the renders of a user in every server, e.g. after their name or avatar changed."""
+        for key in [key for key in self.entries if key[1] == user_id]:
+            del self.entries[key]
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        """Drop the renders of every member of a server, e.g. after it was renamed."""
+        for key in [key for key in self.entries if key[0] == guild_id]:
+            del self.entries[key]
@@ -0,0 +1,114 @@
+from nextcord import Interaction
+from nextcord.ext.menus import ButtonMenuPages, ListPageSource
+from tabulate import tabulate
+
+from src.common.common import *
+from src.common.models import Pool
+
+# Rows per page, a page of the longest cells stays under Discord's 2000 characters
+ROWS_PER_PAGE: int = 15
+
+# Characters of a name shown in a table cell at most
+MAX_CELL_LENGTH: int = 32
+
+
+def cell(value: Any) -> str:
+    """Shorten a table cell, so long names can't push a page over the message limit."""
+    text = str(value)
+    return text if len(text) <= MAX_CELL_LENGTH else text[:MAX_CELL_LENGTH - 1] + "…"
+
+
+class MembershipSnapshot:
+    """
+    The sorted (pool, server) and (pool, server, channel) rows of every pool.
+
+    The rows are rebuilt from the pools only when the routing index version
+    changed, i.e. after a channel was added or removed here or in another process,
+    so admin reports don't walk every pool on every call. Names aren't part of
+    the snapshot, they're resolved for the page that is shown.
+    """
+
+    def __init__(self) -> None:
+        self.version: int = -1
+        self.servers: List[Tuple[str, int]] = []
+        self.channels: List[Tuple[str, int, int]] = []
+
+    def refresh(self, version: int, pools: Dict[str, Pool]) -> "MembershipSnapshot":
+        """
+        Rebuild the rows if the pools changed since the last build.
+
+        :param version: The version of the routing index.
+        :param pools: The pools, as stored on the Relay cog.
+        :return: The snapshot itself.
+        """
+        if version == self.version:
+            return self
+
+        self.servers = []
+        self.channels = []
+        for pool_name in sorted(pools):
+            for guild_id, membership in pools[pool_name].servers.items():
+                self.servers.append((pool_name, guild_id))
+                for channel_id in membership.channels:
+                    self.channels.append((pool_name, guild_id, channel_id))
+        self.version = version
+        return self
+
+
+class TablePageSource(ListPageSource):
+    """Renders rows as a table, one page at a time, with ``render`` called only for the rows shown."""
+
+    def __init__(
+        self,
+        rows: Sequence[Any],
+        headers: List[str],
+        render: Callable[[Any], List[Any]],
+        per_page: int = ROWS_PER_PAGE,
+    ) -> None:
+        super().__init__(rows, per_page=per_page)
+        self.headers: List[str] = headers
+        self.render = render
+
+    async def format_page(self, menu: ButtonMenuPages, entries: List[Any]) -> str:
+        table = tabulate(
+            [[cell(value) for value in self.render(entry)] for entry in entries], headers=self.headers
+        )
+        return (
+            f"```\n{table}\n```"
+            f"Page {menu.current_page + 1}/{self.get_max_pages()} · {len(self.entries)} rows"
+        )
+
+
+class ReportMenu(ButtonMenuPages):
+    """
+    Paginated report answering a slash command.
+
+    The pinned nextcord-ext-menus only starts menus from a command context,
+    :meth:`start_interaction` sends the first page as the interaction response.
+    """
+
+    async def start_interaction(self, inter: Interaction, ephemeral: bool = False) -> None:
+        """
+        Send the first page, with pagination buttons if there's more than one.
+
+        :param inter: The interaction of the slash command.
+        :param ephemeral: Whether only the user who ran the command sees the report.
+        """
+        await self._source._prepare_once()  # noqa
+        self.bot = inter.client
+        self._author_id = inter.user.id
+
+        kwargs = await self._get_kwargs_from_page(await self._source.get_page(0))
+        if self._source.is_paginating():
+            kwargs["view"] = self
+        else:
+            self.stop()
+        await inter.send(**{k: v for k, v in kwargs.items() if v is not None}, ephemeral=ephemeral)
+        self.message = await inter.original_message()
+
+    async def interaction_check(self, interaction: Interaction) -> bool:
+        """Only the user who ran the command turns the pages."""
+        return interaction.user.id == self._author_id
+
+    async def on_timeout(self) -> None:
+        await self.disable()
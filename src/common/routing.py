@@ -0,0 +1,122 @@
+from typing import *
+
+from src.common.models import Pool
+
+
+class RoutingIndex:
+    """
+    Precomputed channel -> pool -> destination lookup for the relay hot path.
+
+    Every pooled channel id maps to the pools it belongs to, and each pool maps to
+    the tuple of other channels a message from that channel should be relayed to.
+    Channels that aren't pooled are simply absent, so unrelayed traffic costs a
+    single dict lookup.
+
+    When a channel is in several pools, a destination shared by them is only
+    routed through the first of them, so the destinations of all pools of a
+    channel together form one set without duplicates.
+    """
+
+    def __init__(self) -> None:
+        self.routes: Dict[int, Dict[str, Tuple[int, ...]]] = {}
+        self.members: Dict[str, Tuple[int, ...]] = {}
+        # Bumped on every membership change, so views derived from it know when to rebuild
+        self.version: int = 0
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self.routes
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the IDs of every pooled channel."""
+        return iter(self.routes)
+
+    def get(self, channel_id: int) -> Dict[str, Tuple[int, ...]]:
+        """
+        Get the pools and destinations for a channel.
+
+        :param channel_id: The ID of the source channel.
+        :return: A mapping of pool name to destination channel IDs, empty if the channel isn't pooled.
+        """
+        return self.routes.get(channel_id, {})
+
+    def pool_of(self, channel_id: int) -> str:
+        """
+        Get the pool the messages of a channel are first relayed through, used to attribute work to a pool.
+
+        That's the first pool with destinations left for the channel, so events
+        about its messages are queued behind them, or its first pool if every
+        destination was collapsed away.
+
+        :param channel_id: The ID of the channel.
+        :return: The name of the pool, or an empty string if the channel isn't pooled.
+        """
+        pools = self.routes.get(channel_id, {})
+        return next(
+            (pool_name for pool_name, destinations in pools.items() if destinations),
+            next(iter(pools), ""),
+        )
+
+    def destinations(self, channel_id: int, pool_name: str) -> Tuple[int, ...]:
+        """
+        Get the channels a message from the given channel should be relayed to.
+
+        :param channel_id: The ID of the source channel.
+        :param pool_name: The name of the pool the message is relayed through.
+        :return: The destination channel IDs, in pool order.
+        """
+        return self.routes.get(channel_id, {}).get(pool_name, ())
+
+    def rebuild(self, pools: Dict[str, Pool]) -> None:
+        """
+        Rebuild the whole index from the pools.
+
+        :param pools: The pools, as stored on the Relay cog.
+        """
+        self.routes = {}
+        self.members = {}
+        self.version += 1
+        for pool_name, pool in pools.items():
+            self.update_pool(pool_name, pool)
+
+    def update_pool(self, pool_name: str, pool: Optional[Pool]) -> None:
+        """
+        Recompute the routes of a single pool after its membership changed.
+
+        :param pool_name: The name of the pool that changed.
+        :param pool: The new state of the pool, or None if the pool was deleted.
+        """
+        self.version += 1
+        previous = self.members.pop(pool_name, ())
+        for channel_id in previous:
+            pools = self.routes.get(channel_id)
+            if pools is None:
+                continue
+            pools.pop(pool_name, None)
+            if not pools:
+                del self.routes[channel_id]
+
+        # dict.fromkeys keeps pool order while dropping duplicate entries
+        members = tuple(dict.fromkeys(pool.channel_ids())) if pool is not None else ()
+        if members:
+            self.members[pool_name] = members
+            for channel_id in members:
+                self.routes.setdefault(channel_id, {})[pool_name] = ()
+
+        for channel_id in set(previous).union(members):
+            if channel_id in self.routes:
+                self.collapse(channel_id)
+
+    def collapse(self, channel_id: int) -> None:
+        """
+        Recompute the destinations of a channel, skipping those an earlier pool already reaches.
+
+        :param channel_id: The ID of the source channel.
+        """
+        seen = {channel_id}
+        pools = self.routes[channel_id]
+        for pool_name in pools:
+            destinations = tuple(
+                other for other in self.members[pool_name] if other not in seen
+            )
+            pools[pool_name] = destinations
+            seen.update(destinations)
@@ -0,0 +1,438 @@
+from asyncio import Event, Future, Task, create_task, get_running_loop, wait_for, TimeoutError
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar
+from time import monotonic
+
+from nextcord import HTTPException
+
+from src.common.common import *
+from src.common.models import DEFAULT_BUDGET, Budget
+
+# Priorities, lower values are sent first
+DELIVERY: int = 0
+MIRROR: int = 1
+
+# Maximum number of requests in flight across all queues
+MAX_IN_FLIGHT: int = 16
+
+# Above this many queued requests, new low priority work is shed
+SHED_DEPTH: int = 500
+
+# Default request budgets per bucket kind, as (requests, per seconds)
+BUCKET_LIMITS: Dict[str, Tuple[int, float]] = {
+    "webhook": (5, 2.0),
+    "channel": (4, 1.0),
+}
+
+# The bucket of the request running in the current task, for the response hook of the HTTP session
+current_bucket: ContextVar[Optional[Tuple[str, int]]] = ContextVar("current_bucket", default=None)
+
+
+class Bucket:
+    """
+    The local view of a Discord rate-limit bucket.
+
+    Requests are paced with the documented default budget, and the budget is
+    corrected from the ``X-RateLimit-*`` headers whenever Discord returns them.
+    """
+
+    __slots__ = ("limit", "per", "remaining", "reset_at")
+
+    def __init__(self, limit: int, per: float) -> None:
+        self.limit: int = limit
+        self.per: float = per
+        self.remaining: int = limit
+        self.reset_at: float = 0.0
+
+    def delay(self, now: float) -> float:
+        """Return how long to wait before the next request may be sent."""
+        if now >= self.reset_at:
+            return 0.0
+        return 0.0 if self.remaining > 0 else self.reset_at - now
+
+    def acquire(self, now: float) -> None:
+        """Use up one request of the budget."""
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.per
+        self.remaining -= 1
+
+    def update(self, headers: Mapping[str, str], now: float) -> None:
+        """Correct the budget from the rate-limit headers of a response."""
+        limit = headers.get("X-RateLimit-Limit")
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After") or headers.get("Retry-After")
+        if limit is not None:
+            self.limit = int(limit)
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset_after is not None:
+            self.reset_at = now + float(reset_after)
+
+
+class Job:
+    """A queued request."""
+
+    __slots__ = ("factory", "future", "pool_name", "coalesce_key", "enqueued_at")
+
+    def __init__(
+        self,
+        factory: Callable[[], Awaitable[Any]],
+        future: Future,
+        pool_name: str,
+        coalesce_key: Optional[Hashable],
+    ) -> None:
+        self.factory = factory
+        self.future: Future = future
+        self.pool_name: str = pool_name
+        self.coalesce_key: Optional[Hashable] = coalesce_key
+        self.enqueued_at: float = monotonic()
+
+
+class KeyQueue:
+    """
+    The requests waiting on one webhook or channel, per pool and by priority.
+
+    A destination can be shared by several pools, every pool with requests
+    queued here has the queue in its ring of their priority and only ever
+    starts its own requests.
+    """
+
+    __slots__ = ("key", "jobs", "bucket", "busy")
+
+    def __init__(self, key: Tuple[str, int], bucket: Bucket) -> None:
+        self.key: Tuple[str, int] = key
+        self.jobs: Dict[str, Tuple[Deque[Job], Deque[Job]]] = {}
+        self.bucket: Bucket = bucket
+        self.busy: bool = False
+
+    def __len__(self) -> int:
+        return sum(self.depth(pool_name) for pool_name in self.jobs)
+
+    def depth(self, pool_name: str) -> int:
+        """Return the number of requests queued here for a pool."""
+        jobs = self.jobs.get(pool_name)
+        return len(jobs[DELIVERY]) + len(jobs[MIRROR]) if jobs else 0
+
+    def push(self, job: Job, priority: int) -> bool:
+        """
+        Queue a request behind the others of its pool and priority.
+
+        :return: Whether the pool had nothing of the priority queued here yet, so the
+            queue joins its ring of that priority.
+        """
+        jobs = self.jobs.get(job.pool_name)
+        if jobs is None:
+            jobs = self.jobs[job.pool_name] = (deque(), deque())
+        jobs[priority].append(job)
+        return len(jobs[priority]) == 1
+
+    def pop(self, pool_name: str, priority: int) -> Job:
+        """Take the next request of a pool and priority, forgetting the pool once it has none left here."""
+        jobs = self.jobs[pool_name]
+        job = jobs[priority].popleft()
+        if not jobs[DELIVERY] and not jobs[MIRROR]:
+            del self.jobs[pool_name]
+        return job
+
+
+class PoolShare:
+    """
+    What a pool uses of its budget in the scheduler: its send rate tokens and its requests in flight.
+
+    The rate is a token bucket holding up to one second of requests, so a quiet
+    pool can send a short burst right away.
+    """
+
+    __slots__ = ("budget", "tokens", "refilled_at", "in_flight", "exhausted")
+
+    def __init__(self, budget: Budget) -> None:
+        self.budget: Budget = budget
+        self.tokens: float = max(1.0, budget.rate or 0.0)
+        self.refilled_at: float = monotonic()
+        self.in_flight: int = 0
+        # The quota that last held the pool back, until it sends again
+        self.exhausted: Optional[str] = None
+
+    def check(self, now: float) -> Tuple[Optional[str], float]:
+        """
+        Check whether the pool may start another request.
+
+        :return: The exhausted quota, None if a request may start, and how long
+            until the rate allows one, 0 when it isn't the rate holding the pool back.
+        """
+        budget = self.budget
+        if budget.concurrency is not None and self.in_flight >= budget.concurrency:
+            return "concurrency", 0.0
+
+        if budget.rate is not None:
+            self.tokens = min(
+                max(1.0, budget.rate), self.tokens + (now - self.refilled_at) * budget.rate
+            )
+            self.refilled_at = now
+            if self.tokens < 1.0:
+                return "rate", (1.0 - self.tokens) / budget.rate
+
+        return None, 0.0
+
+    def acquire(self) -> None:
+        """Use up one request of the budget."""
+        self.in_flight += 1
+        if self.budget.rate is not None:
+            self.tokens -= 1.0
+        self.exhausted = None
+
+
+class SendScheduler:
+    """
+    Schedules outbound Discord requests of the relay through per-webhook and per-channel queues.
+
+    Requests for the same webhook or channel are sent one at a time, in order
+    within each pool, paced by that bucket's rate limit, so bursts queue up locally instead of
+    piling onto Discord as 429s. Pools take turns, so a busy pool can't delay
+    every other one. Every pool has a ring of queues per priority, and message
+    delivery of every pool is started before any reaction mirroring, which
+    only gets the requests in flight that deliveries leave over.
+    Under sustained overload, queued mirror requests for the same reaction are
+    coalesced into the latest one and new ones are shed.
+
+    Buckets outlive the queues of their webhook or channel, so a route that is
+    idle for a moment keeps its pacing. They're corrected from the headers of
+    every response, passed to :meth:`on_request_end` by the HTTP session.
+
+    Every pool has a :class:`~src.common.models.Budget`, looked up with
+    ``budget_of``: a pool may start as many requests per round as its weight,
+    as long as its send rate and concurrency quotas allow. A pool held back by
+    a quota leaves its turn to the others, and is counted in ``exhausted``
+    once per time it runs out.
+    """
+
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT, shed_depth: int = SHED_DEPTH) -> None:
+        self.max_in_flight: int = max_in_flight
+        self.shed_depth: int = shed_depth
+        self.queues: Dict[Tuple[str, int], KeyQueue] = {}
+        self.buckets: Dict[Tuple[str, int], Bucket] = {}
+        # The queues with requests of every pool, in one ring per priority
+        self.pools: OrderedDict[str, Tuple[Deque[KeyQueue], Deque[KeyQueue]]] = OrderedDict()
+        # Queued requests by coalesce key, until they start
+        self.pending: Dict[Hashable, Job] = {}
+        self.budget_of: Callable[[str], Budget] = lambda pool_name: DEFAULT_BUDGET
+        self.shares: Dict[str, PoolShare] = {}
+        self.exhausted: Counter = Counter()
+        self.depth: int = 0
+        self.in_flight: int = 0
+        self.stats: Counter = Counter()
+        self.wakeup: Event = Event()
+        self.task: Optional[Task] = None
+
+    def depths(self) -> Dict[str, int]:
+        """Return the number of queued requests per pool."""
+        return {
+            pool_name: sum(
+                len(queue.jobs[pool_name][priority])
+                for priority, ring in enumerate(rings)
+                for queue in ring
+            )
+            for pool_name, rings in self.pools.items()
+        }
+
+    def share(self, pool_name: str) -> PoolShare:
+        """The share of a pool, with its current budget."""
+        share = self.shares.get(pool_name)
+        if share is None:
+            share = self.shares[pool_name] = PoolShare(self.budget_of(pool_name))
+        else:
+            share.budget = self.budget_of(pool_name)
+        return share
+
+    def bucket(self, key: Tuple[str, int]) -> Bucket:
+        """The bucket of a webhook or channel, created with the default budget of its kind."""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = Bucket(*BUCKET_LIMITS[key[0]])
+        return bucket
+
+    def observe(self, headers: Mapping[str, str]) -> None:
+        """Correct the bucket of the request running in this task from the headers of a response."""
+        key = current_bucket.get()
+        if key is not None:
+            self.bucket(key).update(headers, monotonic())
+
+    async def on_request_end(self, session: Any, context: Any, params: Any) -> None:
+        """The ``on_request_end`` hook of an aiohttp trace config, see :meth:`observe`."""
+        self.observe(params.response.headers)
+
+    def in_flight_by_pool(self) -> Dict[str, int]:
+        """Return the number of requests in flight per pool."""
+        return {pool_name: share.in_flight for pool_name, share in self.shares.items() if share.in_flight}
+
+    def submit(
+        self,
+        key: Tuple[str, int],
+        pool_name: str,
+        priority: int,
+        factory: Callable[[], Awaitable[Any]],
+        coalesce_key: Optional[Hashable] = None,
+    ) -> Future:
+        """
+        Queue a request.
+
+        :param key: The bucket of the request, ``("webhook", id)`` or ``("channel", id)``.
+        :param pool_name: The pool the request is made for.
+        :param priority: DELIVERY or MIRROR.
+        :param factory: Creates the coroutine performing the request.
+        :param coalesce_key: Low priority requests for the same thing share this key, while one
+            is queued a new one replaces its request, so only the latest state is sent.
+        :return: A future resolved with the result of the request, or None if it was shed.
+        """
+        if self.task is None or self.task.done():
+            self.task = create_task(self.dispatch())
+
+        loop = get_running_loop()
+
+        queued = self.pending.get(coalesce_key) if coalesce_key is not None else None
+        if queued is not None:
+            # Only the latest desired state of a key is sent, e.g. remove after add
+            queued.factory = factory
+            self.stats["coalesced"] += 1
+            return queued.future
+
+        if priority != DELIVERY and self.depth >= self.shed_depth:
+            self.stats["shed"] += 1
+            future = loop.create_future()
+            future.set_result(None)
+            return future
+
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = KeyQueue(key, self.bucket(key))
+
+        job = Job(factory, loop.create_future(), pool_name, coalesce_key)
+        if queue.push(job, priority):
+            self.pools.setdefault(pool_name, (deque(), deque()))[priority].append(queue)
+        if coalesce_key is not None:
+            self.pending[coalesce_key] = job
+
+        self.depth += 1
+        self.stats["submitted"] += 1
+        self.wakeup.set()
+        return job.future
+
+    async def send(self, *args, **kwargs) -> Any:
+        """Queue a request and wait for its result, see :meth:`submit`."""
+        return await self.submit(*args, **kwargs)
+
+    async def dispatch(self) -> None:
+        """Start queued requests as their buckets allow, one pool at a time."""
+        while True:
+            self.wakeup.clear()
+            now = monotonic()
+            timeout = None
+            started = False
+
+            # Every pool with work gets to start up to its weight in requests per pass,
+            # deliveries of all pools first, mirroring only with the requests they leave over
+            turns: Dict[str, int] = {}
+            for priority in (DELIVERY, MIRROR):
+                for pool_name in list(self.pools):
+                    if self.in_flight >= self.max_in_flight:
+                        break
+                    if pool_name not in self.pools:
+                        continue
+
+                    share = self.share(pool_name)
+                    ring = self.pools[pool_name][priority]
+                    turns.setdefault(pool_name, share.budget.weight)
+                    for _ in range(len(ring)):
+                        if not ring or turns[pool_name] <= 0 or self.in_flight >= self.max_in_flight:
+                            break
+
+                        quota, delay = share.check(now)
+                        if quota is not None:
+                            if share.exhausted != quota:
+                                share.exhausted = quota
+                                self.exhausted[pool_name, quota] += 1
+                            if delay > 0:
+                                timeout = delay if timeout is None else min(timeout, delay)
+                            break
+
+                        queue = ring[0]
+                        ring.rotate(-1)
+                        if queue.busy:
+                            continue
+
+                        delay = queue.bucket.delay(now)
+                        if delay > 0:
+                            timeout = delay if timeout is None else min(timeout, delay)
+                            continue
+
+                        share.acquire()
+                        self.start(queue, pool_name, priority, now)
+                        started = True
+                        turns[pool_name] -= 1
+
+                    # Pools move to the back once served, so the next pass starts with another pool
+                    if pool_name in self.pools:
+                        self.pools.move_to_end(pool_name)
+
+            if started:
+                continue
+
+            try:
+                await wait_for(self.wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+
+    def start(self, queue: KeyQueue, pool_name: str, priority: int, now: float) -> None:
+        """Pop the next request of a pool and priority from a queue and run it."""
+        job = queue.pop(pool_name, priority)
+        self.depth -= 1
+        if job.coalesce_key is not None:
+            # Requests for the key submitted from now on are sent after this one
+            self.pending.pop(job.coalesce_key, None)
+        if pool_name not in queue.jobs or not queue.jobs[pool_name][priority]:
+            self.unschedule(queue, pool_name, priority)
+
+        queue.busy = True
+        queue.bucket.acquire(now)
+        self.in_flight += 1
+        self.stats["waited_ms"] += int((now - job.enqueued_at) * 1000)
+        create_task(self.run(queue, job))
+
+    def unschedule(self, queue: KeyQueue, pool_name: str, priority: int) -> None:
+        rings = self.pools[pool_name]
+        rings[priority].remove(queue)
+        if not rings[DELIVERY] and not rings[MIRROR]:
+            del self.pools[pool_name]
+
+    async def run(self, queue: KeyQueue, job: Job) -> None:
+        # Only seen by this task, its requests are the ones of the job
+        current_bucket.set(queue.key)
+        try:
+            result = await job.factory()
+        except HTTPException as e:
+            headers = getattr(e.response, "headers", None)
+            if headers:
+                queue.bucket.update(headers, monotonic())
+            if e.status == 429:
+                self.stats["rate_limited"] += 1
+            self.stats["failed"] += 1
+            job.future.set_exception(e)
+        except Exception as e:
+            self.stats["failed"] += 1
+            job.future.set_exception(e)
+        else:
+            self.stats["completed"] += 1
+            job.future.set_result(result)
+        finally:
+            queue.busy = False
+            self.in_flight -= 1
+            self.shares[job.pool_name].in_flight -= 1
+            if not queue.jobs:
+                self.queues.pop(queue.key, None)
+            self.wakeup.set()
+
+    async def close(self) -> None:
+        """Stop dispatching queued requests."""
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,192 @@
+from collections import Counter
+from datetime import datetime
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
+
+from src.common.common import *
+from src.common.models import Pool
+
+# How often, in seconds, buffered message counts are written to the database
+FLUSH_INTERVAL: float = 10.0
+
+# How often, in seconds, pool changes are polled for when change streams aren't available
+SYNC_INTERVAL: float = 2.0
+
+# Change stream events that change a pool's configuration, message count increments are skipped
+CONFIG_CHANGES: List[Dict[str, Any]] = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": {"$in": ["insert", "replace", "delete"]}},
+                {"updateDescription.updatedFields.revision": {"$exists": True}},
+            ]
+        }
+    }
+]
+
+
+class PoolStore:
+    """
+    Persists relay pools as one document per pool in the ``relay_pools`` collection.
+
+    Configuration changes are written through immediately with :meth:`save_pool`.
+    Message counts are buffered in memory by :meth:`increment` and applied as
+    batched ``$inc`` updates by :meth:`flush`, so relaying a message never rewrites
+    any pool configuration.
+
+    Every configuration write bumps the pool's ``revision``, so processes running
+    other shard clusters pick the change up in :meth:`sync`, from a change stream
+    or, on a standalone server, by polling ``updated_at``.
+    """
+
+    def __init__(self) -> None:
+        self.pending: Counter = Counter()
+        self.revisions: Dict[str, int] = {}
+        self.synced_at: Optional[datetime] = None
+        self.streams: bool = True
+
+    async def ensure_indexes(self) -> None:
+        """Create the index used to poll for changed pools."""
+        await db.relay_pools.create_index([("updated_at", ASCENDING)])
+
+    def from_document(self, document: Dict[str, Any]) -> Tuple[str, Pool]:
+        """
+        Turn a stored pool document into the pool kept in memory.
+
+        :param document: The document stored in the ``relay_pools`` collection.
+        :return: The name of the pool and the pool.
+        """
+        pool_name = document["_id"]
+        self.revisions[pool_name] = document.get("revision", 0)
+        updated_at = document.get("updated_at")
+        if updated_at is not None and (self.synced_at is None or updated_at > self.synced_at):
+            self.synced_at = updated_at
+
+        pool = Pool.from_document(pool_name, document)
+        for guild_id, membership in pool.servers.items():
+            # Counts buffered by this process aren't in the document yet
+            membership.message_count += self.pending[pool_name, guild_id]
+        return pool_name, pool
+
+    async def load(self) -> Dict[str, Pool]:
+        """
+        Load every pool from the database.
+
+        The legacy single ``pools`` document is migrated in place on first load.
+
+        :return: The pools, keyed by pool name.
+        """
+        pools = {}
+        async for document in db.relay_pools.find({}):
+            pool_name, pool = self.from_document(document)
+            pools[pool_name] = pool
+
+        if not pools:
+            legacy = await db.pools.find_one({"_id": "pools"})
+            if legacy and legacy.get("data"):
+                pools = {
+                    pool_name: Pool.from_document(pool_name, pool_data)
+                    for pool_name, pool_data in legacy["data"].items()
+                }
+                await db.relay_pools.insert_many(
+                    [{"_id": pool_name, **pool.to_document()} for pool_name, pool in pools.items()]
+                )
+
+        return pools
+
+    async def save_pool(self, pool: Pool) -> None:
+        """
+        Write the configuration of a pool through to the database.
+
+        Message counts aren't written, so buffered increments are never overwritten.
+
+        :param pool: The pool to save.
+        """
+        update = {
+            "password": pool.password,
+            "moderation": pool.moderation,
+            "coalesce": pool.coalesce,
+            "budget": pool.budget.to_document(),
+        }
+        for guild_id, membership in pool.servers.items():
+            update[f"servers.{guild_id}.channels"] = membership.channels.tolist()
+
+        pool_name = pool.name
+        document = await db.relay_pools.find_one_and_update(
+            {"_id": pool_name},
+            {"$set": update, "$inc": {"revision": 1}, "$currentDate": {"updated_at": True}},
+            projection={"revision": True},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        # Our own change comes back through sync, the revision tells it apart
+        self.revisions[pool_name] = document["revision"]
+
+    async def sync(self, on_change: Callable[[str, Optional[Pool]], Awaitable[None]]) -> None:
+        """
+        Apply pool changes written by other processes.
+
+        Changes missed since the last call are polled first. With change streams,
+        the stream is then followed until it breaks; on a standalone server,
+        which has none, every call is a single poll.
+
+        :param on_change: Called with the name and new state of every changed pool,
+            or None if the pool was deleted.
+        """
+        query = {} if self.synced_at is None else {"updated_at": {"$gte": self.synced_at}}
+        async for document in db.relay_pools.find(query):
+            if document.get("revision", 0) > self.revisions.get(document["_id"], 0):
+                await on_change(*self.from_document(document))
+
+        if not self.streams:
+            return
+
+        try:
+            async with db.relay_pools.watch(CONFIG_CHANGES, full_document="updateLookup") as stream:
+                async for change in stream:
+                    pool_name = change["documentKey"]["_id"]
+                    document = change.get("fullDocument")
+                    if document is None:
+                        self.revisions.pop(pool_name, None)
+                        await on_change(pool_name, None)
+                    elif document.get("revision", 0) > self.revisions.get(pool_name, 0):
+                        await on_change(*self.from_document(document))
+        except OperationFailure as e:
+            # Change streams need a replica set, fall back to polling
+            print(f"Error watching pools, polling instead: {e}")
+            self.streams = False
+
+    def increment(self, pool_name: str, guild_id: int, amount: int = 1) -> None:
+        """
+        Buffer a message count increment until the next flush.
+
+        :param pool_name: The name of the pool the message was relayed through.
+        :param guild_id: The ID of the server that sent the message.
+        :param amount: The number of messages to add.
+        """
+        self.pending[pool_name, guild_id] += amount
+
+    async def flush(self) -> None:
+        """Apply all buffered message count increments in a single bulk write."""
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, Counter()
+
+        increments: Dict[str, Dict[str, int]] = {}
+        for (pool_name, guild_id), amount in pending.items():
+            increments.setdefault(pool_name, {})[f"servers.{guild_id}.message_count"] = amount
+
+        try:
+            await db.relay_pools.bulk_write(
+                [
+                    UpdateOne({"_id": pool_name}, {"$inc": inc})
+                    for pool_name, inc in increments.items()
+                ],
+                ordered=False,
+            )
+        except Exception:
+            # Keep the increments for the next flush rather than losing them
+            self.pending.update(pending)
+            raise
@@ -0,0 +1,152 @@
+from asyncio import Lock
+
+from nextcord import Webhook, TextChannel, NotFound
+
+from src.common.common import *
+
+
+class WebhookCache:
+    """
+    Caches the relay webhook of every channel by channel ID.
+
+    The webhook ID and token are kept in memory and in the ``webhooks`` collection,
+    so a relayed message only costs the webhook execute itself. Entries are filled
+    on first use or at startup with :meth:`load` and evicted with :meth:`evict`
+    once Discord reports the webhook as unknown.
+    """
+
+    def __init__(self, bot, webhook_name: str) -> None:
+        self.bot = bot
+        self.webhook_name: str = webhook_name
+        self.webhooks: Dict[int, Webhook] = {}
+        # IDs of the cached webhooks, kept in step with webhooks to spot the bot's own messages
+        self.webhook_ids: Set[int] = set()
+        self.locks: Dict[int, Lock] = {}
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self.webhooks
+
+    def __len__(self) -> int:
+        return len(self.webhooks)
+
+    def ids(self) -> Set[int]:
+        """Return the IDs of every cached webhook."""
+        return self.webhook_ids
+
+    def add(self, channel_id: int, webhook: Webhook) -> None:
+        """Cache the relay webhook of a channel."""
+        previous = self.webhooks.get(channel_id)
+        if previous is not None:
+            self.webhook_ids.discard(previous.id)
+        self.webhooks[channel_id] = webhook
+        self.webhook_ids.add(webhook.id)
+
+    def from_document(self, document: Dict[str, Any]) -> Webhook:
+        """
+        Build a usable webhook from a stored document without any REST call.
+
+        :param document: The document stored in the ``webhooks`` collection.
+        :return: The webhook bound to the bot's connection state.
+        """
+        return Webhook.from_state(
+            {
+                "id": document["webhook_id"],
+                "type": 1,
+                "token": document["token"],
+                "channel_id": document["_id"],
+                "name": self.webhook_name,
+            },
+            state=self.bot._connection,  # noqa
+        )
+
+    async def load(self) -> None:
+        """Fill the cache from the database."""
+        async for document in db.webhooks.find({}):
+            self.add(document["_id"], self.from_document(document))
+
+    def cached(self, channel_id: int) -> Optional[Webhook]:
+        """
+        Get the cached relay webhook of a channel, without any REST call.
+
+        :param channel_id: The ID of the channel.
+        :return: The cached webhook, or None if the channel has none cached.
+        """
+        return self.webhooks.get(channel_id)
+
+    async def lookup(self, channel_id: int) -> Optional[Webhook]:
+        """
+        Get the relay webhook of a channel from the cache or the database, without any REST call.
+
+        Webhooks created by processes running other shards are only in the database.
+
+        :param channel_id: The ID of the channel.
+        :return: The webhook, or None if the channel has none yet.
+        """
+        webhook = self.webhooks.get(channel_id)
+        if webhook is None:
+            document = await db.webhooks.find_one({"_id": channel_id})
+            if document is not None:
+                webhook = self.from_document(document)
+                self.add(channel_id, webhook)
+        return webhook
+
+    async def get(self, channel: TextChannel) -> Webhook:
+        """
+        Get the relay webhook of a channel, finding or creating it on a cache miss.
+
+        :param channel: The channel to get the webhook for.
+        :return: The cached, found or created webhook.
+        """
+        webhook = self.webhooks.get(channel.id)
+        if webhook is not None:
+            return webhook
+
+        # Only one lookup per channel at a time, so concurrent misses can't create duplicates
+        lock = self.locks.setdefault(channel.id, Lock())
+        try:
+            async with lock:
+                webhook = self.webhooks.get(channel.id)
+                if webhook is not None:
+                    return webhook
+
+                # Fetch the list of webhooks in the channel
+                webhooks = await channel.webhooks()
+
+                # Check if a usable webhook with the given name exists
+                webhook = next(
+                    (wh for wh in webhooks if wh.name == self.webhook_name and wh.token),
+                    None,
+                )
+
+                # If the webhook doesn't exist, create a new one
+                if webhook is None:
+                    webhook = await channel.create_webhook(name=self.webhook_name)
+
+                self.add(channel.id, webhook)
+                await db.webhooks.update_one(
+                    {"_id": channel.id},
+                    {"$set": {"webhook_id": webhook.id, "token": webhook.token}},
+                    upsert=True,
+                )
+        finally:
+            # Also when the lookup failed, so a channel the bot can't manage doesn't keep its lock forever
+            if self.locks.get(channel.id) is lock:
+                del self.locks[channel.id]
+
+        return webhook
+
+    async def evict(self, channel_id: int) -> None:
+        """
+        Drop the cached webhook of a channel, e.g. after it was deleted.
+
+        :param channel_id: The ID of the channel whose webhook should be dropped.
+        """
+        webhook = self.webhooks.pop(channel_id, None)
+        if webhook is not None:
+            self.webhook_ids.discard(webhook.id)
+            await db.webhooks.delete_one({"_id": channel_id})
+
+
+def is_unknown_webhook(err: Exception) -> bool:
+    """Check whether an exception means the webhook no longer exists."""
+    return isinstance(err, NotFound) or getattr(err, "code", None) == 10015